@@ -1,14 +1,17 @@
 """Base reader class -- read from a URL in the background."""
 
 import sys
+import time
 from tkinter import *
 import urllib.parse
 from . import grailutil
 
 
 # Default tuning parameters
-# BUFSIZE = 8*1024                      # Buffer size for api.getdata()
-BUFSIZE = 512                           # Smaller size for better response
+BUFSIZE = 512                           # Initial api.getdata() size, small
+                                        # for a quick first paint
+MAXBUFSIZE = 64*1024                    # Largest api.getdata() size
+FEEDTIME = 0.02                         # Seconds one data callback may take
 SLEEPTIME = 100                         # Milliseconds between regular checks
 
 
@@ -27,21 +30,33 @@ class BaseReader:
 
     (meta data* stop (eof | error) | stop handle_error)
 
+    The amount of data asked of the API per callback starts at
+    bufsize and adapts to the observed time per callback (reading
+    plus handle_data()), aiming at feedtime seconds: it at most
+    doubles or halves each time, between minbufsize and maxbufsize.
+    Each reader keeps count of its data callbacks (nreads) and the
+    time spent in them (readtime).
+
     """
 
     # Tuning parameters
     sleeptime = SLEEPTIME
+    bufsize = BUFSIZE
+    minbufsize = BUFSIZE
+    maxbufsize = MAXBUFSIZE
+    feedtime = FEEDTIME
 
     def __init__(self, context, api):
         self.context = context
         self.api = api
         self.callback = self.checkmeta
         self.poller = self.api.pollmeta
-        self.bufsize = BUFSIZE
 
         # Stuff for status reporting
         self.nbytes = 0
         self.maxbytes = 0
+        self.nreads = 0
+        self.readtime = 0.0
         self.shorturl = ""
         self.message = "waiting for socket"
 
@@ -174,6 +189,16 @@ class BaseReader:
                 app = grailutil.get_grailapp()
             app.exception_dialog("in BaseReader")
             self.kill()
+        else:
+            # The API may be sitting on buffered data, or on the end of a
+            # response read from a kept-alive connection, without the
+            # socket becoming readable again; don't wait for it.
+            if self.fno >= 0 and self.poller and self.poller()[1]:
+                self.context.root.after_idle(self.checkapi_pending)
+
+    def checkapi_pending(self):
+        if self.callback:
+            self.checkapi()
 
     def checkmeta(self):
         self.message, ready = self.api.pollmeta()
@@ -199,13 +224,31 @@ class BaseReader:
             self.callback()             # XXX Handle httpAPI readahead
 
     def getapidata(self):
-        data = self.api.getdata(self.bufsize)
+        t0 = time.perf_counter()
+        bufsize = self.bufsize
+        data = self.api.getdata(bufsize)
         if not data:
             self.handle_eof()
             self.stop()
             return
         self.update_nbytes(data)
         self.handle_data(data)
+        self.adapt_bufsize(len(data), time.perf_counter() - t0)
+
+    def adapt_bufsize(self, nbytes, elapsed):
+        self.nreads = self.nreads + 1
+        self.readtime = self.readtime + elapsed
+        bufsize = self.bufsize
+        if nbytes < bufsize and elapsed < self.feedtime:
+            # The data arrives slower than we read it; nothing to learn
+            return
+        if elapsed > 0:
+            bufsize = min(max(int(nbytes * self.feedtime / elapsed),
+                              bufsize // 2),
+                          bufsize * 2)
+        else:
+            bufsize = bufsize * 2
+        self.bufsize = min(max(bufsize, self.minbufsize), self.maxbufsize)
 
     def geteverything(self):
         if self.api:
@@ -234,3 +277,85 @@ class BaseReader:
     def handle_eof(self):
         # Called after self.stop() has been called
         pass
+
+
+class BareContext:
+
+    """Just enough of a Context for a BaseReader on its own.
+
+    Used by benchmark() and the httpAPI tests, which have no browser
+    window to load into.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.app = self
+
+    def addreader(self, reader):
+        pass
+
+    def rmreader(self, reader):
+        pass
+
+    def new_reader_status(self):
+        pass
+
+    def remove_local_api_handlers(self):
+        pass
+
+
+def benchmark(size=10*1024*1024):
+    """Time loading a large local file through fileAPI.
+
+    Run with "python -m grail.BaseReader".  The data is fed to an
+    SGMLLexer, with the adaptive read size and with fixed BUFSIZE
+    reads.
+    """
+    import tempfile
+    import tkinter
+    from . import grail_root
+    from .grailbase import utils
+    from .grailbase.app import Application
+    from .protocols.fileAPI import file_access
+    from .sgml.SGMLLexer import SGMLLexer
+
+    class LexingReader(BaseReader):
+        done = False
+
+        def __init__(self, context, api):
+            self.lexer = SGMLLexer()
+            BaseReader.__init__(self, context, api)
+
+        def handle_data(self, data):
+            self.lexer.feed(data.decode('latin-1'))
+
+        def handle_eof(self):
+            self.lexer.close()
+            self.done = True
+
+    utils._grail_root = grail_root
+    Application()
+    root = tkinter.Tcl()
+    row = ('<p>Lorem <b>ipsum</b> dolor sit amet, <a href="x.html">'
+           'consectetur</a> adipiscing elit.\n').encode()
+    with tempfile.NamedTemporaryFile(suffix='.html') as fp:
+        fp.write(row * (size // len(row) + 1))
+        fp.flush()
+        print("{:>9} {:>9} {:>9} {:>9}".format(
+            "bufsize", "reads", "peak", "seconds"))
+        for maxbufsize in (MAXBUFSIZE, BUFSIZE):
+            api = file_access(fp.name, 'GET', {})
+            t0 = time.perf_counter()
+            reader = LexingReader(BareContext(root), api)
+            reader.maxbufsize = maxbufsize
+            peak = 0
+            while not reader.done:
+                root.tk.dooneevent()
+                peak = max(peak, reader.bufsize)
+            print("{:>9} {:>9} {:>9} {:>9.2f}".format(
+                "adaptive" if maxbufsize > BUFSIZE else "fixed",
+                reader.nreads, peak, time.perf_counter() - t0))
+
+
+if __name__ == '__main__':
+    benchmark()
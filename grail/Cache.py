@@ -13,6 +13,122 @@ import os
 from . import protocols
 import time
 import copy
+import tempfile
+from bisect import bisect_right
+
+
+# Once a SharedItem loading from the network holds more than this many
+# bytes, its data goes to a file instead of staying in memory
+SPILL_SIZE = 1024 * 1024
+
+
+class ChunkStore:
+
+    """The data of a SharedItem, kept as the chunks it was received in.
+
+    offsets[i] is the offset of chunks[i] in the data, so the chunk
+    holding any offset is found with bisect: a read costs O(log k) for
+    k chunks, wherever the reader's offset falls.  Reads return
+    memoryview slices of the chunks instead of copies.
+
+    Iterating over a ChunkStore yields the chunks.
+
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.offsets = []
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def append(self, chunk):
+        self.offsets.append(self.size)
+        self.chunks.append(chunk)
+        self.size = self.size + len(chunk)
+
+    def read(self, offset, maxbytes):
+        """Return up to maxbytes from offset, without crossing a chunk."""
+        if offset >= self.size:
+            return b''
+        i = bisect_right(self.offsets, offset) - 1
+        start = offset - self.offsets[i]
+        return memoryview(self.chunks[i])[start:start + maxbytes]
+
+    def save(self, path):
+        """Write the data to a file named path."""
+        temp = path + '.tmp'
+        with open(temp, 'wb') as f:
+            f.writelines(self.chunks)
+        os.replace(temp, path)
+
+    def close(self):
+        pass
+
+
+class FileChunkStore:
+
+    """The data of a SharedItem, kept in a file.
+
+    This takes over from a ChunkStore when the data gets large.  Data
+    is appended to the file as it arrives and read back with pread(),
+    so any number of readers can share it at any offset.  If the file
+    was made in the disk cache (path given), save() just renames it to
+    its place in the cache; otherwise it is an anonymous temporary
+    file.  Until it is saved, the file is removed by close().
+
+    """
+
+    def __init__(self, store, fp, path=None):
+        self.fp = fp
+        self.fd = fp.fileno()
+        self.path = path
+        self.size = 0
+        for chunk in store:
+            self.append(chunk)
+        store.close()
+
+    def __len__(self):
+        return self.size
+
+    def append(self, chunk):
+        view = memoryview(chunk)
+        while view:
+            view = view[os.write(self.fd, view):]
+        self.size = self.size + len(chunk)
+
+    def read(self, offset, maxbytes):
+        if offset >= self.size:
+            return b''
+        return os.pread(self.fd, min(maxbytes, self.size - offset), offset)
+
+    def save(self, path):
+        if not self.path:
+            with open(path + '.tmp', 'wb') as f:
+                offset = 0
+                while offset < self.size:
+                    data = self.read(offset, 64 * 1024)
+                    f.write(data)
+                    offset = offset + len(data)
+            os.replace(path + '.tmp', path)
+        else:
+            os.replace(self.path, path)
+            self.path = None
+
+    def close(self):
+        fp = self.fp
+        self.fp = None
+        if fp:
+            fp.close()
+            if self.path:
+                try:
+                    os.unlink(self.path)
+                except OSError:
+                    pass
 
 
 class SharedItem:
@@ -22,6 +138,11 @@ class SharedItem:
     The interface is subtly different from that of protocol objects:
     getdata() takes an offset argument, and the sequencing
     restrictions are lifted (i.e. you can call anything in any order).
+    getdata() returns memoryview slices of the data it holds.
+
+    Data loaded from the network is kept in memory up to SPILL_SIZE
+    bytes; beyond that it goes to a file (see FileChunkStore), in the
+    disk cache directory if the item may be cached.
 
     A SharedItem hides all protocol access from the rest of the
     system. The reset() method actually calls on the protocol to
@@ -46,9 +167,8 @@ class SharedItem:
 
         # status
         self.reloading = False
-        self.data = []
+        self.data = ChunkStore()
         self.datalen = 0
-        self.datamap = {}
         self.complete = False
 
         # initialize in one of four states
@@ -108,6 +228,7 @@ class SharedItem:
                 self.finish()
             else:
                 self.abort()
+            self.data.close()
 
     def cache_update(self):
         if (not self.incache or self.reloading) \
@@ -146,38 +267,33 @@ class SharedItem:
         assert offset >= 0
         assert maxbytes > 0
 
+        if self.stage == META:
+            self.getmeta()
         while self.stage == DATA and offset >= self.datalen:
             buf = self.api.getdata(maxbytes)
             if not buf:
-                self.finish()
                 self.complete = True
+                self.finish()
             else:
-                l = len(buf)
-                if l > maxbytes:
-                    # we got more than we wanted,
-                    # so split into two strings (avoid search next time)
-                    self.data.append(buf[:maxbytes])
-                    self.datamap[offset] = len(self.data) - 1
-                    self.data.append(buf[maxbytes:])
-                    self.datamap[offset + maxbytes] = len(self.data) - 1
-                else:
-                    self.data.append(buf)
-                    self.datamap[offset] = len(self.data) - 1
-                self.datalen = self.datalen + l
-
-        try:
-            # the common case
-            chunk = self.data[self.datamap[offset]]
-            return chunk[0:maxbytes]
-        except KeyError:
-            if self.stage == META:
-                self.meta = self.api.getmeta()
-                self.stage = DATA
-            elif self.complete and offset >= self.datalen:
-                return b''
-            chunk_key, delta = self._getdata_search_string_list(offset)
-            chunk = self.data[self.datamap[chunk_key]]
-            return chunk[delta:]
+                self.data.append(buf)
+                self.datalen = self.data.size
+                if self.datalen > SPILL_SIZE \
+                   and isinstance(self.data, ChunkStore) \
+                   and not self.iscached():
+                    self.spill()
+
+        return self.data.read(offset, maxbytes)
+
+    def spill(self):
+        """Move the data to a file, and keep adding to it there."""
+        spool = None
+        if self.cache and not self.postdata:
+            spool = self.cache.spool_file()
+        if spool:
+            fp, path = spool
+        else:
+            fp, path = tempfile.TemporaryFile(), None
+        self.data = FileChunkStore(self.data, fp, path)
 
     def fileno(self):
         if self.api:
@@ -190,40 +306,33 @@ class SharedItem:
 
     def finish(self):
         if self.cache:
-            self.cache.deactivate(self.key)
             if not (self.meta and self.meta[0] == 200):
+                self.cache.deactivate(self.key, self)
                 self.cache.delete(self.key)
+            elif self.refcnt == 0 or not self.complete:
+                # A complete item stays active for requests that come
+                # in while it still has readers
+                self.cache.deactivate(self.key, self)
         self.stage = DONE
         api = self.api
         self.api = None
         if api:
             api.close()
 
-    def _getdata_search_string_list(self, offset):
-        # WARNING: this lookup is costly, please avoid
-        # cost is O(k), where k is # of chunks
-        # if you use this a lot, you'll get O(N^2) reads
-        delta = offset
-        chunk_key = None
-        for chunk_offset in self.datamap.keys():
-            if offset > chunk_offset:
-                diff = offset - chunk_offset
-                if diff <= delta:
-                    delta = diff
-                    chunk_key = chunk_offset
-        return chunk_key, delta
-
     def init_new_load(self, stage):
         self.meta = None
-        self.data = []
+        self.data.close()
+        self.data = ChunkStore()
         self.datalen = 0
-        self.datamap = {}
         self.stage = stage
         self.complete = False
 
-    def refresh(self, when):
+    def refresh(self, entry):
         params = copy.copy(self.params)
-        params['If-Modified-Since'] = when.get_str()
+        if entry.lastmod:
+            params['If-Modified-Since'] = entry.lastmod.get_str()
+        if entry.etag:
+            params['If-None-Match'] = entry.etag
         self.api = protocols.protocol_access(self.url,
                                              self.mode, params,
                                              data=self.postdata)
@@ -238,6 +347,7 @@ class SharedItem:
         if self.meta[0] == 304:
             # we win! it hasn't been modified
             # but we probably need to delete the api object
+            self.cache.revalidated(self.key, self.meta[2])
             self.api.close()
             self.api = self.cache_api
             self.meta = self.api.getmeta()
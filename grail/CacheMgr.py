@@ -5,6 +5,13 @@ import time
 from . import ht_time
 from . import grailutil
 import re
+import hashlib
+import sqlite3
+import tempfile
+import heapq
+import itertools
+from collections import OrderedDict
+from functools import cached_property
 from numbers import Real
 
 META, DATA, DONE = 'META', 'DATA', 'DONE'  # Three stages
@@ -34,7 +41,14 @@ def parse_cache_control(s):
     elts = s.split(',')
     for s in elts:
         a, _, b = s.partition('=')
-        yield (a, b)
+        yield (a.strip().lower(), b.strip().strip('"'))
+
+
+# Heuristic freshness for entries without an explicit lifetime: a page
+# stays fresh for this fraction of the time between its last
+# modification and when it was loaded, up to HEURISTIC_MAX seconds
+HEURISTIC_FRACTION = 0.1
+HEURISTIC_MAX = 24 * 3600
 
 
 class CacheManager:
@@ -59,11 +73,29 @@ class CacheManager:
     count; when that cound reaches zero, it removes itself from the
     list.
 
+    single flight: through the active list, all GET requests for a key
+    share one network request, whether they are plain loads or
+    If-Modified-Since revalidations of a cached copy.  A successfully
+    loaded item stays active until its last reader is done with it, so
+    a request arriving just after the load finished shares its data
+    too (unless it asks for a reload).  fetches counts the items
+    started by open() that go to the network; collapsed counts the
+    requests that were served by an item that was already active.
+
     freshness: CM is partly responsible for checking the freshness of
-    pages. (pages with explicit TTL know when they expire.) freshness
-    tests are preference driven, can be never, per session, or per
-    time-unit. on each open, check to see if we should send an
-    If-Mod-Since to the original server (based on fresh_p method).
+    pages. on each open, check to see if we should revalidate the
+    page with the original server (based on fresh_p method), sending
+    If-Modified-Since and If-None-Match.  a page with an explicit
+    lifetime (Cache-Control max-age, or Expires) is fresh for exactly
+    that long.  otherwise a page is fresh if it was modified long
+    enough before it was loaded (heuristic freshness), or if the
+    preference driven test says so: never, per session, or per
+    time-unit.  must-revalidate turns off the preference driven test.
+
+    the disk cache is opened, and its index read, on first use: when a
+    URL of one of the cache_protocols is opened, or a spool file or
+    the disk attribute is wanted.  until then, other URLs don't wait
+    for it.
 
     """
 
@@ -76,10 +108,8 @@ class CacheManager:
         self.caches = []
         self.items = {}
         self.active = {}
-        self.disk = None
-        self.disk = DiskCache(self, self.app.prefs.GetInt('disk-cache',
-                                                          'size') * 1024,
-                              self.app.prefs.Get('disk-cache', 'directory'))
+        self.fetches = 0
+        self.collapsed = 0
         self.set_freshness_test()
         self.app.prefs.AddGroupCallback('disk-cache', self.update_prefs)
 
@@ -89,12 +119,26 @@ class CacheManager:
             self.app.register_on_exit(
                 lambda save=self.save_cache_state: save())
 
+    @cached_property
+    def disk(self):
+        disk = DiskCache(self, self.app.prefs.GetInt('disk-cache',
+                                                     'size') * 1024,
+                         self.app.prefs.Get('disk-cache', 'directory'))
+        # No load of this session has a spool file yet
+        disk.erase_spool_files()
+        return disk
+
+    def open_disk(self):
+        """Open the disk cache, unless that has been done already."""
+        return self.disk
+
     def save_cache_state(self):
         for cache in self.caches:
             cache._checkpoint_metadata()
 
     def update_prefs(self):
         self.set_freshness_test()
+        self.open_disk()
         size = self.caches[0].max_size = self.app.prefs.GetInt('disk-cache',
                                                                'size') \
             * 1024
@@ -131,16 +175,28 @@ class CacheManager:
             3600.0)
 
         if fresh_type == 'per session':
-            self.fresh_p = lambda key, self=self: \
-                self.fresh_every_session(self.items[key])
-            self.session_freshen = []
+            self.fresh_test = self.fresh_every_session
+            self.session_freshen = set()
         elif fresh_type == 'periodic':
-            self.fresh_p = lambda key, self=self, t=fresh_rate: \
-                self.fresh_periodic(self.items[key], t)
+            self.fresh_test = lambda entry, self=self, t=fresh_rate: \
+                self.fresh_periodic(entry, t)
         elif fresh_type == 'never':
-            self.fresh_p = lambda x: True
+            self.fresh_test = lambda entry: True
         else:  # == 'always'
-            self.fresh_p = lambda x: False
+            self.fresh_test = lambda entry: False
+
+    def fresh_p(self, key):
+        """Return True if the cached page for key needn't be revalidated."""
+        entry = self.items[key]
+        now = time.time()
+        fresh = entry.explicitly_fresh(now)
+        if fresh is not None:
+            return fresh
+        if entry.heuristically_fresh(now):
+            return True
+        if entry.must_revalidate:
+            return False
+        return self.fresh_test(entry)
 
     def open(self, url, mode, params, reload=False, data=None):
         """Opens a URL and returns a protocol API for it.
@@ -152,12 +208,15 @@ class CacheManager:
         """
 
         key = self.url2key(url, mode, params)
+        if key[:key.find(':')] in self.cache_protocols:
+            self.open_disk()
         if mode == 'GET':
-            if key in self.active:
-                # XXX This appeared to be a bad idea!
-                # if reload:
-                # self.active[key].reset()
-                return SharedAPI(self.active[key])
+            item = self.active.get(key)
+            if item and not (reload and item.stage == DONE):
+                # Join the request in flight.  A reload doesn't restart
+                # it, but won't get an item that was loaded before.
+                self.collapsed = self.collapsed + 1
+                return SharedAPI(item)
             return self.open_get(key, url, mode, params, reload, data)
         elif mode == 'POST':
             return self.open_post(key, url, mode, params, reload, data)
@@ -190,10 +249,12 @@ class CacheManager:
                 if reload:
                     item = SharedItem(url, mode, params, self, key, data,
                                       api, reload=reload)
+                    self.fetches = self.fetches + 1
                     self.touch(key)
                 elif not self.fresh_p(key):
                     item = SharedItem(url, mode, params, self, key, data,
-                                      api, refresh=self.items[key].lastmod)
+                                      api, refresh=self.items[key])
+                    self.fetches = self.fetches + 1
                     self.touch(key, refresh=True)
                 else:
                     item = SharedItem(url, mode, params, self, key, data,
@@ -204,14 +265,14 @@ class CacheManager:
         else:
             # cause item to be loaded (and perhaps cached)
             item = SharedItem(url, mode, params, self, key, data)
+            self.fetches = self.fetches + 1
 
         return self.activate(item)
 
     def open_post(self, key, url, mode, params, reload, data):
-        """Open a URL with a POST request. Do not cache."""
+        """Open a URL with a POST request. Do not cache or share."""
         key = self.url2key(url, mode, params)
-        return self.activate(SharedItem(url, mode, params, None, key,
-                                        data))
+        return SharedAPI(SharedItem(url, mode, params, None, key, data))
 
     def activate(self, item):
         """Adds a SharedItem to the shared object list and returns SharedAPI.
@@ -219,9 +280,14 @@ class CacheManager:
         self.active[item.key] = item
         return SharedAPI(self.active[item.key])
 
-    def deactivate(self, key):
-        """Removes a SharedItem from the shared object list."""
-        self.active.pop(key, None)
+    def deactivate(self, key, item=None):
+        """Removes a SharedItem from the shared object list.
+
+        If item is given, the key is only removed if it still refers to
+        that item, and not to one that replaced it.
+        """
+        if item is None or self.active.get(key) is item:
+            self.active.pop(key, None)
 
     def add_cache(self, cache):
         """Called by cache to notify manager this it is ready."""
@@ -230,6 +296,17 @@ class CacheManager:
     def close_cache(self, cache):
         self.caches.remove(cache)
 
+    def spool_file(self):
+        """Return (file, path) of a new file in the disk cache, or None.
+
+        Used by SharedItem for data too large to keep in memory; see
+        DiskCache.make_file().
+        """
+        self.open_disk()
+        if self.caches:
+            return self.caches[0].spool_file()
+        return None
+
     def cache_read(self, key):
         """Checks cache for URL. Returns protocol API on hit.
 
@@ -242,6 +319,11 @@ class CacheManager:
         else:
             return None
 
+    def revalidated(self, key, headers):
+        """Update a cache entry from a 304 (Not Modified) response."""
+        if key in self.items:
+            self.items[key].revalidated(headers)
+
     def touch(self, key=None, url=None, refresh=False):
         """Calls touch() method of CacheEntry object."""
         if url:
@@ -325,20 +407,19 @@ class CacheManager:
         if expires == 0:
             return False
 
-        # respond to http/1.1 cache control directives
+        # respond to http/1.1 cache control directives; no-cache pages
+        # are kept, but fresh_p() revalidates them on every use
         if 'cache-control' in params:
             for k, v in parse_cache_control(params['cache-control']):
-                if k in ('no-cache', 'no-store'):
+                if k == 'no-store':
                     return False
-                if k == 'max-age':
-                    expires = int(v)
 
         return True
 
     def fresh_every_session(self, entry):
         """Refresh the page once per session"""
         if entry.key not in self.session_freshen:
-            self.session_freshen.append(entry.key)
+            self.session_freshen.add(entry.key)
             return False
         return True
 
@@ -388,13 +469,20 @@ class DiskCacheEntry:
     The data members include:
     date -- the date of the most recent HTTP request to the server
     (either a regular load or an If-Modified-Since request)
+    etag -- the entity tag, sent back in If-None-Match
+    cache_control -- the Cache-Control header, from which max_age,
+    s_maxage, no_store, no_cache and must_revalidate are set
     """
 
+    etag = None
+    cache_control = None
+
     def __init__(self, cache=None):
         self.cache = cache
+        self.set_cache_control(None)
 
     def fill(self, key, url, size, date, lastmod, expires, ctype,
-             cencoding, ctencoding):
+             cencoding, ctencoding, etag=None, cache_control=None):
         self.key = key
         self.url = url
         self.size = size
@@ -413,6 +501,66 @@ class DiskCacheEntry:
         self.type = ctype
         self.encoding = cencoding
         self.transfer_encoding = ctencoding
+        self.etag = etag
+        self.set_cache_control(cache_control)
+
+    def set_cache_control(self, value):
+        self.cache_control = value or None
+        self.max_age = self.s_maxage = None
+        self.no_store = self.no_cache = self.must_revalidate = False
+        if not value:
+            return
+        for k, v in parse_cache_control(value):
+            if k in ('max-age', 's-maxage'):
+                try:
+                    v = int(v)
+                except ValueError:
+                    v = 0      # invalid means stale
+                if k == 'max-age':
+                    self.max_age = v
+                else:
+                    self.s_maxage = v
+            elif k == 'no-store':
+                self.no_store = True
+            elif k == 'no-cache':
+                self.no_cache = True
+            elif k in ('must-revalidate', 'proxy-revalidate'):
+                self.must_revalidate = True
+
+    def explicitly_fresh(self, now):
+        """Return whether the entry is fresh by its explicit lifetime.
+
+        Returns None if the server gave no lifetime.  s-maxage only
+        applies to shared caches, which we are not.
+        """
+        if self.no_cache:
+            return False
+        if self.max_age is not None:
+            if not self.date:
+                return False
+            return now - self.date.get_secs() < self.max_age
+        if self.expires:
+            return self.expires.get_secs() > now
+        return None
+
+    def heuristically_fresh(self, now):
+        """Return True if the entry is fresh by the heuristic."""
+        if not (self.date and self.lastmod):
+            return False
+        loaded = self.date.get_secs()
+        lifetime = (loaded - self.lastmod.get_secs()) * HEURISTIC_FRACTION
+        return now - loaded < min(lifetime, HEURISTIC_MAX)
+
+    def revalidated(self, headers):
+        """Take new validators and lifetime from a 304 response."""
+        if 'etag' in headers:
+            self.etag = headers['etag']
+        if 'cache-control' in headers:
+            self.set_cache_control(headers['cache-control'])
+        if 'expires' in headers:
+            self.expires = HTTime(headers['expires'])
+            self.cache.add_expireable(self)
+        self.cache.log_entry(self)
 
     string_date = re.compile('^[A-Za-z]')
 
@@ -447,6 +595,8 @@ class DiskCacheEntry:
         self.date = None
         self.lastmod = None
         self.expires = None
+        self.etag = None
+        self.set_cache_control(None)
         for tup in [(vars[4], 'date'), (vars[5], 'lastmod'),
                     (vars[6], 'expires')]:
             self.parse_assign(tup[0], tup[1])
@@ -472,16 +622,36 @@ class DiskCacheEntry:
         s = '\t'.join(map(str, stuff))
         return s
 
+    def parse_row(self, row):
+        """Read a row of the cache index."""
+        (self.key, self.url, self.file, self.size, date, lastmod, expires,
+         self.type, self.encoding, self.transfer_encoding, self.etag,
+         cache_control) = row
+        for rep, var in ((date, 'date'), (lastmod, 'lastmod'),
+                         (expires, 'expires')):
+            self.parse_assign(rep, var)
+        self.set_cache_control(cache_control)
+
+    def unparse_row(self):
+        """Return a row for the cache index."""
+        if not hasattr(self, 'file'):
+            self.file = ''
+        return (self.key, self.url, self.file, self.size, str(self.date),
+                str(self.lastmod), str(self.expires), self.type,
+                self.encoding, self.transfer_encoding, self.etag,
+                self.cache_control)
+
     def get(self):
         """Create a disk_cache_access API object and return it.
 
         Calls cache.get() to update the LRU information.
 
         Also checks to see if a page with an explicit Expire date has
-        expired; raises a CacheReadFailed if it has.
+        expired; raises a CacheReadFailed if it has and there is no
+        validator to revalidate it with.
         """
-        if self.expires:
-            if self.expires and self.expires.get_secs() < time.time():
+        if self.expires and not (self.etag or self.lastmod):
+            if self.expires.get_secs() < time.time():
                 # we need to refresh the page; can we just reload?
                 raise CacheReadFailed(self.cache)
         self.cache.get(self.key)
@@ -503,27 +673,38 @@ class DiskCacheEntry:
         pass
 
 
-def expire_key(item):
-    """used with list.sort() to sort list of CacheEntries by expiry date."""
-    return item.expires.get_secs()
-
-
 class DiskCache:
     """Persistent object cache.
 
     need to discuss:
 
-    use_order
+    use_order: an OrderedDict of keys (values unused) from least to most
+    recently used, so that a hit or an eviction costs O(1).
 
-    the log: writes every change to cache or use_order, writes
-    flushed, do a checkpoint run on startup, format is tuple (entry
-    type, object), where entry type is add, evict, update use_order,
-    version.
+    the index: an SQLite database (file INDEX, in WAL mode) with a row
+    per entry, including a use sequence number that gives the LRU order.
+    Adds and evictions are committed as they happen; use_order updates
+    are batched (USE_BATCH at a time, and at checkpoint).  Startup reads
+    the rows in use order, so it costs O(entries) however long the
+    cache has been in use.  A LOG file left by an older Grail (a text
+    transaction log, versions 1.2 and 1.3) is replayed once and
+    converted into an index.
 
-    expires
+    expires: a heap of (expiry time, sequence, entry) for the entries
+    with an explicit expiry date.  Entries are not removed from the
+    heap when they are evicted or given a new expiry date; heap entries
+    for a page no longer cached, or for an expiry time it no longer
+    has, are skipped when they reach the top.
 
     evict
 
+    the files: each entry's data is in a file named after a hash of
+    its key, in a two-level fan-out of subdirectories (ab/cd/spamabcd...),
+    so no directory gets very large.  Files of the older flat layout
+    are moved into place when the cache is opened.  Data of loads in
+    progress is spooled to files in the spool subdirectory, which the
+    erase methods leave alone.
+
     Note: Nowhere do we verify that the disk has enough space for a
     full cache.
 
@@ -541,30 +722,107 @@ class DiskCache:
         self.manager = manager
         self.manager.add_cache(self)
         self.items = {}
-        self.use_order = []
-        self.log = None
+        self.use_order = OrderedDict()
+        self.index = None
+        self.pending_uses = {}
         self.expires = []
+        self.expires_seq = itertools.count()
         self.types = {}
 
         grailutil.establish_dir(self.directory)
         self._read_metadata()
-        self._reinit_log()
+        self._convert_flat_layout()
 
     log_version = "1.3"
     log_ok_versions = ["1.2", "1.3"]
 
+    # Version of the index schema, kept in PRAGMA user_version
+    index_version = 2
+    index_files = ('INDEX', 'INDEX-wal', 'INDEX-shm')
+
+    insert_entry = ('INSERT OR REPLACE INTO entries '
+                    '(key, url, file, size, date, lastmod, expires, type, '
+                    'encoding, transfer_encoding, etag, cache_control, used) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)')
+
+    # Number of use_order updates collected before they are written
+    USE_BATCH = 64
+
     def close(self, log):
         self.manager.delete(self.items.keys(), evict=False)
         if log:
-            self.use_order = []
-            self._checkpoint_metadata()
+            self.use_order.clear()
+            self.pending_uses.clear()
+            with self.index:
+                self.index.execute('DELETE FROM entries')
+        self._checkpoint_metadata()
+        self.index.close()
         del self.items
         del self.expires
         self.manager.close_cache(self)
         self.dead = True
 
     def _read_metadata(self):
-        """Read the transaction log from the cache directory.
+        """Open the cache index and load the cache's contents from it.
+
+        Entries are read in use order, which also sets up use_order.
+        If there is no index yet but there is a transaction log from
+        an older version, the log is converted.
+        """
+        indexpath = os.path.join(self.directory, 'INDEX')
+        logpath = os.path.join(self.directory, 'LOG')
+        migrate = not os.path.exists(indexpath) \
+            and os.path.exists(logpath)
+        self.index = sqlite3.connect(indexpath)
+        self.index.execute('PRAGMA journal_mode=WAL')
+        self.index.execute('PRAGMA synchronous=NORMAL')
+        (version,) = self.index.execute('PRAGMA user_version').fetchone()
+        if version == 1:
+            # version 2 added the validator and lifetime columns
+            self.index.executescript("""
+                ALTER TABLE entries ADD COLUMN etag TEXT;
+                ALTER TABLE entries ADD COLUMN cache_control TEXT;
+                PRAGMA user_version = 2;
+                """)
+        elif version != self.index_version:
+            # new index, or one we don't understand
+            self.index.executescript("""
+                DROP TABLE IF EXISTS entries;
+                CREATE TABLE entries (
+                    key TEXT PRIMARY KEY, url TEXT, file TEXT,
+                    size INTEGER, date TEXT, lastmod TEXT, expires TEXT,
+                    type TEXT, encoding TEXT, transfer_encoding TEXT,
+                    used INTEGER, etag TEXT, cache_control TEXT);
+                CREATE INDEX entries_used ON entries (used);
+                PRAGMA user_version = {};
+                """.format(self.index_version))
+        if migrate:
+            self._read_log(logpath)
+            with self.index:
+                self.index.executemany(
+                    self.insert_entry,
+                    (self.items[key].unparse_row() + (used,)
+                     for used, key in enumerate(self.use_order)))
+            os.unlink(logpath)
+        else:
+            for row in self.index.execute(
+                    'SELECT key, url, file, size, date, lastmod, expires, '
+                    'type, encoding, transfer_encoding, etag, cache_control '
+                    'FROM entries ORDER BY used'):
+                newentry = DiskCacheEntry(self)
+                newentry.parse_row(row)
+                self.items[newentry.key] = newentry
+                self.manager.items[newentry.key] = newentry
+                self.use_order[newentry.key] = None
+                self.size = self.size + newentry.size
+                if newentry.expires:
+                    self.add_expireable(newentry)
+        (used,) = self.index.execute(
+            'SELECT MAX(used) FROM entries').fetchone()
+        self.use_counter = itertools.count((used or 0) + 1)
+
+    def _read_log(self, logpath):
+        """Read a transaction log from an older version of Grail.
 
         Reads the pickled log entries and re-creates the cache's
         current contents and use_order from the log.
@@ -573,108 +831,124 @@ class DiskCache:
         that the version number read is the same as the current
         version number.
         """
-        logpath = os.path.join(self.directory, 'LOG')
-        try:
-            log = open(logpath)
-        except IOError:
-            # now what happens if there is an error here?
-            log = open(logpath, 'w')
-            log.close()
-            return
-
-        with log:
+        with open(logpath) as log:
             for line in log:
                 try:
                     kind = line[0:1]
                     if kind == '2':  # use update
                         key = line[2:-1]
-                        self.use_order.remove(key)
-                        self.use_order.append(key)
+                        self.use_order.move_to_end(key)
                     elif kind == '1':           # delete
                         key = line[2:-1]
                         if key in self.items:
                             self.size = self.size - self.items.pop(key).size
                             del self.manager.items[key]
-                            self.use_order.remove(key)
-                            assert key not in self.use_order
+                            del self.use_order[key]
                     elif kind == '0':  # add
                         newentry = DiskCacheEntry(self)
                         newentry.parse(line[2:-1])
                         if newentry.key not in self.items:
-                            self.use_order.append(newentry.key)
+                            self.use_order[newentry.key] = None
                         newentry.cache = self
                         self.items[newentry.key] = newentry
                         self.manager.items[newentry.key] = newentry
                         self.size = self.size + newentry.size
+                        if newentry.expires:
+                            self.add_expireable(newentry)
                     elif kind == '3':  # version (hopefully first)
                         ver = line[2:-1]
                         if ver not in self.log_ok_versions:
                            # clear out anything we might have read
                            # and bail. this is an old log file.
                             if len(self.use_order) > 0:
-                                self.use_order = []
+                                self.use_order.clear()
+                                self.expires = []
                                 for key in self.items.keys():
                                     del self.manager.items[key]
                                 self.items.clear()
                                 self.size = 0
                                 return
                         assert ver in self.log_ok_versions
-                except IndexError:
+                except (IndexError, KeyError):
                     # ignore this line
                     pass
 
     def _checkpoint_metadata(self):
-        """Checkpoint the transaction log.
+        """Checkpoint the cache index.
 
-        Creates a new log that contains only the current state of the
-        cache.
+        Writes pending use_order updates and folds the write-ahead log
+        into the index file.
         """
         import traceback
-        if self.log:
-            self.log.close()
         try:
-            newpath = os.path.join(self.directory, 'CHECKPOINT')
-
-            with open(newpath, 'w') as newlog:
-                newlog.write('3 ' + self.log_version + '\n')
-                for key in self.use_order:
-                    self.log_entry(self.items[key], alt_log=newlog,
-                                   flush=False)
-                    # don't flush writes during the checkpoint, because if
-                    # we crash it won't matter
-            logpath = os.path.join(self.directory, 'LOG')
-            os.unlink(logpath)
-            os.rename(newpath, logpath)
-        except:
+            self.flush_use_order()
+            self.index.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        except sqlite3.Error:
             print("exception during checkpoint")
             traceback.print_exc()
 
-    def _reinit_log(self):
-        """Open the log for writing new transactions."""
-        logpath = os.path.join(self.directory, 'LOG')
-        self.log = open(logpath, 'a')
-
-    def log_entry(self, entry, delete=False, alt_log=None, flush=True):
-        """Write to the log adds and evictions."""
-        if alt_log:
-            dest = alt_log
-        else:
-            dest = self.log
-        if delete:
-            dest.write('1 ' + entry.key + '\n')
-        else:
-            dest.write('0 ' + entry.unparse() + '\n')
-        if flush:
-            dest.flush()
+    def log_entry(self, entry, delete=False):
+        """Write adds and evictions to the index."""
+        self.pending_uses.pop(entry.key, None)
+        with self.index:
+            if delete:
+                self.index.execute('DELETE FROM entries WHERE key = ?',
+                                   (entry.key,))
+            else:
+                self.index.execute(
+                    self.insert_entry,
+                    entry.unparse_row() + (next(self.use_counter),))
 
     def log_use_order(self, key):
-        """Write to the log changes in use_order."""
+        """Record a change in use_order, to be written in a batch."""
         if key in self.items:
-            self.log.write('2 ' + key + '\n')
-            # should we flush() here? probably...
-            self.log.flush()
-
-    cache_file = re.compile(r'^spam[0-9]+')
+            self.pending_uses[key] = next(self.use_counter)
+            if len(self.pending_uses) >= self.USE_BATCH:
+                self.flush_use_order()
+
+    def flush_use_order(self):
+        """Write the pending use_order changes to the index."""
+        if self.pending_uses:
+            with self.index:
+                self.index.executemany(
+                    'UPDATE entries SET used = ? WHERE key = ?',
+                    ((used, key) for key, used in self.pending_uses.items()))
+            self.pending_uses.clear()
+
+    def _convert_flat_layout(self):
+        """Move files of the old flat layout to their hashed location."""
+        moved = []
+        for entry in self.items.values():
+            if os.path.dirname(entry.file):
+                continue
+            newfile = self.get_file_name(entry)
+            newpath = self.get_file_path(newfile)
+            try:
+                grailutil.establish_dir(os.path.dirname(newpath))
+                os.replace(self.get_file_path(entry.file), newpath)
+            except OSError:
+                # missing file; entry.get() will find out
+                continue
+            entry.file = newfile
+            moved.append((newfile, entry.key))
+        if moved:
+            with self.index:
+                self.index.executemany(
+                    'UPDATE entries SET file = ? WHERE key = ?', moved)
+
+    cache_file = re.compile(r'^spam([0-9a-f]+|.*\.tmp$)')
+    spool_dir = 'spool'
+
+    def walk(self):
+        """Yield (directory, files) for the cache, like os.walk().
+
+        The spool directory is left out; its files belong to loads in
+        progress, and are renamed into the cache when they are done.
+        """
+        for dir, subdirs, files in os.walk(self.directory):
+            if dir == self.directory and self.spool_dir in subdirs:
+                subdirs.remove(self.spool_dir)
+            yield dir, files
 
     def erase_cache(self):
 
@@ -683,7 +957,7 @@ class DiskCache:
             self.manager.disk.erase_cache()
             return
 
-        for dir, _, files in os.walk(self.directory):
+        for dir, files in self.walk():
             for file in files:
                 if self.cache_file.match(file):
                     path = os.path.join(dir, file)
@@ -698,20 +972,21 @@ class DiskCache:
             self.manager.disk.erase_unlogged_files()
             return
 
-        known = {'LOG'}
+        known = set(self.index_files)
         known.update(entry.file for entry in self.items.values())
 
-        for dir, _, files in os.walk(self.directory):
+        for dir, files in self.walk():
+            reldir = os.path.relpath(dir, self.directory)
             for file in files:
-                if file not in known and self.cache_file.match(file):
+                if os.path.normpath(os.path.join(reldir, file)) not in known \
+                   and self.cache_file.match(file):
                     path = os.path.join(dir, file)
                     os.unlink(path)
 
     def get(self, key):
         """Update and log use_order."""
         assert key in self.items
-        self.use_order.remove(key)
-        self.use_order.append(key)
+        self.use_order.move_to_end(key)
         self.log_use_order(key)
 
     def update(self, object):
@@ -734,10 +1009,11 @@ class DiskCache:
         self.make_space(size)
 
         newitem = DiskCacheEntry(self)
-        (date, lastmod, expires, ctype, cencoding, ctencoding) \
-            = self.read_headers(headers)
+        (date, lastmod, expires, ctype, cencoding, ctencoding, etag,
+         cache_control) = self.read_headers(headers)
         newitem.fill(object.key, object.url, size, date, lastmod,
-                     expires, ctype, cencoding, ctencoding)
+                     expires, ctype, cencoding, ctencoding, etag,
+                     cache_control)
         newitem.file = self.get_file_name(newitem)
         if expires:
             self.add_expireable(newitem)
@@ -747,7 +1023,7 @@ class DiskCache:
 
         self.items[object.key] = newitem
         self.manager.items[object.key] = newitem
-        self.use_order.append(object.key)
+        self.use_order[object.key] = None
 
         return newitem
 
@@ -768,16 +1044,40 @@ class DiskCache:
 
         ctencoding = headers.get('content-transfer-encoding')
 
-        return (date, lastmod, expires, ctype, cencoding, ctencoding)
+        etag = headers.get('etag')
+
+        cache_control = headers.get('cache-control')
+
+        return (date, lastmod, expires, ctype, cencoding, ctencoding, etag,
+                cache_control)
 
     def add_expireable(self, entry):
-        """Adds entry to list of pages with explicit expire date."""
-        self.expires.append(entry)
+        """Adds entry to the heap of pages with explicit expire date."""
+        heapq.heappush(self.expires, (entry.expires.get_secs(),
+                                      next(self.expires_seq), entry))
+        if len(self.expires) > 2 * len(self.items) + 16:
+            # Drop the heap entries gone stale in the meantime
+            self.expires = [item for item in self.expires
+                            if self.expireable_current(item)]
+            heapq.heapify(self.expires)
+
+    # Internal -- tell whether an item of the expires heap still holds
+    # a cached entry's expiry time.
+    def expireable_current(self, item):
+        secs, seq, entry = item
+        return (self.items.get(entry.key) is entry
+                and entry.expires is not None
+                and entry.expires.get_secs() == secs)
 
     def get_file_name(self, entry):
-        """Invent a filename for a new cache entry."""
-        filename = 'spam' + str(time.time()) + self.get_suffix(entry.type)
-        return filename
+        """Return the filename, relative to the cache, for an entry.
+
+        The name is derived from the entry's key, so it doesn't depend
+        on when the entry was made.
+        """
+        digest = hashlib.sha1(entry.key.encode('utf-8')).hexdigest()
+        return os.path.join(digest[:2], digest[2:4],
+                            'spam' + digest + self.get_suffix(entry.type))
 
     def get_file_path(self, filename):
         path = os.path.join(self.directory, filename)
@@ -789,12 +1089,43 @@ class DiskCache:
         else:
             return guess_extension(type) or ''
 
+    def spool_file(self):
+        """Return (file, path) of a new file for SharedItem data."""
+        spooldir = os.path.join(self.directory, self.spool_dir)
+        try:
+            grailutil.establish_dir(spooldir)
+            fd, path = tempfile.mkstemp(prefix='spam', suffix='.tmp',
+                                        dir=spooldir)
+        except OSError:
+            return None
+        return os.fdopen(fd, 'w+b'), path
+
+    def erase_spool_files(self):
+        """Remove the spool files left by an earlier session."""
+        spooldir = os.path.join(self.directory, self.spool_dir)
+        try:
+            files = os.listdir(spooldir)
+        except OSError:
+            return
+        for file in files:
+            if self.cache_file.match(file):
+                try:
+                    os.unlink(os.path.join(spooldir, file))
+                except OSError:
+                    pass
+
     def make_file(self, entry, object):
-        """Write the object's data to disk."""
+        """Write the object's data to disk.
+
+        The data is written to a temporary file that is then renamed, or
+        if it has already been spooled to a file in the cache directory,
+        that file is just renamed.  Either way, a reader of an earlier
+        version of the same entry keeps its data.
+        """
         path = self.get_file_path(entry.file)
         try:
-            with open(path, 'wb') as f:
-                f.writelines(object.data)
+            grailutil.establish_dir(os.path.dirname(path))
+            object.data.save(path)
         except IOError as err:
             raise CacheFileError(path) from err
 
@@ -828,32 +1159,24 @@ class DiskCache:
         """Evict the least recently used page."""
         # get ride of least-recently used thing
         if len(self.items) > 0:
-            key = self.use_order[0]
+            key = next(iter(self.use_order))
             self.evict(key)
         else:
             raise CacheEmpty
 
     def evict_expired_pages(self):
-        """Evict any pages on the expires list that have expired."""
-        self.expires.sort(key=expire_key)
-        size = len(self.expires)
-        if size > 0 \
-           and self.expires[0].expires.get_secs() < time.time():
-            index = 0
-            t = time.time()
-            while index < size and self.expires[index].expires.get_secs() < t:
-                index = index + 1
-            for item in self.expires[0:index]:
-                self.evict(item.key)
-            del self.expires[0:index]
+        """Evict any pages on the expires heap that have expired."""
+        t = time.time()
+        while self.expires and self.expires[0][0] < t:
+            item = heapq.heappop(self.expires)
+            if self.expireable_current(item):
+                self.evict(item[2].key)
 
     def evict(self, key):
         """Remove an entry from the cache and delete the file from disk."""
-        self.use_order.remove(key)
+        del self.use_order[key]
         evictee = self.items.pop(key)
         del self.manager.items[key]
-        if key in self.expires:
-            self.expires.remove(key)
         try:
             os.unlink(self.get_file_path(evictee.file))
         except EnvironmentError as err:
@@ -968,3 +1291,57 @@ class HTTime:
             return self.str
         else:
             return str(None)
+
+
+def benchmark(sizes=(1000, 10000, 100000, 1000000), ops=10000):
+    """Time cache hits and LRU evictions against the number of entries.
+
+    Run with "python -m grail.CacheMgr".  The per-operation cost should
+    stay flat as the number of entries grows.
+    """
+    import random
+    import tempfile
+
+    class Manager:
+        # Just enough of a CacheManager for a DiskCache on its own
+        def __init__(self):
+            self.items = {}
+
+        def add_cache(self, cache):
+            pass
+
+        def close_cache(self, cache):
+            pass
+
+        def delete(self, keys, evict=True):
+            pass
+
+    print("{:>9} {:>12} {:>12}".format("entries", "hit (us)", "evict (us)"))
+    for n in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            cache = DiskCache(Manager(), 0, directory)
+            for i in range(n):
+                entry = DiskCacheEntry(cache)
+                key = "http://host/{}".format(i)
+                entry.fill(key, key, 1, None, None, None, 'text/html',
+                           None, None)
+                entry.file = key
+                cache.items[key] = entry
+                cache.manager.items[key] = entry
+                cache.use_order[key] = None
+                cache.size = cache.size + 1
+            keys = random.sample(list(cache.items), min(ops, n))
+            t0 = time.perf_counter()
+            for key in keys:
+                cache.get(key)
+            t1 = time.perf_counter()
+            for key in keys:
+                cache.evict_any_page()
+            t2 = time.perf_counter()
+            cache.close(False)
+            print("{:9d} {:12.2f} {:12.2f}".format(
+                n, (t1 - t0) * 1e6 / len(keys), (t2 - t1) * 1e6 / len(keys)))
+
+
+if __name__ == '__main__':
+    benchmark()
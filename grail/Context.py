@@ -109,9 +109,8 @@ class Context(URIContext):
 
         """
         if url and histify:
-            # don't lose title if we have one:
-            title, when = self.app.global_history.lookup_url(url)
-            self.app.global_history.remember_url(url, title or '')
+            # without a title, remember_url() keeps any it has
+            self.app.global_history.remember_url(url)
             if not self.page:
                 self.page = History.PageInfo(url)
                 self.history.append_page(self.page)
@@ -8,19 +8,16 @@ import posixpath
 
 from tkinter import *
 from io import RawIOBase
+from functools import cached_property
 
 from . import filetypes
 from . import tktools
 from . import grailutil
 from . import BaseApplication
 from . import Stylesheet
-from . import GlobalHistory
 
 from .grailbase import utils
 from .grailbase import GrailPrefs
-from .CacheMgr import CacheManager
-from .ImageCache import ImageCache
-from .Authenticate import AuthenticationManager
 utils._grail_root = grail_root
 
 # Milliseconds between interrupt checks
@@ -201,7 +198,14 @@ class SocketQueue:
 
 class Application(BaseApplication.BaseApplication):
 
-    """The application class represents a group of browser windows."""
+    """The application class represents a group of browser windows.
+
+    The subsystems that read files when they start -- the global
+    history, the URL cache, the cookie database -- and the image
+    cache and authentication manager are made, and their modules
+    imported, when first used rather than before the first window
+    appears.  So are the Greek dingbats.
+    """
 
     def __init__(self, prefs=None, display=None):
         self.root = Tk(className='Grail', screenName=display)
@@ -227,11 +231,8 @@ class Application(BaseApplication.BaseApplication):
 
         # initialize on_exit_methods before global_history
         self.on_exit_methods = []
-        self.global_history = GlobalHistory.GlobalHistory(self)
         self.login_cache = {}
-        self.url_cache = CacheManager(self)
-        self.image_cache = ImageCache(self.url_cache)
-        self.auth = AuthenticationManager(self)
+        self.register_on_exit(self.save_cookies)
         self.root.report_callback_exception = self.report_callback_exception
         if sys.stdin.isatty():
             # only useful if stdin might generate KeyboardInterrupt
@@ -239,15 +240,57 @@ class Application(BaseApplication.BaseApplication):
         self.browsers = []
         self.iostatuspanel = None
         self.in_exception_dialog = False
-        from . import Greek
-        for k, v in Greek.entitydefs.items():
-            Application.dingbatimages[k] = (v, '_sym')
         self.root.bind_class("Text", "<Alt-Left>", self.dummy_event)
         self.root.bind_class("Text", "<Alt-Right>", self.dummy_event)
 
     def dummy_event(self, event):
         pass
 
+    # Subsystems made on first use
+
+    @cached_property
+    def global_history(self):
+        from . import GlobalHistory
+        return GlobalHistory.GlobalHistory(self)
+
+    @cached_property
+    def url_cache(self):
+        from .CacheMgr import CacheManager
+        return CacheManager(self)
+
+    @cached_property
+    def image_cache(self):
+        from .ImageCache import ImageCache
+        return ImageCache(self.url_cache)
+
+    @cached_property
+    def auth(self):
+        from .Authenticate import AuthenticationManager
+        return AuthenticationManager(self)
+
+    @cached_property
+    def cookies(self):
+        return self.load_cookies()
+
+    def load_cookies(self):
+        from . import cookielib
+        cookies = cookielib.CookieDB()
+        filename = os.path.join(self.graildir, 'cookies')
+        cookies.set_filename(filename)
+        if os.path.exists(filename):
+            try:
+                cookies.load()
+            except (IOError, ValueError, cookielib.Error) as err:
+                sys.stderr.write('WARNING: ignoring rest of {}: {}\n'
+                                 .format(filename, err))
+                cookies.save()
+        return cookies
+
+    def save_cookies(self):
+        if 'cookies' in self.__dict__:
+            self.cookies.sync()
+            self.cookies.close()
+
     def register_on_exit(self, method):
         self.on_exit_methods.append(method)
 
@@ -387,13 +430,25 @@ class Application(BaseApplication.BaseApplication):
                      'ensp': (' ', None)
                      }
 
+    greek_loaded = False
+
+    def load_greek(self):
+        if not Application.greek_loaded:
+            from . import Greek
+            for k, v in Greek.entitydefs.items():
+                Application.dingbatimages[k] = (v, '_sym')
+            Application.greek_loaded = True
+
     def clear_dingbat(self, entname):
+        self.load_greek()
         self.dingbatimages.pop(entname, None)
 
     def set_dingbat(self, entname, entity):
+        self.load_greek()
         self.dingbatimages[entname] = entity
 
     def load_dingbat(self, entname):
+        self.load_greek()
         if entname in self.dingbatimages:
             return self.dingbatimages[entname]
         gifname = grailutil.which(entname + '.gif', self.iconpath)
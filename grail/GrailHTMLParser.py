@@ -341,8 +341,9 @@ class GrailHTMLParser(HTMLParser):
 
     # Duplicated from htmllib.py because we want to have the target attribute
     def start_a(self, attrs):
-        if self.get_object():           # expensive!
-            self.get_object().anchor(attrs)
+        object = self.get_object()
+        if object:
+            object.anchor(attrs)
             return
         name = title = ''
         #
@@ -701,6 +701,9 @@ class Reader(BaseReader):
 
     def handle_eof(self):
         if not self.save_file:
+            if profiling:
+                print("{}: {} Tcl calls".format(self.url,
+                                                self.viewer.tclcalls))
             if self.fragment:
                 self.viewer.scroll_to(self.fragment)
             elif self.scrollpos:
@@ -169,6 +169,8 @@ class Viewer(formatter.AbstractWriter):
         self.addtags = ()               # Additional tags (e.g. anchors)
         self.align = None               # Alignment setting
         self.pendingdata = ''           # Data 'on hold'
+        self.segments = []              # Data and tags for the next insert
+        self.tclcalls = 0               # Tcl calls made for this page
         self.targets = set()               # Mark names for anchors/footnotes
         self.new_tags()
 
@@ -408,6 +410,7 @@ class Viewer(formatter.AbstractWriter):
             w.destroy()
         if self.text:
             self.pendingdata = ''
+            self.segments = []
             self.unfreeze()
             self.text.delete('1.0', END)
             self.freeze()
@@ -459,22 +462,55 @@ class Viewer(formatter.AbstractWriter):
 
     def unfreeze(self):
         self.text['state'] = NORMAL
+        self.tclcalls = self.tclcalls + 1
 
     def freeze(self, update=False):
         if self.pendingdata and self.pendingdata.strip():
-            self.text.insert(END, self.pendingdata, self.flowingtags)
+            self.add_segment(self.pendingdata, self.flowingtags)
             self.pendingdata = ''
+        self.insert_segments()
         if self.smoothscroll:
             from .supertextbox import resize_super_text_box
             resize_super_text_box(frame=self.frame)
         self.text['state'] = DISABLED
+        self.tclcalls = self.tclcalls + 1
         if update:
             self.text.update_idletasks()
+            self.tclcalls = self.tclcalls + 1
 
     def flush(self):
         if self.pendingdata:
-            self.text.insert(END, self.pendingdata, self.flowingtags)
+            self.add_segment(self.pendingdata, self.flowingtags)
             self.pendingdata = ''
+        self.insert_segments()
+
+    def add_segment(self, data, tags):
+        """Queue data to be inserted at the end with tags.
+
+        Text for the widget is collected as data, tags, data, tags...
+        in self.segments, with adjacent data for the same tags joined,
+        and inserted with a single call by insert_segments().
+        """
+        if not data:
+            return
+        segments = self.segments
+        if segments and segments[-1] == tags:
+            segments[-2] = segments[-2] + data
+        else:
+            segments.append(data)
+            segments.append(tags)
+
+    def insert_segments(self):
+        """Insert the queued segments into the text widget.
+
+        This must be done before anything depends on the widget's
+        contents, such as indexes, marks and embedded windows at the
+        end; freeze() and flush() do it too.
+        """
+        if self.segments:
+            self.text.insert(END, *self.segments)
+            self.segments = []
+            self.tclcalls = self.tclcalls + 1
 
     def scroll_page_down(self, event=None):
         self.text.tk.call('tkScrollByPages', self.text.vbar, 'v', 1)
@@ -490,7 +526,7 @@ class Viewer(formatter.AbstractWriter):
 
     def new_tags(self):
         if self.pendingdata and self.pendingdata.strip():
-            self.text.insert(END, self.pendingdata, self.flowingtags)
+            self.add_segment(self.pendingdata, self.flowingtags)
             self.pendingdata = ''
         self.flowingtags = tuple(filter(
             None,
@@ -513,7 +549,9 @@ class Viewer(formatter.AbstractWriter):
         else:
             tag = None
         if tag != self.fonttag:
-            self.flush()
+            if self.pendingdata:
+                self.add_segment(self.pendingdata, self.flowingtags)
+                self.pendingdata = ''
             self.fonttag = tag
         self.new_tags()
 
@@ -556,7 +594,7 @@ class Viewer(formatter.AbstractWriter):
         ##      print('New styles:', styles)
         self.addtags = styles
         if self.pendingdata:
-            self.text.insert(END, self.pendingdata, self.flowingtags)
+            self.add_segment(self.pendingdata, self.flowingtags)
             self.pendingdata = ''
         self.rightmarginlevel = rl = styles.count('blockquote')
         self.rightmargintag = ('rightmargin_{}'.format(rl)) if rl else None
@@ -591,28 +629,24 @@ class Viewer(formatter.AbstractWriter):
     def send_label_data(self, data):
         ##      print("Label data:", repr(data))
         tags = self.flowingtags + ('label_{}'.format(self.marginlevel),)
+        self.add_segment(self.pendingdata, self.flowingtags)
+        self.pendingdata = ''
         if isinstance(data, str):
-            self.text.insert(END, self.pendingdata, self.flowingtags,
-                             '\t{}\t'.format(data), tags)
-            self.pendingdata = ''
+            self.add_segment('\t{}\t'.format(data), tags)
         elif isinstance(data, Iterable):
             #  (string, fonttag) pair
             data, fonttag = data
             if fonttag:
-                self.text.insert(END, self.pendingdata, self.flowingtags,
-                                 '\t', tags,
-                                 data, tags + (fonttag,))
+                self.add_segment('\t', tags)
+                self.add_segment(data, tags + (fonttag,))
                 self.text.tag_raise(fonttag)
+                self.tclcalls = self.tclcalls + 1
                 self.pendingdata = '\t'
             else:
-                self.text.insert(END, self.pendingdata, self.flowingtags,
-                                 '\t{}\t'.format(data), tags)
-                self.pendingdata = ''
+                self.add_segment('\t{}\t'.format(data), tags)
         else:
             #  Some sort of image specified by DINGBAT or SRC
-            self.text.insert(END, self.pendingdata, self.flowingtags,
-                             '\t', tags)
-            self.pendingdata = ''
+            self.add_segment('\t', tags)
             window = Label(self.text, image=data,
                            background=self.text['background'],
                            borderwidth=0)
@@ -625,8 +659,8 @@ class Viewer(formatter.AbstractWriter):
 
     def send_literal_data(self, data):
         ##      print("Literal data:", repr(data), self.flowingtags + ('pre',))
-        self.text.insert(END, self.pendingdata, self.flowingtags,
-                         data, self.flowingtags + ('pre',))
+        self.add_segment(self.pendingdata, self.flowingtags)
+        self.add_segment(data, self.flowingtags + ('pre',))
         self.pendingdata = ''
 
     # Viewer's own methods
@@ -775,11 +809,10 @@ class Viewer(formatter.AbstractWriter):
             self.text.mark_unset(*self.targets)
 
     def add_target(self, fragment):
-        if self.pendingdata:
-            self.text.insert(END, self.pendingdata, self.flowingtags)
-            self.pendingdata = ''
+        self.flush()
         self.text.mark_set(fragment, END + ' - 1 char')
         self.text.mark_gravity(fragment, 'left')
+        self.tclcalls = self.tclcalls + 2
         self.targets.add(fragment)
 
     def scroll_to(self, fragment):
@@ -830,14 +863,14 @@ class Viewer(formatter.AbstractWriter):
         self.pendingdata = self.pendingdata + MIN_IMAGE_LEADER
         self.align = prev_align
         self.new_tags()
+        self.insert_segments()
 
     def add_subwindow(self, window, align=CENTER, index=END):
-        if self.pendingdata:
-            self.text.insert(END, self.pendingdata, self.flowingtags)
-            self.pendingdata = ''
+        self.flush()
         window.bind("<Button-3>", self.button_3_event)
         self.subwindows.append(window)
         self.text.window_create(index, window=window, align=align)
+        self.tclcalls = self.tclcalls + 1
 
     def add_subviewer(self, subviewer):
         self.flush()
@@ -1077,5 +1110,44 @@ def test():
     root.mainloop()
 
 
+def benchmark(count=2000):
+    """Format a tag-heavy page into a Viewer and count the Tcl calls.
+
+    Run with "python -m grail.Viewer -b [count]"; this needs a display.
+    """
+    import time
+    try:
+        root = Tk()
+    except TclError as err:
+        print("no benchmark:", err)
+        return
+    root.withdraw()
+    v = Viewer(Toplevel(root), None)
+    fmt = formatter.AbstractFormatter(v)
+    t0 = time.perf_counter()
+    v.unfreeze()
+    for i in range(count):
+        fmt.add_flowing_data("some ")
+        fmt.push_font((None, 1, None, None))
+        fmt.add_flowing_data("emphasized")
+        fmt.pop_font()
+        fmt.push_style('a')
+        fmt.add_flowing_data(" linked ")
+        fmt.pop_style()
+        fmt.add_flowing_data("text.")
+        if i % 50 == 49:
+            v.freeze(True)
+            v.unfreeze()
+    v.freeze()
+    t1 = time.perf_counter()
+    print("{} runs of tags: {:.1f} ms, {} Tcl calls".format(
+        count, (t1 - t0) * 1000, v.tclcalls))
+    root.destroy()
+
+
 if __name__ == '__main__':
-    test()
+    import sys
+    if sys.argv[1:2] == ['-b']:
+        benchmark(*map(int, sys.argv[2:3]))
+    else:
+        test()
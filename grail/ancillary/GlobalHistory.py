@@ -123,12 +123,24 @@ class GlobalHistory:
 
         urls()
                 Return a list, in order of all URLs on the GlobalHistory.
+
+    The history file is read when the history is first queried.  URLs
+    remembered before that are kept aside and added after the file's
+    contents, so a browser can show its first page without waiting for
+    the file.
     """
 
     def __init__(self, app, readonly=False):
         self._app = app
         self._urlmap = {}               # for fast lookup
         self._history = []              # to maintain order
+        self._pending = []              # remembered before loading
+        self._loaded = False
+        if not readonly:
+            app.register_on_exit(self.on_app_exit)
+
+    def _load(self):
+        self._loaded = True
         # first try to load the Grail global history file
         fp = None
         try:
@@ -144,8 +156,9 @@ class GlobalHistory:
         finally:
             if fp:
                 fp.close()
-        if not readonly:
-            app.register_on_exit(self.on_app_exit)
+        for url, title, when in self._pending:
+            self._remember(url, title, when)
+        del self._pending[:]
 
     def mass_append(self, histlist):
         histlist.reverse()
@@ -154,15 +167,23 @@ class GlobalHistory:
             self._history.append(url)
 
     def remember_url(self, url, title=''):
+        if self._loaded:
+            self._remember(url, title, now())
+        else:
+            self._pending.append((url, title, now()))
+
+    def _remember(self, url, title, when):
         if url not in self._urlmap:
             self._history.append(url)
         elif not title:
             title, oldts = self._urlmap[url]
-        self._urlmap[url] = (title, now())
+        self._urlmap[url] = (title, when)
         # Debugging...
 #       print('remember_url:', url, self._urlmap[url])
 
     def set_title(self, url, title):
+        if not self._loaded:
+            self._load()
         if url in self._urlmap:
             old_title, when = self._urlmap[url]
         else:
@@ -170,15 +191,25 @@ class GlobalHistory:
         self._urlmap[url] = (title, when)
 
     def lookup_url(self, url):
+        if not self._loaded:
+            self._load()
         return self._urlmap.get(url, (None, None))
 
     def inhistory_p(self, url):
+        if not self._loaded:
+            self._load()
         return url in self._urlmap
 
     def urls(self):
+        if not self._loaded:
+            self._load()
         return self._history[:]
 
     def on_app_exit(self):
+        if not (self._loaded or self._pending):
+            # Nothing was added; the file is as good as it was
+            self._app.unregister_on_exit(self.on_app_exit)
+            return
         with open(DEFAULT_GRAIL_HIST_FILE, 'w') as fp:
             print('GRAIL-global-history-file-1', file=fp)
             urls = self.urls()
@@ -115,8 +115,52 @@ class Preferences:
         self.deleted.clear()
 
 
+class Snapshot:
+    """The combined preferences at one moment, for fast repeated lookup.
+
+    Values are converted to a type on first request and the result is
+    remembered, so later typed lookups are a single dictionary probe.
+    """
+
+    def __init__(self, items):
+        self.values = dict(items)       # (group, cmpnt) -> string
+        self.typed = {}                 # (group, cmpnt, type_name) -> value
+        self.groups = defaultdict(list)
+        for key, val in sorted(self.values.items()):
+            self.groups[key[0]].append((key, val))
+
+    def Get(self, group, cmpnt):
+        try:
+            return self.values[(group, cmpnt)]
+        except KeyError:
+            raise KeyError("Preference {} not found".format((group, cmpnt)))
+
+    def GetTyped(self, group, cmpnt, type_name):
+        key = (group, cmpnt, type_name)
+        try:
+            return self.typed[key]
+        except KeyError:
+            pass
+        val = self.Get(group, cmpnt)
+        try:
+            typed = typify(val, type_name)
+        except TypeError:
+            raise TypeError('{} should be {}: {!r}'.format(
+                (group, cmpnt), type_name, val))
+        self.typed[key] = typed
+        return typed
+
+    def GetGroup(self, group):
+        return list(self.groups.get(group, ()))
+
+
 class AllPreferences:
-    """Maintain the combination of user and system preferences."""
+    """Maintain the combination of user and system preferences.
+
+    Lookups other than of factory values are answered from a Snapshot,
+    which is dropped whenever the preferences change: by Set(), by
+    Save() before the group callbacks run, and by load().
+    """
 
     def __init__(self):
         self.load()
@@ -128,6 +172,14 @@ class AllPreferences:
                                              USERPREFSFILENAME))
         self.sys = Preferences(os.path.join(utils.get_grailroot(),
                                             SYSPREFSFILENAME))
+        self._snapshot = None
+
+    def snapshot(self):
+        """Return a Snapshot of the current preferences."""
+        snapshot = self._snapshot
+        if snapshot is None:
+            snapshot = self._snapshot = Snapshot(self.items())
+        return snapshot
 
     def AddGroupCallback(self, group, callback):
         """Register callback to be invoked when saving GROUP changed prefs.
@@ -161,10 +213,7 @@ class AllPreferences:
         if factory:
             return self.sys.Get(group, cmpnt)
         else:
-            try:
-                return self.user.Get(group, cmpnt)
-            except KeyError:
-                return self.sys.Get(group, cmpnt)
+            return self.snapshot().Get(group, cmpnt)
 
     def GetTyped(self, group, cmpnt, type_name, factory=False):
         """Get preference, converted to given type.
@@ -172,6 +221,8 @@ class AllPreferences:
         Optional FACTORY true means get system default value.
 
         Raise KeyError if not found, TypeError if value is wrong type."""
+        if not factory:
+            return self.snapshot().GetTyped(group, cmpnt, type_name)
         val = self.Get(group, cmpnt, factory)
         try:
             return typify(val, type_name)
@@ -190,11 +241,7 @@ class AllPreferences:
 
     def GetGroup(self, group):
         """Get a list of ((group,cmpnt), value) tuples in group."""
-        got = []
-        for it in self.items():
-            if it[0][0] == group:
-                got.append(it)
-        return got
+        return self.snapshot().GetGroup(group)
 
     def items(self):
         got = {}
@@ -210,6 +257,7 @@ class AllPreferences:
         """Assign GROUP,COMPONENT with VALUE."""
         if self.Get(group, cmpnt) != val:
             self.user.Set(group, cmpnt, val)
+            self._snapshot = None
 
     def Editable(self):
         """Identify or establish user's prefs file, or IO error."""
@@ -237,6 +285,7 @@ class AllPreferences:
             self.user.Save()
         except IOError:
             print("Failed save of user prefs.")
+        self._snapshot = None
 
         # Process the callbacks:
         callbacks, did_callbacks = self.callbacks, set()
@@ -311,7 +360,16 @@ class Test(unittest.TestCase):
         # Get the new value.
         self.assertEqual(origheight + 1,
                          prefs.GetInt("browser", "default-height"))
+        # Group callbacks see the saved value.
+        seen = []
+        def callback():
+            seen.append(prefs.GetInt("browser", "default-height"))
+        prefs.AddGroupCallback("browser", callback)
         prefs.Save()
+        prefs.RemoveGroupCallback("browser", callback)
+        self.assertEqual(seen, [origheight + 1])
+        self.assertIn((("browser", "default-height"), str(origheight + 1)),
+                      prefs.GetGroup("browser"))
 
         # Restore simple value
         prefs.Set('browser', 'default-height', origheight)
@@ -5,6 +5,7 @@ import os
 import mimetypes
 import re
 from . import utils
+from . import extloader
 
 
 class Application:
@@ -24,6 +25,8 @@ class Application:
             user_icons, os.path.join(utils.get_grailroot(), 'icons')]
         #
         self.__loaders = {}
+        self.extension_index = extloader.ModuleIndex(
+            os.path.join(self.graildir, "extensions.idx"))
         #
         # Add our type map file to the set used to initialize the shared map:
         #
@@ -36,6 +39,7 @@ class Application:
     def add_loader(self, name, loader):
         localdir = os.sep.join(name.split("."))
         userdir = os.path.join(self.graildir, localdir)
+        loader.set_index(self.extension_index)
         loader.add_directory(userdir)
         self.__loaders[name] = loader
 
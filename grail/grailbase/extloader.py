@@ -4,22 +4,98 @@ to do the right thing."""
 __version__ = '$Revision: 1.2 $'
 
 import os
+import sys
+import pickle
+import pkgutil
 import importlib
 import traceback
+import unittest
+
+
+class ModuleIndex:
+    """Names of the modules found in directories.
+
+    Each directory's listing is kept with the directory's modification
+    time, and is redone when that changes.  With a filename, the index
+    is read from the file when created and written back by save(), so
+    that the listings survive from one run to the next.
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.dirs = {}                  # path -> (mtime, frozenset of names)
+        self.changed = False
+        if filename:
+            self.load()
+
+    def modules(self, path):
+        """Return the names of the modules in the directory path.
+
+        That is an empty set if there is no such path, and None if it
+        exists but isn't a directory, like a zip file.
+        """
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return frozenset()
+        entry = self.dirs.get(path)
+        if entry is not None and entry[0] == mtime:
+            return entry[1]
+        if not os.path.isdir(path):
+            return None
+        names = frozenset(info.name for info in pkgutil.iter_modules([path]))
+        self.dirs[path] = (mtime, names)
+        self.changed = True
+        return names
+
+    def load(self):
+        try:
+            with open(self.filename, 'rb') as fp:
+                self.dirs = dict(pickle.load(fp))
+        except (IOError, EOFError, pickle.UnpicklingError, ValueError,
+                TypeError):
+            return
+
+    def save(self):
+        if not (self.filename and self.changed):
+            return
+        try:
+            with open(self.filename + '.tmp', 'wb') as fp:
+                pickle.dump(list(self.dirs.items()), fp)
+            os.replace(self.filename + '.tmp', self.filename)
+        except OSError:
+            return
+        self.changed = False
+
 
 class ExtensionLoader:
 
+    """Load extensions from the modules of a package.
+
+    Lookups that find nothing are remembered too, so an unknown name
+    costs one search.  Whether the package has a module by a name is
+    first checked against a ModuleIndex of the package's directories,
+    without trying to import it.  Adding a directory forgets the
+    failed lookups.
+    """
+
     def __init__(self, package):
         self.__package = package
         self.__extensions = {}
+        self.__missing = set()
+        self.__index = ModuleIndex()
 
     def get(self, name):
         try:
             ext = self.get_extension(name)
         except KeyError:
+            if name in self.__missing:
+                return None
             ext = self.find(name)
             if ext is not None:
                 self.add_extension(name, ext)
+            else:
+                self.__missing.add(name)
         return ext
 
     def find(self, name):
@@ -30,6 +106,8 @@ class ExtensionLoader:
         #print(self.__package)
         if 'APIAPI' in name:
             name = name.replace('APIAPI', 'API')
+        if not self.has_module(name):
+            return None
         try:
             mod = importlib.import_module(self.__package.__name__+'.'+name)
             #mod = __import__(name, vars(self.__package), level=1)
@@ -38,16 +116,76 @@ class ExtensionLoader:
             mod = None
         return mod
 
+    def has_module(self, name):
+        """Return whether the package may have a module called name."""
+        if '.' in name or self.__package.__name__ + '.' + name in sys.modules:
+            return True
+        index = self.__index
+        found = False
+        for path in self.__package.__path__:
+            names = index.modules(path)
+            if names is None or name in names:
+                found = True
+                break
+        index.save()
+        return found
+
+    def set_index(self, index):
+        self.__index = index
+        self.__missing.clear()
+
     def add_directory(self, path):
         path = os.path.normpath(os.path.join(os.getcwd(), path))
         if path not in self.__package.__path__:
             self.__package.__path__.insert(0, path)
+            self.__missing.clear()
             return True
         else:
             return False
 
     def add_extension(self, name, extension):
         self.__extensions[name] = extension
+        self.__missing.discard(name)
 
     def get_extension(self, name):
         return self.__extensions[name]
+
+
+class Test(unittest.TestCase):
+
+    def runTest(self):
+        import tempfile
+        import types
+        with tempfile.TemporaryDirectory() as dir:
+            package = types.ModuleType('_extloader_test')
+            package.__path__ = [dir]
+            sys.modules[package.__name__] = package
+            try:
+                with open(os.path.join(dir, 'foo.py'), 'w') as fp:
+                    fp.write('x = 1\n')
+                filename = os.path.join(dir, 'index')
+                loader = ExtensionLoader(package)
+                loader.set_index(ModuleIndex(filename))
+                self.assertEqual(loader.get('foo').x, 1)
+                self.assertIsNone(loader.get('bar'))
+                # A known miss doesn't look at the directory again
+                with open(os.path.join(dir, 'bar.py'), 'w') as fp:
+                    fp.write('x = 2\n')
+                self.assertIsNone(loader.get('bar'))
+
+                # The listing is saved, and redone once the directory
+                # changes
+                index = ModuleIndex(filename)
+                self.assertNotIn('bar', index.dirs[dir][1])
+                os.utime(dir, ns=(0, 0))
+                self.assertIn('bar', index.modules(dir))
+                loader.set_index(index)
+                self.assertEqual(loader.get('bar').x, 2)
+            finally:
+                for name in list(sys.modules):
+                    if name.startswith(package.__name__):
+                        del sys.modules[name]
+
+
+if __name__ == '__main__':
+    unittest.main()
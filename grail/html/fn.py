@@ -7,8 +7,8 @@ __version__ = '$Revision: 2.9 $'
 
 
 def writer_start_fn(parser, attrs):
-    if 'p' in parser.stack:
-        parser.lex_endtag('p')
+    if parser.sgml_parser.has_context('p'):
+        parser.sgml_parser.lex_endtag('p')
         parser.formatter.end_paragraph(0)
     else:
         parser.formatter.add_line_break()
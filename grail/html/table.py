@@ -43,6 +43,7 @@ class TableSubParser:
         # tosses any dangling text not in a caption or explicit cell
         parser.save_bgn()
         # Flush output -- we're gonna dive under for a while...
+        parser.viewer.insert_segments()
         parser.viewer.text.update_idletasks()
         # create the table data structure
         if self._lasttable:
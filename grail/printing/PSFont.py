@@ -77,6 +77,7 @@ class PSFont:
        __init__(optional: VARIFAMILY, FIXEDFAMILY)
        set_font((SIZE, ITALIC?, BOLD?, TT?)) ==> (PSFONTNAME, SIZE)
        text_width(TEXT) ==> WIDTH_IN_POINTS
+       text_widths([TEXT, ...]) ==> [WIDTH_IN_POINTS, ...]
        font_size(optional: (SIZE, ITALIC?, BOLD?, TT?)) ==> SZ_IN_POINTS
     """
 
@@ -137,6 +138,7 @@ class PSFont:
         # instantiated font objects
         self.fontobjs = {}
         self.tw_func = None
+        self.tws_func = None
 
     def get_font(self):
         """Returns the font nickname and size.
@@ -193,6 +195,7 @@ class PSFont:
             self.fontobjs[fontnickname] = fonts.font_from_name(psfontname)
 ##      print(fontnickname, "==>", self.fontobjs[fontnickname])
         self.tw_func = self.fontobjs[fontnickname].text_width
+        self.tws_func = self.fontobjs[fontnickname].text_widths
 
         self._fontsize = new_sz
 
@@ -206,6 +209,9 @@ class PSFont:
         # return width
         return self.tw_func(self._fontsize, text)
 
+    def text_widths(self, words):
+        return self.tws_func(self._fontsize, words)
+
     def font_size(self, font_tuple=None):
         """Return the size of the current font, or the font defined by
         optional FONT_TUPLE if present."""
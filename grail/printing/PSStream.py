@@ -477,8 +477,7 @@ class PSStream:
         words = data.split(' ')
         wordcnt = len(words) - 1
         space_width = self._space_width
-        for word in words:
-            width = text_width(word)
+        for word, width in zip(words, self._font.text_widths(words)):
             # Does the word fit on the current line?
             if xpos + width < allowed_width:
                 append(word)
@@ -596,6 +595,8 @@ class PSStream:
         self.prune_titles()
         self._ofp.write("({})\n({})\n{} EP\n".format(
                         url, title, self.get_pageno()))
+        # the page is done; pass it on rather than buffer it
+        self._ofp.flush()
 
     def push_page_end(self):
         # self._baseline could be None
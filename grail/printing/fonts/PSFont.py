@@ -17,27 +17,106 @@ import operator
 import array
 
 
+WORD_CACHE_SIZE = 10000                 # Word widths remembered per font
+
+
 class PSFont:
 
+    """Widths are summed from the per-character metrics, in units of
+    1/1000 of the font size, by map() rather than a Python loop.
+    Characters outside Latin-1 are measured as '?'.
+
+    text_widths() measures a line's worth of words at once and
+    remembers the width of each word, which is independent of the
+    size; text_width() uses what it remembers.  The memo is dropped
+    when it grows past WORD_CACHE_SIZE.
+    """
+
     def __init__(self, fontname, fullname, metrics):
         self._fontname = fontname
         self._fullname = fullname
         self._metrics = metrics
+        self._charwidth = list(metrics).__getitem__
+        self._words = {}
 
     def fontname(self): return self._fontname
 
     def fullname(self): return self._fullname
 
+    def text_units(self, str):
+        """Return the width of the string in 1/1000 of the font size."""
+        return sum(map(self._charwidth, str.encode('latin-1', 'replace')))
+
     def text_width(self, fontsize, str):
         """Quickly calculate the width in points of the given string
         in the current font, at the given font size.
         """
+        try:
+            width = self._words[str]
+        except KeyError:
+            width = self.text_units(str)
+        return width * fontsize / 1000
+
+    def text_widths(self, fontsize, words):
+        """Return a list of the widths in points of each of the given
+        strings, at the given font size.
+        """
+        known = self._words
+        if len(known) > WORD_CACHE_SIZE:
+            known.clear()
+        widths = []
+        append = widths.append
+        for word in words:
+            try:
+                width = known[word]
+            except KeyError:
+                width = known[word] = self.text_units(word)
+            append(width * fontsize / 1000)
+        return widths
+
+
+def benchmark(n=200):
+    """Time measuring lines the way PSStream.push_string_flowing()
+    does, once the line and then each of its words, using the old
+    per-character loop and using text_width() and text_widths().
+
+    Run with "python -m grail.printing.fonts.PSFont".
+    """
+    import time
+    from . import PSFont_Times_Roman
+    font = PSFont_Times_Roman.font
+    metrics = font._metrics
+    text = ("Lorem ipsum dolor sit amet, consectetur adipiscing elit, "
+            "sed do eiusmod tempor incididunt ut labore et dolore magna "
+            "aliqua.  Ut enim ad minim veniam, quis nostrud exercitation "
+            "ullamco laboris nisi ut aliquip ex ea commodo consequat. ")
+    lines = [text[i:] + text[:i] for i in range(0, len(text), 7)]
+
+    def loop(fontsize, str):
+        # What text_width() used to do
         width = 0
-        metrics = self._metrics
         for ci in map(ord, str):
             width = width + metrics[ci]
         return width * fontsize / 1000
 
+    def old(line):
+        words = line.split(' ')
+        return [loop(12.0, line)] + [loop(12.0, word) for word in words]
+
+    def new(line):
+        words = line.split(' ')
+        return [font.text_width(12.0, line)] + font.text_widths(12.0, words)
+
+    for label, func in (("per-char loop", old), ("text_widths", new)):
+        assert list(map(func, lines)) == list(map(old, lines)), label
+        t0 = time.perf_counter()
+        for i in range(n):
+            for line in lines:
+                func(line)
+        elapsed = time.perf_counter() - t0
+        print("{:<14} {:8.2f} us/line".format(
+            label, elapsed / n / len(lines) * 1e6))
+
 
 if __name__ == '__main__':
     from . import PSFont_Times_Roman
@@ -47,3 +126,4 @@ if __name__ == '__main__':
     print('Full Name:', font.fullname())
     print('Width of "Hello World" in 12.0:',
           font.text_width(12.0, 'Hello World'))
+    benchmark()
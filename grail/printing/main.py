@@ -19,6 +19,9 @@ import urllib.request
 import urllib.parse
 import pkgutil
 import subprocess
+import time
+import unittest
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from io import TextIOWrapper
 
 # local modules:
@@ -34,6 +37,7 @@ from ..grailbase.uricontext import URIContext
 
 
 MULTI_DO_PAGE_BREAK = True                 # changing this breaks stuff
+FEEDSIZE = 64*1024                         # characters per parser feed()
 
 
 #  The main program.  Really needs to be broken up a bit!
@@ -60,17 +64,22 @@ def run(app):
     copies = 1
     levels = None
     outfile = None
+    batch = None
+    jobs = None
+    tags = []
     #
     try:
         options, args = getopt.getopt(sys.argv[1:],
                                       'mvhdcaUl:u:t:sp:o:f:C:P:T:i',
-                                      ['color',
+                                      ['batch=',
+                                       'color',
                                        'copies=',
                                        'debug',
                                        'fontsize=',
                                        'footnote-anchors',
                                        'help',
                                        'images',
+                                       'jobs=',
                                        'logfile=',
                                        'multi',
                                        'orientation=',
@@ -131,10 +140,15 @@ def run(app):
             verbose = verbose + 1
         elif opt == '--output':
             outfile = arg
+        elif opt == '--batch':
+            batch = arg
+        elif opt == '--jobs':
+            jobs = int(arg)
         elif opt == '--tags':
             if not load_tag_handler(app, arg):
                 error = 2
                 help = True
+            tags.append(arg)
         elif opt == '--paragraph-indent':
             # negative indents should indicate hanging indents, but we don't
             # do those yet, so force to normal interpretation
@@ -152,6 +166,10 @@ def run(app):
         except IOError:
             sys.stderr = stderr
     utils.debug("Using Python version " + sys.version)
+    if batch:
+        if run_batch(settings, batch, outfile, jobs, tags):
+            sys.exit(1)
+        return
     # crack open the input file, or stdin
     outfp = None
     if printer:
@@ -197,30 +215,15 @@ def run(app):
             # BOGOSITY: reading from stdin
             context = URIContext("file:/index.html")
         context.app = app
-        paper = printing_paper.PaperInfo(settings.papersize,
-                                         margins=settings.margins,
-                                         rotation=settings.orientation)
-        if tabstop and tabstop > 0:
-            paper.TabStop = tabstop
-        if utils.get_debugging('paper'):
-            paper.dump()
-        # create the writer & parser
-        fontsize, leading = settings.get_fontsize()
-        w = PSWriter.PSWriter(outfp, title or None, url or '',
-                              # varifamily='Palatino',
-                              paper=paper, settings=settings)
         ctype = "text/html"
-        mod = app.find_type_extension("printing.filetypes", ctype)
-        if not mod.parse:
-            sys.exit("cannot load printing support for " + ctype)
-        p = mod.parse(w, settings, context)
+        w, p = make_parser(app, settings, outfp, context, title, url, tabstop)
         if multi:
             if args[1:]:
                 xform = explicit_multi_transform(args[1:])
             else:
                 xform = multi_transform(context, levels)
             p.add_anchor_transform(xform)
-            p.feed(infp.read())
+            feed_source(p, infp)
             docs = [(context.get_url(), 1, w.ps.get_title(), 1)]
             #
             # This relies on xform.get_subdocs() returning the list used
@@ -258,14 +261,14 @@ def run(app):
                         context.set_url(url)
                         w.ps.set_url(url)
                     pageno = w.ps.get_pageno()
-                    p.feed(infp.read())
+                    feed_source(p, infp)
                     infp.close()
                     title = w.ps.get_title()
                     p._set_docinfo(url, pageno, title)
                     spec = (url, pageno, title, xform.get_level(url))
                     docs.append(spec)
         else:
-            p.feed(infp.read())
+            feed_source(p, infp)
         p.close()
         w.close()
     finally:
@@ -278,6 +281,50 @@ def run(app):
 #  Lots of helper functions....
 
 
+def make_parser(app, settings, outfp, context, title='', url='',
+                tabstop=None):
+    """Create the PSWriter for OUTFP and the HTML parser feeding it."""
+    paper = printing_paper.PaperInfo(settings.papersize,
+                                     margins=settings.margins,
+                                     rotation=settings.orientation)
+    if tabstop and tabstop > 0:
+        paper.TabStop = tabstop
+    if utils.get_debugging('paper'):
+        paper.dump()
+    w = PSWriter.PSWriter(outfp, title or None, url or '',
+                          # varifamily='Palatino',
+                          paper=paper, settings=settings)
+    ctype = "text/html"
+    mod = app.find_type_extension("printing.filetypes", ctype)
+    if not mod.parse:
+        sys.exit("cannot load printing support for " + ctype)
+    return w, mod.parse(w, settings, context)
+
+
+def feed_source(parser, infp, size=FEEDSIZE):
+    """Feed the document from INFP to PARSER a chunk at a time, so it
+    never needs to be in memory as a whole.
+
+    Chunks end before a '<'.  The text between two tags is passed on in
+    one piece, as it is when the document is fed all at once, and the
+    writer lays it out the same way; where a text run is split makes a
+    difference to its line breaks.
+    """
+    pending = []
+    while True:
+        data = infp.read(size)
+        if not data:
+            break
+        i = data.rfind('<')
+        if i < 0:
+            pending.append(data)
+            continue
+        pending.append(data[:i])
+        parser.feed(''.join(pending))
+        pending = [data[i:]]
+    parser.feed(''.join(pending))
+
+
 def load_tag_handler(app, arg):
     loader = app.get_loader("html.postscript")
     narg = os.path.join(os.getcwd(), arg)
@@ -465,6 +512,12 @@ def usage(settings):
     print('    -m: descend tree starting from specified document,')
     print('        printing all HTML documents found')
     print('    -h: this help message')
+    print('    --batch: convert every HTML file below a directory, or')
+    print('        every file or URL listed in a manifest, one per line')
+    print('        and optionally followed by its output file; --output')
+    print('        names the directory to write to')
+    print('    --jobs: number of processes for --batch (default is one')
+    print('        per CPU)')
     print('[file]: file to convert, otherwise from stdin')
 
 
@@ -472,6 +525,132 @@ def _onoff(bool):
     return "ON" if bool else "OFF"
 
 
+#  Batch conversion over a pool of worker processes....
+
+
+BATCH_EXTENSIONS = ('.html', '.htm')
+
+
+def batch_jobs(source, outdir):
+    """Return the (input, output) pairs of a batch.
+
+    SOURCE is either a directory, searched recursively for HTML files
+    whose outputs mirror the tree below OUTDIR, or a manifest file
+    listing an input file or URL per line, optionally followed by its
+    output file, relative to OUTDIR.  Blank lines and lines starting
+    with '#' are skipped.
+    """
+    jobs = []
+    if os.path.isdir(source):
+        for dirpath, dirnames, filenames in os.walk(source):
+            dirnames.sort()
+            for fn in sorted(filenames):
+                base, ext = os.path.splitext(fn)
+                if ext.lower() in BATCH_EXTENSIONS:
+                    relpath = os.path.relpath(dirpath, source)
+                    jobs.append((os.path.join(dirpath, fn),
+                                 os.path.normpath(os.path.join(
+                                     outdir, relpath, base + '.ps'))))
+        return jobs
+    with open(source) as fp:
+        for line in fp:
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            infile = fields[0]
+            if fields[1:]:
+                outfn = fields[1]
+            else:
+                fn = posixpath.basename(urllib.parse.urlparse(infile).path)
+                outfn = (os.path.splitext(fn)[0] or 'index') + '.ps'
+            jobs.append((infile, os.path.join(outdir, outfn)))
+    return jobs
+
+
+# The Application of a batch worker process.  It lives as long as the
+# process, so the font metrics and tag handlers it loads serve every
+# document the worker converts.
+_batch_app = None
+
+
+def batch_init(settings, tags, debugging):
+    """Set up a batch worker process with the parent's settings."""
+    global _batch_app
+    from . import settings as settings_module
+    settings_module.set_settings(settings)
+    utils.set_debugging(debugging)
+    _batch_app = Application()
+    for arg in tags:
+        load_tag_handler(_batch_app, arg)
+
+
+def batch_convert(infile, outfile):
+    """Convert one document of a batch in a worker process.
+
+    Returns the time taken and an error message, or None on success.
+    """
+    from . import settings
+    t0 = time.perf_counter()
+    try:
+        infp, infile, fn = open_source(infile)
+        with infp:
+            dirname = os.path.dirname(outfile)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            with open(outfile, 'w', encoding='latin-1',
+                      errors='replace') as outfp:
+                context = URIContext(infile)
+                context.app = _batch_app
+                w, p = make_parser(_batch_app, settings.get_settings(),
+                                   outfp, context, url=infile)
+                feed_source(p, infp)
+                p.close()
+                w.close()
+    except (Exception, SystemExit) as err:
+        return time.perf_counter() - t0, "{}: {}".format(
+            type(err).__name__, err)
+    return time.perf_counter() - t0, None
+
+
+def run_batch(settings, source, outdir=None, jobs=None, tags=()):
+    """Convert a batch of documents over JOBS worker processes.
+
+    Prints a line per document as it is done, then a summary of the
+    timings and failures.  Returns the number of failures.
+    """
+    pairs = batch_jobs(source, outdir or os.curdir)
+    failures = []
+    busy = 0.0
+    t0 = time.perf_counter()
+    with ProcessPoolExecutor(jobs, initializer=batch_init,
+                             initargs=(settings, list(tags),
+                                       utils.get_debugging())) as pool:
+        futures = {pool.submit(batch_convert, *pair): pair
+                   for pair in pairs}
+        for future in as_completed(futures):
+            infile, outfile = futures[future]
+            try:
+                seconds, error = future.result()
+            except Exception as err:
+                # The worker died
+                seconds, error = 0.0, "{}: {}".format(
+                    type(err).__name__, err)
+            busy = busy + seconds
+            if error:
+                failures.append((infile, error))
+                print("{:8.2f}s {} FAILED".format(seconds, infile))
+            else:
+                print("{:8.2f}s {} -> {}".format(seconds, infile, outfile))
+    elapsed = time.perf_counter() - t0
+    print()
+    print("{} documents, {} failed, {:.2f}s in workers, {:.2f}s elapsed"
+          .format(len(pairs), len(failures), busy, elapsed))
+    for infile, error in failures:
+        print("   ", infile)
+        print("       ", error)
+    return len(failures)
+
+
 #  main() & relations....
 
 
@@ -502,6 +681,100 @@ def main():
         sys.exit(1)
 
 
+class BatchTest(unittest.TestCase):
+
+    """Convert documents in a batch and one at a time, and compare.
+
+    Run with "python -m unittest grail.printing.main".
+    """
+
+    def setUp(self):
+        import tempfile
+        from .. import grail_root
+        from ..grailbase import utils as grailbase_utils
+        grailbase_utils._grail_root = grail_root
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.dir = self.tempdir.name
+        self.addCleanup(self.tempdir.cleanup)
+
+    def write_doc(self, name, text):
+        path = os.path.join(self.dir, 'in', name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as fp:
+            fp.write('<html><head><title>{}</title></head><body>\n{}'
+                     '</body></html>\n'.format(name, text))
+        return path
+
+    def convert(self, *args):
+        """Run the command line with args, and return the output."""
+        import contextlib
+        import io
+        from unittest import mock
+        with mock.patch.object(sys, 'argv', ['html2ps'] + list(args)), \
+             contextlib.redirect_stdout(io.StringIO()) as out:
+            run(Application())
+        return out.getvalue()
+
+    def read_ps(self, path):
+        """Return the PostScript in path, without the time values."""
+        with open(path, encoding='latin-1') as fp:
+            return [line for line in fp if 'UTC' not in line]
+
+    def runTest(self):
+        docs = [self.write_doc('one.html',
+                               '<h1>One</h1><p>The quick brown fox.\n' * 50),
+                self.write_doc('sub/two.html',
+                               '<ul><li>spam<li><b>eggs</b></ul>\n' * 50)]
+        out = self.convert('--batch', os.path.join(self.dir, 'in'),
+                           '--output', os.path.join(self.dir, 'batch'))
+        self.assertIn('2 documents, 0 failed', out)
+        for doc, name in zip(docs, ('one.ps', 'sub/two.ps')):
+            single = os.path.join(self.dir, 'single.ps')
+            self.convert('--output', single, doc)
+            self.assertEqual(
+                self.read_ps(os.path.join(self.dir, 'batch', name)),
+                self.read_ps(single))
+
+
+class FeedTest(BatchTest):
+
+    """Feeding a document in chunks doesn't change the PostScript."""
+
+    def convert_string(self, doc, size=None):
+        import io
+        from . import settings
+        app = Application()
+        outfp = io.StringIO()
+        context = URIContext('file:/doc.html')
+        context.app = app
+        w, p = make_parser(app, settings.get_settings(app.prefs), outfp,
+                           context, url='doc.html')
+        if size:
+            feed_source(p, io.StringIO(doc), size)
+        else:
+            p.feed(doc)
+        p.close()
+        w.close()
+        return [line for line in outfp.getvalue().splitlines(True)
+                if 'UTC' not in line]
+
+    def runTest(self):
+        import random
+        rnd = random.Random(42)
+        words = ['the', 'quick', 'brown', 'fox', 'jumps', 'over', 'lazy',
+                 'dog', '&amp;', '<b>bold</b>', '<br>', '<p>',
+                 '<pre>x  y\tz\n</pre>', '<!-- <p> -->']
+        # A long text run is where a different split shows in the layout.
+        docs = ['<p>' + ' '.join(rnd.choice(words[:8])
+                                 for i in range(50000)),
+                ''.join(rnd.choice(words) + rnd.choice(' \n\t')
+                        for i in range(5000))]
+        for doc in docs:
+            whole = self.convert_string(doc)
+            for size in (97, 1000):
+                self.assertEqual(self.convert_string(doc, size), whole)
+
+
 def profile_main(n=18):
     import profile
     import pstats
@@ -13,6 +13,13 @@ def get_settings(prefs=None):
     return _settings
 
 
+def set_settings(settings):
+    """Make SETTINGS, such as a copy passed to another process, the
+    object get_settings() returns."""
+    global _settings
+    _settings = settings
+
+
 from . import utils                            # || module
 
 
@@ -52,6 +59,12 @@ class PrintSettings:
             prefs.AddGroupCallback(self.GROUP, self.update)
             prefs.AddGroupCallback('parsing-html', self.update)
 
+    def __getstate__(self):
+        # A copy is a snapshot; it doesn't follow preference changes.
+        state = self.__dict__.copy()
+        state['_PrintSettings__prefs'] = None
+        return state
+
     def update(self):
         """Load / reload settings from preferences subsystem."""
         prefs = self.__prefs
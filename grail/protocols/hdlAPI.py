@@ -20,12 +20,24 @@ XXX Remaining problems:
            experimenting with solutions in the future.  This should be
            good enough for now.
 
-           Handle resolution is done synchronously, thereby defeating
-           the intended asynchronous API.  This should be fixed by
-           adding an asynchronous interface to hdllib.py.
+Handle resolution is asynchronous: the queries go out through the
+module's hdllib.Resolver, which all hdl_access objects share, and
+pollmeta() checks for the replies.  fileno() is a duplicate of the
+resolver's socket, so each reader can have its own Tk file handler.
+The steps of a resolution (fetching the global hash table the first
+time, querying the handle, and on HP_HANDLE_NOT_FOUND fetching the
+local hash table and querying that) are the generator resolve().
+
+Resolved handles and hash tables are kept in a hdllib.ResolutionCache,
+saved in the Grail directory, so that handles resolved before need no
+network traffic at all.
 
 """
 
+import os
+import select
+import time
+import unittest
 import urllib.parse
 from .. import hdllib
 from . import nullAPI
@@ -87,24 +99,39 @@ def parse_handle(hdl):
     return urllib.parse.unquote(hdl, 'latin-1').encode('latin-1'), d
 
 
+# The resolver shared by all handle requests
+resolver = hdllib.Resolver()
+
+# The ResolutionCache, kept in the user's Grail directory
+cache = None
+
+
+def get_cache():
+    global cache
+    if cache is None:
+        app = grailutil.get_grailapp()
+        if app:
+            cache = hdllib.ResolutionCache(
+                os.path.join(app.graildir, 'hdl-cache'))
+            if hasattr(app, 'register_on_exit'):
+                app.register_on_exit(cache.save)
+        else:
+            cache = hdllib.ResolutionCache()
+    return cache
+
+
 class hdl_access(nullAPI.null_access):
 
     _types = HANDLE_TYPES
 
-    #print("Fetching global hash table")
-    _global_hashtable = hdllib.fetch_global_hash_table()
+    # Fetched by the first request; the query is shared by the
+    # requests started while it is in flight
+    _global_hashtable = None
+    _global_query = None
 
-    _hashtable = _global_hashtable
+    _hashtable = None
 
-    _local_hashtables = {}
-
-    def get_local_hash_table(self, hdl):
-        key = hdllib.get_authority(hdl)
-        if key not in self._local_hashtables:
-            #print("Fetching local hash table for", key)
-            self._local_hashtables[key] = hdllib.fetch_local_hash_table(
-                key, self._global_hashtable)
-        return self._local_hashtables[key]
+    _global_server = hdllib.DEFAULT_GLOBAL_SERVER
 
     def __init__(self, hdl, method, params):
         self._msgattrs = {"title": "Ambiguous handle resolution"}
@@ -143,23 +170,123 @@ class hdl_access(nullAPI.null_access):
         if 'server' in self._attrs:
             self._hashtable = hdllib.HashTable(server=self._attrs['server'])
 
-    def pollmeta(self):
-        nullAPI.null_access.pollmeta(self)
+        if resolver.after is None and hasattr(self.app, 'root'):
+            resolver.after = self.app.root.after
+        self._fd = -1
+        self._steps = self.resolve()
+        self._query = next(self._steps, None)
+
+    def query(self, hashtable, hdl, types=[], flags=[], timeout=30,
+              interval=5, command=hdllib.HP_QUERY,
+              response=hdllib.HP_QUERY_RESPONSE):
+        return resolver.query(hashtable, hdl, types, flags, timeout,
+                              interval, command, response)
+
+    def resolve(self):
+        """Yield the queries that resolve the handle, one at a time.
+
+        The (flags, items) result of each query is sent back in, or
+        its error thrown in.  Sets self._items.  Resolutions and hash
+        tables found in the cache need no query.
+
+        """
+        cache = get_cache()
+        key = None
+        if self._hashtable is None:
+            key = hdllib.handle_key(self._hdl, self._types)
+            items = cache.get(key)
+            if items is not None:
+                self._items = items
+                return
+            if hdl_access._global_hashtable is None:
+                data = cache.get(hdllib.table_key(b''))
+                if data is None:
+                    if hdl_access._global_query is None:
+                        ht = hdllib.HashTable(server=self._global_server)
+                        hdl_access._global_query = self.query(
+                            ht, *hdllib.global_hash_table_request())
+                    try:
+                        flags, items = yield hdl_access._global_query
+                    finally:
+                        hdl_access._global_query = None
+                    data = hdllib.global_hash_table_data(items)
+                    cache.put(hdllib.table_key(b''), data,
+                              hdllib.DEFAULT_TABLE_TTL)
+                if hdl_access._global_hashtable is None:
+                    hdl_access._global_hashtable = \
+                        hdllib.HashTable(data=data)
+            self._hashtable = self._global_hashtable
         try:
-            replyflags, self._items = self._hashtable.get_data(
-                self._hdl, self._types)
+            flags, self._items = yield self.query(
+                self._hashtable, self._hdl, self._types)
         except hdllib.Error as inst:
-            if inst.errno == hdllib.HP_HANDLE_NOT_FOUND:
-                #print("Retry using a local handle server")
-                self._hashtable = self.get_local_hash_table(self._hdl)
-                replyflags, self._items = self._hashtable.get_data(
-                    self._hdl, self._types)
-                return 'Ready', True
-            raise
+            if inst.errno != hdllib.HP_HANDLE_NOT_FOUND \
+               or self._hashtable is not self._global_hashtable:
+                raise
         else:
-            return 'Ready', True
+            if key:
+                cache.put(key, self._items, hdllib.cache_period(self._items))
+            return
+        # Retry using a local handle server
+        authority = hdllib.get_authority(self._hdl)
+        data = cache.get(hdllib.table_key(authority))
+        if data is None:
+            ht = self._global_hashtable
+            flags, items = yield self.query(
+                ht, *hdllib.local_hash_table_request(authority))
+            data, handle = hdllib.service_items(items)
+            if not data and handle:
+                flags, items = yield self.query(
+                    ht, handle, [hdllib.HDL_TYPE_SERVICE_POINTER])
+                data, handle = hdllib.service_items(items)
+            if not data:
+                raise hdllib.Error("Didn't get a hash table")
+            cache.put(hdllib.table_key(authority), data,
+                      hdllib.DEFAULT_TABLE_TTL)
+        self._hashtable = hdllib.HashTable(data=data)
+        flags, self._items = yield self.query(
+            self._hashtable, self._hdl, self._types)
+        if key:
+            cache.put(key, self._items, hdllib.cache_period(self._items))
+
+    def pollmeta(self):
+        nullAPI.null_access.pollmeta(self)
+        mine = self._query
+        finished = resolver.poll()
+        while self._query is not None and self._query.done:
+            query = self._query
+            self._query = None
+            try:
+                if query.error is not None:
+                    self._query = self._steps.throw(query.error)
+                else:
+                    self._query = self._steps.send(query.result())
+            except StopIteration:
+                pass
+        if [query for query in finished if query is not mine]:
+            # Those queries' readers may not see the socket readable
+            resolver.wakeup()
+        if self._query is not None:
+            return 'Resolving handle', False
+        return 'Ready', True
+
+    def fileno(self):
+        if self._fd < 0:
+            self._fd = os.dup(resolver.fileno())
+        return self._fd
+
+    def close(self):
+        if self._query is not None:
+            if self._query is not self._global_query:
+                resolver.cancel(self._query)
+            self._query = None
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
 
     def getmeta(self):
+        while not self.pollmeta()[1]:
+            resolver.wait(self._query)
         nullAPI.null_access.getmeta(self)
         self._data = b""
         self._pos = 0
@@ -183,7 +310,7 @@ class hdl_access(nullAPI.null_access):
                             hdllib.HDL_TYPE_SERVICE_HANDLE):
                     uri = hdllib.hexstr(uri)
                 else:
-                    uri = escape(repr(uri))
+                    uri = saxutils.escape(repr(uri))
                 if type in hdllib.data_map:
                     type = hdllib.data_map[type][9:]
                 else:
@@ -215,3 +342,152 @@ class hdl_access(nullAPI.null_access):
 # hdl:cnri.dlib/november95
 # hdl:nonreg.guido/python-home-page
 # hdl:nonreg.guido/python-ftp-dir
+
+
+class Test(unittest.TestCase):
+
+    """Resolve handles against local stand-in handle servers.
+
+    Run with "python -m unittest grail.protocols.hdlAPI".
+    """
+
+    def setUp(self):
+        self.local = hdllib.StandInServer(
+            {b'local/1': [(hdllib.HDL_TYPE_URL, b'http://local/1')]})
+        self.server = hdllib.StandInServer(
+            {b'ha.auth/local': [(hdllib.HDL_TYPE_SERVICE_POINTER,
+                                 self.local.service_pointer())],
+             b'test/1': [(hdllib.HDL_TYPE_URL, b'http://test/1')],
+             b'test/2': [(hdllib.HDL_TYPE_URL, b'http://test/2'),
+                         (hdllib.HDL_TYPE_URL, b'http://test/2a')]},
+            delays={b'test/1': 0.2})
+        # The global hash table points at the server itself
+        self.server.handles[b'/service-pointer'] = [
+            (hdllib.HDL_TYPE_SERVICE_POINTER, self.server.service_pointer())]
+        hdl_access._global_server = self.server.address
+        hdl_access._global_hashtable = None
+        global cache
+        self.saved_cache = cache
+        cache = hdllib.ResolutionCache()
+
+    def tearDown(self):
+        global cache
+        del hdl_access._global_server
+        hdl_access._global_hashtable = None
+        cache = self.saved_cache
+        resolver.close()
+        self.server.close()
+        self.local.close()
+
+    def runTest(self):
+        apis = [hdl_access(hdl, 'GET', {})
+                for hdl in ('test/1', 'test/2', 'local/1')]
+        pending = list(apis)
+        while pending:
+            readable = select.select(pending, [], [], 1)[0]
+            self.assertTrue(readable)
+            for api in readable:
+                if api.pollmeta()[1]:
+                    pending.remove(api)
+        metas = [api.getmeta() for api in apis]
+        for api in apis:
+            api.close()
+        self.assertEqual(metas[0], (302, 'Moved',
+                                    {'location': 'http://test/1'}))
+        self.assertEqual(metas[1][0], 200)
+        self.assertEqual(metas[2], (302, 'Moved',
+                                    {'location': 'http://local/1'}))
+        # the global hash table was only fetched once
+        self.assertEqual(self.server.requests.count(b'/service-pointer'), 1)
+
+
+class StubResolver:
+
+    """Answer queries from a dictionary of servers, by port, and their
+    handles; record the queries."""
+
+    after = False
+
+    def __init__(self, servers):
+        self.servers = servers
+        self.queries = []
+
+    def query(self, hashtable, hdl, types=[], flags=[], timeout=30,
+              interval=5, command=hdllib.HP_QUERY,
+              response=hdllib.HP_QUERY_RESPONSE):
+        self.queries.append(hdl)
+        query = hdllib.Query(hdl, None, 0, b'', timeout, interval, response)
+        handles = self.servers[hashtable.hash_handle(hdl)[3]]
+        if hdl in handles:
+            query.responses[1] = (b'\0', handles[hdl])
+            query.done = True
+        else:
+            query.fail(hdllib.Error('HP_HANDLE_NOT_FOUND',
+                                    hdllib.HP_HANDLE_NOT_FOUND))
+        return query
+
+    def poll(self):
+        return []
+
+
+class CacheTest(unittest.TestCase):
+
+    """Warm resolutions come from the cache, without queries."""
+
+    def setUp(self):
+        global resolver, cache
+        self.saved = resolver, cache
+        resolver = self.resolver = StubResolver({
+            hdllib.DEFAULT_UDP_PORT: {
+                b'/service-pointer': [(hdllib.HDL_TYPE_SERVICE_POINTER,
+                                       hdllib.make_service_pointer(
+                                           '127.0.0.1', 1))]},
+            1: {b'ha.auth/local': [(hdllib.HDL_TYPE_SERVICE_POINTER,
+                                    hdllib.make_service_pointer(
+                                        '127.0.0.1', 2))],
+                b'test/1': [(hdllib.HDL_TYPE_URL, b'http://test/1')]},
+            2: {b'local/1': [(hdllib.HDL_TYPE_URL, b'http://local/1')],
+                b'local/2': [(hdllib.HDL_TYPE_URL, b'http://local/2')]}})
+        cache = self.cache = hdllib.ResolutionCache(max_entries=4)
+        hdl_access._global_hashtable = None
+
+    def tearDown(self):
+        global resolver, cache
+        resolver, cache = self.saved
+        hdl_access._global_hashtable = None
+
+    def resolve(self, hdl):
+        del self.resolver.queries[:]
+        api = hdl_access(hdl, 'GET', {})
+        meta = api.getmeta()
+        api.close()
+        return meta, self.resolver.queries
+
+    def runTest(self):
+        self.assertEqual(self.resolve('test/1'),
+                         ((302, 'Moved', {'location': 'http://test/1'}),
+                          [b'/service-pointer', b'test/1']))
+        self.assertEqual(self.resolve('TEST/1'),
+                         ((302, 'Moved', {'location': 'http://test/1'}), []))
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+
+        # The local hash table is cached too
+        self.assertEqual(self.resolve('local/1')[1],
+                         [b'local/1', b'ha.auth/local', b'local/1'])
+        self.assertEqual(self.resolve('local/2')[1],
+                         [b'local/2', b'local/2'])
+        self.assertEqual(self.resolve('local/1')[1], [])
+
+        # The least recently used entry, the global hash table, was
+        # evicted; cached handles still need no queries
+        hdl_access._global_hashtable = None
+        self.assertEqual(len(self.cache), 4)
+        self.assertEqual(self.resolve('local/2')[1], [])
+        self.assertEqual(self.resolve('test/1')[1], [])
+        self.assertIsNone(self.cache.get(hdllib.table_key(b'')))
+
+        # Entries expire
+        key = hdllib.handle_key(b'local/1', HANDLE_TYPES)
+        later = time.time() + hdllib.DEFAULT_HANDLE_TTL + 1
+        self.assertIsNotNone(self.cache.get(key))
+        self.assertIsNone(self.cache.get(key, later))
@@ -1,37 +1,64 @@
 """Provisional HTTP interface using the new protocol API.
 
 XXX This was hacked together in an hour so I would have something to
-test ProtocolAPI.py.  Especially the way it uses knowledge about the
-internals of httplib.HTTP is disgusting (but then, so would editing
-the source of httplib.py be :-).
+test ProtocolAPI.py.  It still borrows http.client.HTTPConnection for
+making the connection, but writes the request and reads the response
+on the raw socket itself.
+
+Requests are sent as HTTP/1.1.  The response body is framed by one of
+the *Body classes below: by Content-Length, by the chunked
+transfer-coding, or (HTTP/1.0 style) by the server closing the
+connection.  Framing and transfer-coding are removed before the data
+is handed to the caller.
+
+Connections are kept alive and shared between requests to the same
+(scheme, host, port) through the module-level ConnectionPool.  A
+connection is only handed back to the pool when the response body was
+delimited by its framing and has been read completely, and neither
+side asked for the connection to be closed.
+
+If the application has a cookie database (app.cookies, a
+cookielib.CookieDB), requests carry the matching cookies and
+Set-Cookie headers in responses are stored in it.
 
 XXX Main deficiencies:
 
-- poll*() always returns ready
 - should read the headers more carefully (no blocking)
-- (could even *write* the headers more carefully)
 - should poll the connection making part too
 
 """
 
 
 import http.client
-from urllib.parse import splithost
+from urllib.parse import splithost, splitport, urlsplit
 import email.parser
 from .. import grailutil
+from .. import cookielib
 import select
 from .. import Reader
 import re
 import socket
+import time
+import unittest
 from .. import GRAILVERSION
 
 
-replypat = br'HTTP/1\.[0-9.]+[ \t]+([0-9][0-9][0-9])(.*)'
+replypat = br'HTTP/(1\.[0-9.]+)[ \t]+([0-9][0-9][0-9])(.*)'
 replyprog = re.compile(replypat)
 
 
 # Search for blank line following HTTP headers
 endofheaders = re.compile(br'\n[ \t]*\r?\n')
+# ... or for a header section that is empty
+noheaders = re.compile(br'[ \t]*\r?\n')
+
+
+# Protocol version sent with each request
+HTTP_VSN_STR = 'HTTP/1.1'
+
+# Seconds an idle connection is kept in the pool, unless the server
+# announces a shorter timeout in its Keep-Alive header
+KEEPALIVE_TIMEOUT = 15
 
 
 # Stages
@@ -55,14 +82,265 @@ def simplereply(url):
     return 200, "OK", headers
 
 
+def parse_keepalive(s):
+    """Return the (timeout, max) parameters of a Keep-Alive header.
+
+    Missing or malformed parameters are returned as None.
+    """
+    params = {}
+    for elt in s.split(','):
+        name, _, value = elt.partition('=')
+        try:
+            params[name.strip().lower()] = int(value.strip())
+        except ValueError:
+            pass
+    return params.get('timeout'), params.get('max')
+
+
+def idle_socket_ok(sock):
+    """Return True if an idle kept-alive socket may be used again.
+
+    An idle socket should have nothing to read; if it is readable, the
+    server has either closed its end or sent something unsolicited.
+    """
+    try:
+        return not select.select([sock], [], [], 0)[0]
+    except (OSError, ValueError):
+        return False
+
+
+class ConnectionPool:
+
+    """Idle persistent connections, keyed by (scheme, host, port).
+
+    An access object checks a connection out with get() for the
+    duration of one request and returns it with put() once the response
+    has been read completely.  Idle connections are retired when their
+    keep-alive deadline passes, when the server closes them, or when
+    more than the allowed number are idle for one key.
+
+    The number of requests in progress is limited by the application's
+    SocketQueue; idle connections don't count against that limit, but
+    http_access never keeps more of them per key than the SocketQueue
+    allows to be open.
+
+    """
+
+    def __init__(self, timeout=KEEPALIVE_TIMEOUT):
+        self.timeout = timeout
+        self.idle = {}          # key -> [(deadline, connection), ...]
+        self.opened = 0         # number of connections made
+        self.reused = 0         # number of requests on a kept-alive one
+        self.after = None       # Tk-style scheduler for retire_idle()
+        self.timer_pending = False
+
+    def get(self, key, conn):
+        """Return an idle connection for key, or connect conn."""
+        self.retire_idle()
+        conns = self.idle.get(key)
+        while conns:
+            deadline, idle = conns.pop()
+            if not conns:
+                del self.idle[key]
+            if idle_socket_ok(idle.sock):
+                self.reused = self.reused + 1
+                return idle
+            idle.close()
+        conn.connect()
+        self.opened = self.opened + 1
+        return conn
+
+    def put(self, key, conn, timeout=None, limit=None):
+        """Keep conn for reuse by the next request for key."""
+        if timeout is None or timeout > self.timeout:
+            timeout = self.timeout
+        conns = self.idle.setdefault(key, [])
+        conns.append((time.time() + timeout, conn))
+        if limit is not None:
+            while len(conns) > limit:
+                conns.pop(0)[1].close()
+        if self.after and not self.timer_pending:
+            self.timer_pending = True
+            self.after(int(self.timeout * 1000), self.__timer)
+
+    def __timer(self):
+        self.timer_pending = False
+        self.retire_idle()
+        if self.idle and self.after:
+            self.timer_pending = True
+            self.after(int(self.timeout * 1000), self.__timer)
+
+    def retire_idle(self, now=None):
+        """Close idle connections whose keep-alive deadline has passed."""
+        if now is None:
+            now = time.time()
+        for key, conns in list(self.idle.items()):
+            keep = []
+            for deadline, conn in conns:
+                if deadline > now:
+                    keep.append((deadline, conn))
+                else:
+                    conn.close()
+            if keep:
+                self.idle[key] = keep
+            else:
+                del self.idle[key]
+
+    def close(self):
+        """Close all idle connections."""
+        for conns in self.idle.values():
+            for deadline, conn in conns:
+                conn.close()
+        self.idle.clear()
+
+
+# Shared by http_access and https_access
+pool = ConnectionPool()
+
+
+# Body framing.  A body object takes the response body out of the raw
+# bytes received after the headers.  read() consumes from a buffer of
+# received bytes; passthrough() tells how many bytes may be read from
+# the socket and handed to the caller as they are, which avoids copying
+# the body through the buffer wherever the framing allows.  ready()
+# tells whether read() would return data or find the end of the body.
+
+class UntilCloseBody:
+
+    """Body delimited by the server closing the connection."""
+
+    delimited = False
+
+    def __init__(self):
+        self.done = False
+
+    def read(self, buf, maxbytes):
+        data = bytes(buf[:maxbytes])
+        del buf[:maxbytes]
+        return data
+
+    def ready(self, buf):
+        return self.done or bool(buf)
+
+    def passthrough(self, maxbytes):
+        return maxbytes
+
+    def consumed(self, nbytes):
+        pass
+
+    def eof(self):
+        self.done = True
+
+
+class ContentLengthBody(UntilCloseBody):
+
+    """Body of a known length."""
+
+    delimited = True
+
+    def __init__(self, length):
+        self.remaining = length
+        self.done = not length
+
+    def read(self, buf, maxbytes):
+        data = UntilCloseBody.read(self, buf, min(maxbytes, self.remaining))
+        self.consumed(len(data))
+        return data
+
+    def passthrough(self, maxbytes):
+        return min(maxbytes, self.remaining)
+
+    def consumed(self, nbytes):
+        self.remaining = self.remaining - nbytes
+        if not self.remaining:
+            self.done = True
+
+
+class ChunkedBody(UntilCloseBody):
+
+    """Body in the chunked transfer-coding.
+
+    The chunk-size lines, chunk extensions and trailer are dropped; only
+    the chunk data is returned.
+
+    """
+
+    delimited = True
+
+    # States
+    SIZE = 'size'           # expecting a chunk-size line
+    CHUNK = 'chunk'         # inside chunk data
+    CRLF = 'crlf'           # expecting the line end after chunk data
+    TRAILER = 'trailer'     # reading trailer lines after the last chunk
+
+    def __init__(self):
+        self.done = False
+        self.state = self.SIZE
+        self.chunk = 0
+
+    def read(self, buf, maxbytes):
+        while not self.done:
+            if self.state == self.CHUNK:
+                data = UntilCloseBody.read(self, buf,
+                                           self.passthrough(maxbytes))
+                self.consumed(len(data))
+                return data
+            i = buf.find(b'\n')
+            if i < 0:
+                break
+            line = bytes(buf[:i]).strip()
+            if self.state == self.SIZE:
+                size = line.split(b';', 1)[0].strip()
+                try:
+                    chunk = int(size, 16)
+                except ValueError:
+                    chunk = -1
+                if chunk < 0:
+                    # The line stays in buf, so read() raises again
+                    raise IOError("bad chunk size in HTTP response",
+                                  line.decode('latin-1'))
+                self.chunk = chunk
+                self.state = self.CHUNK if chunk else self.TRAILER
+            elif self.state == self.CRLF:
+                self.state = self.SIZE
+            elif not line:
+                self.done = True
+            del buf[:i + 1]
+        return b''
+
+    def ready(self, buf):
+        # Consume the chunk-size lines and line ends that are complete,
+        # so that a buffer holding nothing else isn't taken for data.
+        try:
+            self.read(buf, 0)
+        except IOError:
+            return True                 # for read() to report it
+        return self.done or (self.state == self.CHUNK and bool(buf))
+
+    def passthrough(self, maxbytes):
+        if self.state == self.CHUNK:
+            return min(maxbytes, self.chunk)
+        return 0
+
+    def consumed(self, nbytes):
+        self.chunk = self.chunk - nbytes
+        if not self.chunk:
+            self.state = self.CRLF
+
+
 class http_access:
 
+    scheme = 'http'
+    connection_class = http.client.HTTPConnection
+
     def __init__(self, resturl, method, params, data=None):
         self.app = grailutil.get_grailapp()
         self.args = (resturl, method, params, data)
         self.state = WAIT
         self.h = None
         self.reader_callback = None
+        if pool.after is None and hasattr(self.app, 'root'):
+            pool.after = self.app.root.after
         self.app.sq.request_socket(self, self.open)
 
     def register_reader(self, reader_callback, ignore):
@@ -93,48 +371,123 @@ class http_access:
         else:
             host = user_passwd
             auth = None
-        self.h = http.client.HTTPConnection(host)
-
-        # Grail does not currently seem to handle HTTP 1.1's persistent
-        # connections, nor chunked transfer encoding
-        self.h._http_vsn = 10
-        self.h._http_vsn_str = 'HTTP/1.0'
 
-        self.h.putrequest(method, self.selector)
-        self.h.putheader('User-agent', GRAILVERSION)
+        headers = ['{} {} {}'.format(method, self.selector or '/',
+                                     HTTP_VSN_STR)]
+        headers.append('User-agent: ' + GRAILVERSION)
         if auth:
-            self.h.putheader('Authorization', 'Basic {}'.format(auth))
+            headers.append('Authorization: Basic {}'.format(auth))
         if 'host' not in params:
-            self.h.putheader('Host', host)
+            headers.append('Host: ' + host)
         if 'accept-encoding' not in params:
             encodings = Reader.get_content_encodings()
             if encodings:
                 encodings.sort()
-                self.h.putheader('Accept-Encoding', ", ".join(encodings))
+                headers.append('Accept-Encoding: ' + ", ".join(encodings))
         for key, value in params.items():
             if not key.startswith('.'):
-                self.h.putheader(key, value)
-        self.h.putheader('Accept', '*/*')
-        self.h.endheaders()
+                headers.append('{}: {}'.format(key, value))
+        self.cookie_url = self.cookie_target(host)
+        cookie = self.find_cookies(params)
+        if cookie:
+            headers.append('Cookie: ' + cookie)
+        headers.append('Accept: */*')
         if data:
-            self.h.send(data)
-        self.readahead = bytearray()
+            headers.append('Content-Length: {}'.format(len(data)))
+        headers.append('\r\n')
+        self.request = '\r\n'.join(headers).encode('latin-1')
+        if data:
+            if isinstance(data, str):
+                data = data.encode('latin-1')
+            self.request = self.request + data
+
+        h = self.connection_class(host)
+        self.key = (self.scheme, h.host, h.port)
+        self.send_request(h)
         self.state = META
-        self.line1seen = False
-        self.reply = None
         if self.reader_callback:
             self.reader_callback()
 
-    def close(self):
-        if self.h:
+    def cookie_target(self, host):
+        """Return the host and path of the URL, for cookies."""
+        if '://' in self.selector:
+            # Full URL for a proxy
+            url = urlsplit(self.selector)
+            return (url.hostname or '').lower(), url.path or '/'
+        path = self.selector.partition('?')[0]
+        return splitport(host)[0].lower(), path or '/'
+
+    def find_cookies(self, params):
+        """Return the Cookie header for the request, if any."""
+        cookies = getattr(self.app, 'cookies', None)
+        if cookies is None \
+           or any(key.lower() == 'cookie' for key in params):
+            return None
+        host, path = self.cookie_url
+        return '; '.join('{}={}'.format(cookie.name, cookie.value)
+                         for cookie in cookies.lookup(
+                             host, path, self.scheme == 'https'))
+
+    def store_cookies(self, headers):
+        """Store the cookies a response sets."""
+        cookies = getattr(self.app, 'cookies', None)
+        values = headers.get_all('set-cookie')
+        if cookies is None or not values:
+            return
+        host, path = self.cookie_url
+        for value in values:
+            try:
+                for cookie in cookielib.parse_cookies(value):
+                    if not cookie.domain:
+                        cookie.domain = host
+                    elif not ('.' + host).endswith(cookie.domain):
+                        # not for us to set
+                        continue
+                    if not cookie.path:
+                        cookie.path = path[:path.rfind('/')] or '/'
+                    cookies.set_cookie(cookie)
+            except (ValueError, cookielib.Error):
+                # ignore the rest of a malformed header
+                pass
+
+    def send_request(self, h):
+        """Send the request, on a pooled connection if there is one."""
+        self.h = pool.get(self.key, h)
+        self.reused = self.h is not h
+        self.readahead = bytearray()
+        self.line1seen = False
+        self.reply = None
+        self.keepalive = False
+        self.keepalive_timeout = None
+        self.body = None
+        try:
+            self.h.send(self.request)
+        except OSError:
+            if not self.reused:
+                raise
+            # The server dropped the idle connection; try a new one
             self.h.close()
+            self.send_request(self.connection_class(*self.key[1:]))
+
+    def close(self):
+        h = self.h
+        self.h = None
+        if h:
+            if self.keepalive and self.body and self.body.done \
+               and not self.readahead:
+                pool.put(self.key, h, self.keepalive_timeout,
+                         self.app.sq.max)
+            else:
+                h.close()
         if self.state != CLOS:
             self.app.sq.return_socket(self)
             self.state = CLOS
-        self.h = None
 
     def pollmeta(self, timeout=0):
         assert self.state == META
+        if self.reply:
+            # Already complete; there may be nothing more to read
+            return "received server response", True
 
         sock = self.h.sock
         try:
@@ -142,35 +495,97 @@ class http_access:
                 return "waiting for server response", False
         except select.error as msg:
             raise IOError(msg) from msg
-        new = sock.recv(1024)
+        try:
+            new = sock.recv(1024)
+        except ConnectionResetError:
+            if not (self.reused and not self.readahead):
+                raise
+            new = b''
         if not new:
+            if self.reused and not self.readahead \
+               and self.args[1] != 'POST':
+                # A kept-alive connection was closed by the server
+                # before it saw our request; resend on a new one.
+                self.h.close()
+                self.send_request(self.connection_class(*self.key[1:]))
+                return "waiting for server response", False
             self.reply = simplereply(self.selector)
+            self.body = UntilCloseBody()
             return "EOF in server response", True
         self.readahead.extend(new)
-        if b'\n' not in new:
-            return "receiving server response", False
-        if not self.line1seen:
-            self.line1seen = True
-            line, rest = self.readahead.split(b'\n', 1)
-            m = replyprog.match(line)
+        return self.parse_reply()
+
+    def parse_reply(self):
+        while b'\n' in self.readahead:
+            if not self.line1seen:
+                self.line1seen = True
+                line, rest = self.readahead.split(b'\n', 1)
+                m = replyprog.match(line)
+                if not m:
+                    # Not an HTTP/1.x response.  Fall back to HTTP/0.9.
+                    self.reply = simplereply(self.selector)
+                    self.body = UntilCloseBody()
+                    return "received non-HTTP/1.x server response", True
+                self.version, self.errcode, self.errmsg = m.group(1, 2, 3)
+                self.version = self.version.decode('latin-1')
+                self.errcode = int(self.errcode)
+                self.errmsg = self.errmsg.decode('latin-1').strip()
+                self.readahead = rest
+            m = noheaders.match(self.readahead) \
+                or endofheaders.search(self.readahead)
             if not m:
-                # Not an HTTP/1.0 response.  Fall back to HTTP/0.9.
-                self.reply = simplereply(self.selector)
-                return "received non-HTTP/1.0 server response", True
-            self.errcode, self.errmsg = m.group(1, 2)
-            self.errcode = int(self.errcode)
-            self.errmsg = self.errmsg.decode('latin-1').strip()
-            self.readahead = rest
-        m = endofheaders.search(self.readahead)
-        if m and m.start() >= 0:
+                break
             headers = self.readahead[:m.end()].decode('latin-1')
             del self.readahead[:m.end()]
+            if 100 <= self.errcode < 200:
+                # Interim response; the final one follows
+                self.line1seen = False
+                continue
             parser = email.parser.Parser()
             headers = parser.parsestr(headers, headersonly=True)
+            self.check_framing(headers)
+            self.store_cookies(headers)
             self.reply = self.errcode, self.errmsg, headers
             return "received server response", True
         return "receiving server response", False
 
+    def check_framing(self, headers):
+        """Find out where the body ends and if the connection persists."""
+        codings = [coding.strip().lower() for coding
+                   in headers.get('transfer-encoding', '').split(',')]
+        if self.errcode in (204, 304):
+            self.body = ContentLengthBody(0)
+        elif codings != ['']:
+            # Transfer-Encoding overrides Content-Length, which must not
+            # be used for progress reports either
+            del headers['content-length']
+            if codings[-1] == 'chunked':
+                self.body = ChunkedBody()
+            else:
+                self.body = UntilCloseBody()
+        else:
+            try:
+                length = int(headers.get('content-length'))
+            except (TypeError, ValueError):
+                length = -1
+            if length >= 0:
+                self.body = ContentLengthBody(length)
+            else:
+                self.body = UntilCloseBody()
+        tokens = {token.strip().lower()
+                  for token in headers.get('connection', '').split(',')}
+        if self.version == '1.0':
+            self.keepalive = 'keep-alive' in tokens
+        else:
+            self.keepalive = 'close' not in tokens
+        if 'keep-alive' in headers:
+            timeout, max = parse_keepalive(headers['keep-alive'])
+            self.keepalive_timeout = timeout
+            if max is not None and max < 1:
+                self.keepalive = False
+        if not self.body.delimited:
+            self.keepalive = False
+
     def getmeta(self):
         assert self.state == META
         if not self.reply:
@@ -182,25 +597,280 @@ class http_access:
 
     def polldata(self):
         assert self.state == DATA
-        if self.readahead:
+        body = self.body
+        if body.done:
+            return "end of data", True
+        if body.ready(self.readahead):
             return "processing readahead data", True
-        return ("waiting for data",
-                bool(select.select([self], [], [], 0)[0]))
+        if not select.select([self], [], [], 0)[0]:
+            return "waiting for data", False
+        if body.passthrough(1):
+            return "waiting for data", True
+        # The body's framing comes next; read it here, since what is
+        # on the socket may be all framing and getdata() would block
+        # for the data after it.
+        new = self.h.sock.recv(1024)
+        if not new:
+            return "end of data", True  # for getdata() to find
+        self.readahead.extend(new)
+        return "processing readahead data", body.ready(self.readahead)
 
     def getdata(self, maxbytes):
         assert self.state == DATA
-        if self.readahead:
-            data = self.readahead[:maxbytes]
-            self.readahead = self.readahead[maxbytes:]
-            return data
-        data = self.h.sock.recv(maxbytes)
-        if not data:
-            self.state = DONE
-            # self.close()
-        return data
+        body = self.body
+        while True:
+            if self.readahead:
+                data = body.read(self.readahead, maxbytes)
+                if data:
+                    return data
+            if body.done:
+                self.state = DONE
+                return b''
+            n = body.passthrough(maxbytes)
+            data = self.h.sock.recv(n or maxbytes)
+            if not data:
+                body.eof()
+                self.keepalive = False
+                self.state = DONE
+                # self.close()
+                return data
+            if n:
+                body.consumed(len(data))
+                return data
+            self.readahead.extend(data)
 
     def fileno(self):
         return self.h.sock.fileno()
 
 
+class Test(unittest.TestCase):
+
+    """Fetch several documents from a local server and count connections.
+
+    Run with "python -m unittest grail.protocols.httpAPI".
+    """
+
+    def setUp(self):
+        import http.server
+        import threading
+        from ..grailbase import app
+        from ..Grail import SocketQueue
+
+        body = b'<p>spam' * 100
+        self.connections = connections = []
+        self.cookies = cookies = []
+        self.go_on = go_on = threading.Event()
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                connections.append(self.client_address)
+                super().setup()
+
+            def do_GET(self):
+                cookies.append(self.headers.get('Cookie'))
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html')
+                if self.path.startswith('/login/'):
+                    self.send_header('Set-Cookie', 'session=42')
+                    self.send_header('Set-Cookie',
+                                     'user=spam; Path=/; Expires='
+                                     'Fri, 01 Jan 2100 00:00:00 GMT')
+                if self.path.startswith('/long-headers/'):
+                    self.send_header('X-Padding',
+                                     'x' * int(self.path.split('/')[-1]))
+                if self.path == '/chunked':
+                    self.send_header('Transfer-Encoding', 'chunked')
+                    self.end_headers()
+                    for i in range(0, len(body), 300):
+                        chunk = body[i:i + 300]
+                        self.wfile.write(b'%x;ext=1\r\n' % len(chunk)
+                                         + chunk + b'\r\n')
+                    self.wfile.write(b'0\r\nX-Trailer: spam\r\n\r\n')
+                elif self.path == '/chunked-slow':
+                    # The chunk-size line, then the data when told to
+                    self.send_header('Transfer-Encoding', 'chunked')
+                    self.end_headers()
+                    self.wfile.write(b'%x\r\n' % len(body))
+                    go_on.wait(10)
+                    self.wfile.write(body + b'\r\n0\r\n\r\n')
+                else:
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.body = body
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                      Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        if not grailutil.get_grailapp():
+            app.Application()
+        self.app = grailutil.get_grailapp()
+        if not hasattr(self.app, 'sq'):
+            self.app.sq = SocketQueue(5)
+        pool.close()
+
+    def tearDown(self):
+        pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def fetch(self, path):
+        url = '//{}:{}{}'.format(*self.server.server_address, path)
+        api = http_access(url, 'GET', {})
+        errcode, errmsg, headers = api.getmeta()
+        return errcode, self.read(api)
+
+    def read(self, api):
+        data = bytearray()
+        while True:
+            message, ready = api.polldata()
+            if not ready:
+                select.select([api], [], [], 1)
+                continue
+            buf = api.getdata(512)
+            if not buf:
+                break
+            data.extend(buf)
+        api.close()
+        return bytes(data)
+
+    def runTest(self):
+        opened = pool.opened
+        for i in range(10):
+            self.assertEqual(self.fetch('/image{}.gif'.format(i)),
+                             (200, self.body))
+        self.assertEqual(self.fetch('/chunked'), (200, self.body))
+        self.assertEqual(self.fetch('/'), (200, self.body))
+        self.assertEqual(len(self.connections), 1)
+        self.assertEqual(pool.opened - opened, 1)
+
+        # An idle connection past its deadline is retired
+        pool.retire_idle(time.time() + KEEPALIVE_TIMEOUT + 1)
+        self.assertEqual(pool.idle, {})
+        self.fetch('/')
+        self.assertEqual(len(self.connections), 2)
+
+
+class CookieTest(Test):
+
+    """Cookies set by a response are sent with later requests."""
+
+    def runTest(self):
+        self.app.cookies = cookielib.CookieDB()
+        try:
+            self.fetch('/login/form')
+            self.fetch('/login/next')
+            self.fetch('/other')
+        finally:
+            del self.app.cookies
+        self.assertEqual(self.cookies,
+                         [None, 'session=42; user=spam', 'user=spam'])
+
+
+class ReaderTest(Test):
+
+    """A response with headers longer than one read, through a BaseReader."""
+
+    def runTest(self):
+        import tkinter
+        from ..BaseReader import BaseReader, BareContext
+
+        class Reader(BaseReader):
+            meta = None
+            done = False
+
+            def __init__(self, context, api):
+                self.data = bytearray()
+                BaseReader.__init__(self, context, api)
+
+            def handle_meta(self, errcode, errmsg, headers):
+                self.meta = errcode, len(headers['x-padding'])
+                BaseReader.handle_meta(self, errcode, errmsg, headers)
+
+            def handle_data(self, data):
+                self.data.extend(data)
+
+            def handle_eof(self):
+                self.done = True
+
+        root = tkinter.Tcl()
+        # The reply is complete after an odd and an even number of reads
+        for padding in (3000, 4000):
+            url = '//{}:{}/long-headers/{}'.format(
+                *self.server.server_address, padding)
+            reader = Reader(BareContext(root), http_access(url, 'GET', {}))
+            deadline = time.time() + 10
+            while not reader.done and time.time() < deadline:
+                root.update()
+                time.sleep(0.01)
+            reader.stop()
+            self.assertEqual(reader.meta, (200, padding))
+            self.assertEqual(reader.data, self.body)
+            self.assertTrue(reader.done)
+
+
+class SlowChunkedTest(Test):
+
+    """A chunk-size line arriving without its data isn't ready."""
+
+    def runTest(self):
+        url = '//{}:{}/chunked-slow'.format(*self.server.server_address)
+        api = http_access(url, 'GET', {})
+        api.getmeta()
+        deadline = time.time() + 0.5
+        while time.time() < deadline:
+            self.assertFalse(api.polldata()[1])
+            time.sleep(0.05)
+        self.assertEqual(api.readahead, b'')
+        self.go_on.set()
+        self.assertEqual(self.read(api), self.body)
+
+
+class ChunkedTest(unittest.TestCase):
+
+    def runTest(self):
+        """Decode a chunked body arriving one byte at a time."""
+        raw = b'5\r\nhello\r\n7;name=val\r\n, world\r\n0\r\n\r\nnext'
+        body = ChunkedBody()
+        buf = bytearray()
+        data = bytearray()
+        for i in range(len(raw)):
+            buf.append(raw[i])
+            data.extend(body.read(buf, 3))
+            if body.done:
+                break
+        self.assertEqual(data, b'hello, world')
+        self.assertTrue(body.done)
+        self.assertEqual(raw[i + 1:], b'next')
+        with self.assertRaises(IOError):
+            ChunkedBody().read(bytearray(b'zz\r\n'), 10)
+
+        # Framing alone isn't ready; it is used up waiting for the data
+        body = ChunkedBody()
+        buf = bytearray(b'5\r\n')
+        self.assertFalse(body.ready(buf))
+        self.assertEqual(buf, b'')
+        buf.extend(b'hel')
+        self.assertTrue(body.ready(buf))
+        self.assertEqual(body.read(buf, 10), b'hel')
+        buf.extend(b'lo\r\n')
+        self.assertEqual(body.read(buf, 10), b'lo')
+        buf.extend(b'0\r\n')
+        self.assertFalse(body.ready(buf))
+        buf.extend(b'\r\n')
+        self.assertTrue(body.ready(buf))
+        self.assertTrue(body.done)
+        # A bad chunk size is left for read() to report
+        buf = bytearray(b'zz\r\n')
+        self.assertTrue(ChunkedBody().ready(buf))
+        self.assertEqual(buf, b'zz\r\n')
+
+
 # To test this, use ProtocolAPI.test()
@@ -456,7 +456,7 @@ class HTMLParser(SGMLHandler.BaseSGMLHandler):
                     self.sgml_parser.lex_endtag(stack[0])
                     stack = self.sgml_parser.get_context('p')
                 # XXX this is really evil!
-                self.sgml_parser.stack.pop()
+                self.sgml_parser.pop_stack()
             return
         self.element_close_maybe('p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6')
         self.formatter.end_paragraph(parbreak)
@@ -481,7 +481,7 @@ class HTMLParser(SGMLHandler.BaseSGMLHandler):
                 self.sgml_parser.lex_endtag(stack[0])
                 stack = self.sgml_parser.get_context('p')
             #  Remove <P> surgically:
-            self.sgml_parser.stack.pop()
+            self.sgml_parser.pop_stack()
             self.para_end(parbreak=0)
         else:
             self.formatter.add_line_break()
@@ -895,8 +895,9 @@ class HTMLParser(SGMLHandler.BaseSGMLHandler):
         self.formatter.pop_style()
 
     def start_a(self, attrs):
-        if self.get_object():
-            self.get_object().anchor(attrs)
+        object = self.get_object()
+        if object:
+            object.anchor(attrs)
             return
         href = attrs.get('href', '').strip()
         name = extract_keyword('name', attrs, '', conv=conv_normstring)
@@ -1174,6 +1175,7 @@ class HTMLParser(SGMLHandler.BaseSGMLHandler):
 
 
 class DummyTagInfo(SGMLHandler.TagInfo):
+    __slots__ = ()
 
     def __init__(self, tag):
         SGMLHandler.TagInfo.__init__(self, tag, None, None, None)
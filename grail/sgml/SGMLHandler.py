@@ -5,6 +5,7 @@ __version__ = "$Revision: 1.1 $"
 
 from . import SGMLLexer
 import functools
+import types
 
 
 class ElementHandler:
@@ -13,16 +14,46 @@ class ElementHandler:
         pass
 
     def get_taginfo(self, tag):
-        klass = type(self)
-        start = getattr(klass, "start_" + tag, None)
-        if start:
-            end = getattr(klass, "end_" + tag, None)
-            do = None
-        else:
-            end = None
-            do = getattr(klass, "do_" + tag, None)
-        if start or do:
-            return TagInfo(tag, start, do, end)
+        return self.get_tagtable().get(tag)
+
+    def get_taginfo_key(self):
+        """Return a key shared by handlers that give the same taginfo.
+
+        That is the class for handlers that look tags up in the class's
+        table, and None if the taginfo may be particular to this handler.
+        """
+        if type(self).get_taginfo is ElementHandler.get_taginfo:
+            return type(self)
+        return None
+
+    @classmethod
+    def get_tagtable(cls):
+        """Return a read-only mapping from tag names to TagInfo objects.
+
+        The mapping covers the start_, end_ and do_ methods of the class
+        and is built the first time it is asked for, once per class.
+        """
+        table = vars(cls).get('_ElementHandler__tagtable')
+        if table is None:
+            table = {}
+            for name in dir(cls):
+                action, sep, tag = name.partition('_')
+                if not (sep and tag) or action not in ('start', 'do'):
+                    continue
+                if tag in table:
+                    continue
+                start = getattr(cls, "start_" + tag, None)
+                if start:
+                    end = getattr(cls, "end_" + tag, None)
+                    do = None
+                else:
+                    end = None
+                    do = getattr(cls, "do_" + tag, None)
+                if start or do:
+                    table[tag] = TagInfo(tag, start, do, end)
+            table = types.MappingProxyType(table)
+            cls.__tagtable = table
+        return table
 
     def handle_endtag(self, tag, method):
         """
@@ -104,8 +135,8 @@ class CompositeHandler:
     This is intended to allow a simple class to extend the element set
     accepted by an instantiated gatherer without duplicating all the
     fundamental operations of the primary gatherer.  Both objects being
-    composed need to implement the get_taginfo() method; this may be
-    inherited from the ElementHandler class.
+    composed need to implement the get_taginfo() and get_taginfo_key()
+    methods; these may be inherited from the ElementHandler class.
 
     """
 
@@ -124,6 +155,7 @@ class CompositeHandler:
         self.doctype = primary.doctype
         self.__primary = primary
         self.__secondary = secondary
+        self.__handlers = primary, secondary
         for attr in ("handle_data", "handle_sdata", "handle_entityref",
                      "unknown_entityref", "unknown_endtag",
                      "unknown_starttag", "unknown_namedcharref",
@@ -132,33 +164,55 @@ class CompositeHandler:
                 setattr(self, attr, getattr(secondary, attr))
             else:
                 setattr(self, attr, getattr(primary, attr))
-        self.__tagmap = {}
+        # tag -> (taginfo, index of the handler in self.__handlers),
+        # shared by composites with the same taginfo key
+        key = self.get_taginfo_key()
+        if key is None:
+            self.__tagmap = {}
+        else:
+            self.__tagmap = self.__tagmaps.setdefault(key, {})
+
+    __tagmaps = {}
 
     def close(self):
         self.__secondary.close()
 
     def get_taginfo(self, tag):
+        try:
+            return self.__tagmap[tag][0]
+        except KeyError:
+            pass
         taginfo = self.__secondary.get_taginfo(tag)
         if taginfo:
-            self.__tagmap[tag] = self.__secondary
+            self.__tagmap[tag] = taginfo, 1
         else:
-            self.__tagmap[tag] = self.__primary
             taginfo = self.__primary.get_taginfo(tag)
+            self.__tagmap[tag] = taginfo, 0
         return taginfo
 
+    def get_taginfo_key(self):
+        primary = self.__primary.get_taginfo_key()
+        secondary = self.__secondary.get_taginfo_key()
+        if primary is None or secondary is None:
+            return None
+        return CompositeHandler, primary, secondary
+
     def handle_starttag(self, tag, method, attrs):
-        self.__tagmap[tag].handle_starttag(tag, method, attrs)
+        handler = self.__handlers[self.__tagmap[tag][1]]
+        handler.handle_starttag(tag, method, attrs)
 
     def handle_endtag(self, tag, method):
-        self.__tagmap[tag].handle_endtag(tag, method)
+        handler = self.__handlers[self.__tagmap[tag][1]]
+        handler.handle_endtag(tag, method)
 
 
 @functools.total_ordering
 class TagInfo:
-    container = True
+    __slots__ = ('tag', 'container', 'start', 'end')
 
     def __init__(self, tag, start, do, end):
         self.tag = tag
+        self.container = True
         if start:
             self.start = start
             self.end = end or _nullfunc
@@ -36,6 +36,7 @@ whitespace = '\\t\\n\x0b\x0c\\r '
 # and CDATA (character data -- only end tags are special).
 
 import re
+import unittest
 
 
 class SGMLError(Exception):
@@ -80,6 +81,21 @@ class SGMLLexerBase:
         """Return the current line number if known.
         """
 
+    def compiled(self, flag):
+        """Control use of the compiled tokenizer.
+
+        flag
+            Boolean indicating new setting of the tokenizer.
+
+        If `flag' is true, the common constructs are found by a single
+        compiled pattern matched once per token, instead of testing
+        for each kind of construct in turn.  The events reported are
+        the same either way.
+
+        A boolean indicating the previous value is returned.
+        """
+        pass
+
     def normalize(self, norm):
         """Control normalization of name tokens.
 
@@ -222,6 +238,7 @@ class SGMLLexer(SGMLLexerBase):
     entitydefs = {}
     _in_parse = False
     _finish_parse = False
+    _compiled = True
 
     def __init__(self):
         self.reset()
@@ -232,9 +249,27 @@ class SGMLLexer(SGMLLexerBase):
     def cleanup(self):
         pass
 
+    # The input is kept in rawdata, of which the first _pos characters
+    # have been lexed.  Fed data is collected in _pending and only
+    # added to rawdata, dropping the lexed part, when it is lexed in
+    # turn; that is put off while an incomplete construct waits for
+    # one of the characters in _waitfor.  A comment waits for its close
+    # instead: _searched is how far past its start it has been searched
+    # for one, and _tail what is left of it from there, where a close
+    # could still begin; only what is fed on top of that is searched.
     rawdata = ''
+    _pos = 0
+    _waitfor = ''
+    _searched = 0
+    _tail = ''
 
     def reset(self):
+        self.rawdata = ''
+        self._pos = 0
+        self._pending = []
+        self._waitfor = ''
+        self._searched = 0
+        self._tail = ''
         self.stack = []
         self.lasttag = '???'
         self.nomoretags = False
@@ -253,13 +288,31 @@ class SGMLLexer(SGMLLexerBase):
         return None
 
     def feed(self, data):
-        self.rawdata = self.rawdata + data
-        if not self._in_parse:
-            self._in_parse = True
-            self.goahead(False)
-            self._in_parse = False
-            if self._finish_parse:
-                self.cleanup()
+        if self._in_parse:
+            self.rawdata = self.rawdata + data  # goahead() picks it up
+            return
+        self._pending.append(data)
+        if self._searched:
+            data = self._tail + data
+            if not commentclose.search(data):
+                k = close_start(data, 0)
+                self._searched = self._searched + k
+                self._tail = data[k:]
+                return
+        else:
+            waitfor = self._waitfor
+            if waitfor and not any(c in data for c in waitfor):
+                return
+        self._in_parse = True
+        self.goahead(False)
+        self._in_parse = False
+        if self._finish_parse:
+            self.cleanup()
+
+    def compiled(self, flag):
+        prev = self._compiled
+        self._compiled = bool(flag)
+        return prev
 
     def normalize(self, norm):
         prev = self._normfunc is str.lower
@@ -267,19 +320,24 @@ class SGMLLexer(SGMLLexerBase):
         return prev
 
     def restrict(self, constrain):
+        self._waitfor = ''
+        self._searched = 0
         prev = not self._strict
         self._strict = not constrain
         return prev
 
     def setliteral(self, tag):
+        import re
         self.literal = True
-        re = "{}{}[{}]*{}".format(ETAGO, tag, whitespace, TAGC)
+        pattern = "{}{}[{}]*{}".format(ETAGO, tag, whitespace, TAGC)
         if self._normfunc is str.lower:
-            self._lit_etag_re = re.compile(re, re.IGNORECASE)
+            self._lit_etag_re = re.compile(pattern, re.IGNORECASE)
         else:
-            self._lit_etag_re = re.compile(re)
+            self._lit_etag_re = re.compile(pattern)
 
     def setnomoretags(self):
+        self._waitfor = ''
+        self._searched = 0
         self.nomoretags = True
 
     # Internal -- handle data as far as reasonable.  May leave state
@@ -287,8 +345,16 @@ class SGMLLexer(SGMLLexerBase):
     # true, force handling all data as if followed by EOF marker.
     def goahead(self, end):
         #print("goahead", self.rawdata)
-        i = 0
-        n = len(self.rawdata)
+        if self._pending:
+            self.rawdata = self.rawdata[self._pos:] + ''.join(self._pending)
+            self._pos = 0
+            del self._pending[:]
+        self._waitfor = ''
+        i = self._pos
+        if self._compiled:
+            i, n = self.scan(i, end)
+        else:
+            n = len(self.rawdata)
         while i < n:
             rawdata = self.rawdata  # pick up any appended data
             n = len(rawdata)
@@ -310,6 +376,7 @@ class SGMLLexer(SGMLLexerBase):
                     if pos >= 0:
                         self.lex_data(rawdata[i:pos])
                         i = pos
+                    self._waitfor = '<>'
                 break
             # pick up self._finish_parse as soon as possible:
             end = end or self._finish_parse
@@ -324,133 +391,194 @@ class SGMLLexer(SGMLLexerBase):
             if i == n:
                 break
             #print("interesting", j, i)
-            if rawdata[i] == '<':
-                #print("<", self.literal, rawdata[i:20])
-                if starttagopen.match(rawdata, i):
-                    # print("open")
-                    if self.literal:
-                        self.lex_data(rawdata[i])
-                        i = i + 1
-                        continue
-                    #print("parse_starttag", self.parse_starttag)
-                    k = self.parse_starttag(i)
+            k = self.parse_markup(i, end)
+            if k < 0:
+                break
+            i = k
+        # end while
+        n = len(self.rawdata)
+        if (end or self._finish_parse) and i < n:
+            self.lex_data(self.rawdata[i:n])
+            i = n
+            self._waitfor = ''
+        self._pos = i
+
+    # Internal -- handle data from i like goahead(), with one match of
+    # the tokens pattern per construct; the rarer ones are left to
+    # parse_markup().  Return the index reached and the length of the
+    # data goahead() is to carry on with, which is 0 if it is to stop
+    # there.  It carries on when the literal, nomoretags or strict mode
+    # is entered, since only goahead() handles those.
+    def scan(self, i, end):
+        while True:
+            rawdata = self.rawdata
+            n = len(rawdata)
+            if self.nomoretags or self.literal or self._strict:
+                return i, n
+            for match in tokens.finditer(rawdata, i):
+                kind = match.lastgroup
+                if kind == 'data':
+                    self.lex_data(match.group())
+                    i = match.end()
+                elif kind == 'starttag':
+                    tag = self._normfunc(match.group('stag'))
+                    attrs = {}
+                    k, j = match.span('attrs')
+                    if k < j:
+                        attrs, k = self.parse_attributes(k, j)
+                    self.lex_starttag(tag, attrs)
+                    if match.group('slash'):
+                        # using XML empty-tag hack
+                        self.lex_endtag(tag)
+                    i = match.end()
+                elif kind == 'endtag':
+                    self.lex_endtag(self._normfunc(match.group('etag')))
+                    self.literal = False
+                    i = match.end()
+                elif kind == 'entityref':
+                    self.lex_entityref(match.group('ename'),
+                                       match.group('eterm'))
+                    i = match.end()
+                elif kind == 'charref':
+                    terminator = match.group('cterm')
+                    ordinal = int(match.group('ordinal'))
+                    i = match.end()
+                    if terminator == '\n':
+                        self.lex_charref(ordinal, '')
+                        self.lex_data('\n')
+                    else:
+                        self.lex_charref(ordinal, terminator)
+                elif kind == 'comment':
+                    k = self.parse_comment(i, end or self._finish_parse)
                     if k < 0:
-                        break
-                    i = k
-                    continue
-                if endtagopen.match(rawdata, i):
-                    k = self.parse_endtag(i)
+                        return i, 0
+                    i = i + k
+                    break
+                else:
+                    k = self.parse_markup(i, end or self._finish_parse)
                     if k < 0:
-                        break
+                        return i, 0
                     i = k
+                    break
+                if (self.rawdata is not rawdata or self.nomoretags
+                        or self.literal or self._strict):
+                    break
+            else:
+                return i, 0
+
+    # Internal -- handle the markup or reference starting at i, which
+    # is at '<' or '&'.  Return the index after it, or -1 if it is not
+    # complete.
+    def parse_markup(self, i, end):
+        rawdata = self.rawdata
+        n = len(rawdata)
+        if rawdata[i] == '<':
+            #print("<", self.literal, rawdata[i:20])
+            if starttagopen.match(rawdata, i):
+                # print("open")
+                if self.literal:
+                    self.lex_data(rawdata[i])
+                    return i + 1
+                #print("parse_starttag", self.parse_starttag)
+                return self.parse_starttag(i)
+            if endtagopen.match(rawdata, i):
+                k = self.parse_endtag(i)
+                if k >= 0:
                     self.literal = False
-                    continue
-                if commentopen.match(rawdata, i):
-                    if self.literal:
-                        self.lex_data(rawdata[i])
-                        i = i + 1
-                        continue
-                    k = self.parse_comment(i, end)
-                    if k < 0:
-                        break
-                    i = i + k
-                    continue
-                match = processinginstruction.match(rawdata, i)
-                if match:
-                    k = match.start()
-                    #  Processing instruction:
-                    if self._strict:
-                        self.lex_pi(match.group(1))
-                        i = match.end()
+                return k
+            if commentopen.match(rawdata, i):
+                if self.literal:
+                    self.lex_data(rawdata[i])
+                    return i + 1
+                k = self.parse_comment(i, end)
+                if k < 0:
+                    return -1
+                return i + k
+            match = processinginstruction.match(rawdata, i)
+            if match:
+                k = match.start()
+                #  Processing instruction:
+                if self._strict:
+                    self.lex_pi(match.group(1))
+                    return match.end()
+                else:
+                    self.lex_data(rawdata[i])
+                    return i + 1
+            match = special.match(rawdata, i)
+            if match:
+                k = match.start()
+                if k - i == 3:
+                    self.lex_declaration([])
+                    return i + 3
+                if self._strict:
+                    if rawdata[i + 2].isalpha():
+                        k = self.parse_declaration(i)
+                        if k > -1:
+                            i = i + k
                     else:
+                        self.lex_data('<!')
+                        i = i + 2
+                else:
+                    #  Pretend it's data:
+                    if self.literal:
                         self.lex_data(rawdata[i])
-                        i = i + 1
-                    continue
-                match = special.match(rawdata, i)
-                if match:
-                    k = match.start()
-                    if k - i == 3:
-                        self.lex_declaration([])
-                        i = i + 3
-                        continue
-                    if self._strict:
-                        if rawdata[i + 2].isalpha():
-                            k = self.parse_declaration(i)
-                            if k > -1:
-                                i = i + k
-                        else:
-                            self.lex_data('<!')
-                            i = i + 2
-                    else:
-                        #  Pretend it's data:
-                        if self.literal:
-                            self.lex_data(rawdata[i])
-                            k = 1
-                        i = match.end()
-                    continue
-            elif rawdata[i] == '&':
-                charref = legalcharref if self._strict else simplecharref
-                match = charref.match(rawdata, i)
-                if match:
-                    k = match.end()
-                    if rawdata[k - 1] not in ';\n':
-                        k = k - 1
-                        terminator = ''
-                    else:
-                        terminator = rawdata[k - 1]
-                    name = match.group(1)[:-1]
-                    postchar = ''
-                    if terminator == '\n' and not self._strict:
-                        postchar = '\n'
-                        terminator = ''
-                    if name[0] in '0123456789':
-                        #  Character reference:
-                        try:
-                            self.lex_charref(int(name), terminator)
-                        except ValueError:
-                            self.lex_data("&#{}{}".format(name, terminator))
-                    else:
-                        #  Named character reference:
-                        self.lex_namedcharref(self._normfunc(name),
-                                              terminator)
-                    if postchar:
-                        self.lex_data(postchar)
-                    i = k
-                    continue
-                match = entityref.match(rawdata, i)
-                if match:
-                    k = match.end()
-                    #  General entity reference:
-                    #k = i+k
-                    if rawdata[k - 1] not in ';\n':
-                        k = k - 1
-                        terminator = ''
-                    else:
-                        terminator = rawdata[k - 1]
-                    name = match.group(1)
-                    self.lex_entityref(name, terminator)
-                    i = k
-                    continue
-            else:
-                raise RuntimeError('neither < nor & ??')
-            # We get here only if incomplete matches but
-            # nothing else
-            match = incomplete.match(rawdata, i)
-            if not match:
-                self.lex_data(rawdata[i])
-                i = i + 1
-                continue
-            k = match.end()
-            j = k
-            if j == n:
-                break  # Really incomplete
-            self.lex_data(rawdata[i:j])
-            i = j
-        # end while
-        if (end or self._finish_parse) and i < n:
-            self.lex_data(self.rawdata[i:n])
-            i = n
-        self.rawdata = self.rawdata[i:]
+                        k = 1
+                    i = match.end()
+                return i
+        elif rawdata[i] == '&':
+            charref = legalcharref if self._strict else simplecharref
+            match = charref.match(rawdata, i)
+            if match:
+                k = match.end()
+                if rawdata[k - 1] not in ';\n':
+                    k = k - 1
+                    terminator = ''
+                else:
+                    terminator = rawdata[k - 1]
+                name = match.group(1)[:-1]
+                postchar = ''
+                if terminator == '\n' and not self._strict:
+                    postchar = '\n'
+                    terminator = ''
+                if name[0] in '0123456789':
+                    #  Character reference:
+                    try:
+                        self.lex_charref(int(name), terminator)
+                    except ValueError:
+                        self.lex_data("&#{}{}".format(name, terminator))
+                else:
+                    #  Named character reference:
+                    self.lex_namedcharref(self._normfunc(name),
+                                          terminator)
+                if postchar:
+                    self.lex_data(postchar)
+                return k
+            match = entityref.match(rawdata, i)
+            if match:
+                k = match.end()
+                #  General entity reference:
+                #k = i+k
+                if rawdata[k - 1] not in ';\n':
+                    k = k - 1
+                    terminator = ''
+                else:
+                    terminator = rawdata[k - 1]
+                name = match.group(1)
+                self.lex_entityref(name, terminator)
+                return k
+        else:
+            raise RuntimeError('neither < nor & ??')
+        # We get here only if incomplete matches but
+        # nothing else
+        match = incomplete.match(rawdata, i)
+        if not match:
+            self.lex_data(rawdata[i])
+            return i + 1
+        j = match.end()
+        if j == n:
+            return -1  # Really incomplete
+        self.lex_data(rawdata[i:j])
+        return j
 
     # Internal -- parse comment, return length or -1 if not terminated
     def parse_comment(self, i, end):
@@ -482,8 +610,10 @@ class SGMLLexer(SGMLLexerBase):
             for comment in comments:
                 self.lex_comment(comment)
             return pos + len(MDC) - i
-        # not strict
-        match = commentclose.search(rawdata, i + 4)
+        # not strict; a comment that was waiting starts at i
+        start = i + (self._searched or 4)
+        self._searched = 0
+        match = commentclose.search(rawdata, start)
         if not match:
             if end:
                 j = rawdata.find(MDC, i)
@@ -492,6 +622,9 @@ class SGMLLexer(SGMLLexerBase):
                     return j + len(MDC) - i
                 self.lex_comment(rawdata[i + 4:])
                 return len(rawdata) - i
+            k = close_start(rawdata, start)
+            self._searched = k - i
+            self._tail = rawdata[k:]
             return -1
         j = match.start()
         self.lex_comment(rawdata[i + 4: j])
@@ -521,6 +654,7 @@ class SGMLLexer(SGMLLexerBase):
         # XXX The following should skip matching quotes (' or ")
         match = endbracket.search(rawdata, i + 1)
         if not match:
+            self._waitfor = '<>/' if self._strict else '<>'
             return -1
         j = match.start(0)
         #print("parse_starttag endbracket", j)
@@ -541,26 +675,7 @@ class SGMLLexer(SGMLLexerBase):
         #print("tagfind end", k)
         tag = self._normfunc(rawdata[i + 1:k])
         #print("tag", tag)
-        # pull recognizable attributes
-        attrs = {}
-        while k < j:
-            match = attrfind.match(rawdata, k)
-            if not match:
-                break
-            l = match.start(0)
-            k = k + l
-            # Break out the name[/value] pair:
-            attrname, rest, attrvalue = match.group(1, 2, 3)
-            if not rest:
-                attrvalue = None    # was:  = attrname
-            elif attrvalue[:1] == LITA == attrvalue[-1:] or \
-                    attrvalue[:1] == LIT == attrvalue[-1:]:
-                attrvalue = attrvalue[1:-1]
-                if '&' in attrvalue:
-                    from .SGMLReplacer import replace
-                    attrvalue = replace(attrvalue, self.entitydefs)
-            attrs[self._normfunc(attrname)] = attrvalue
-            k = match.end(0)
+        attrs, k = self.parse_attributes(k, j)
         # close the start-tag
         xx = tagend.match(rawdata, k)
         if not xx:
@@ -605,6 +720,31 @@ class SGMLLexer(SGMLLexerBase):
         self.lex_starttag(tag, attrs)
         return k
 
+    # Internal -- pull the recognizable attributes starting before j
+    # from k on, return them and the index after the last one
+    def parse_attributes(self, k, j):
+        rawdata = self.rawdata
+        attrs = {}
+        while k < j:
+            match = attrfind.match(rawdata, k)
+            if not match:
+                break
+            l = match.start(0)
+            k = k + l
+            # Break out the name[/value] pair:
+            attrname, rest, attrvalue = match.group(1, 2, 3)
+            if not rest:
+                attrvalue = None    # was:  = attrname
+            elif attrvalue[:1] == LITA == attrvalue[-1:] or \
+                    attrvalue[:1] == LIT == attrvalue[-1:]:
+                attrvalue = attrvalue[1:-1]
+                if '&' in attrvalue:
+                    from .SGMLReplacer import replace
+                    attrvalue = replace(attrvalue, self.entitydefs)
+            attrs[self._normfunc(attrname)] = attrvalue
+            k = match.end(0)
+        return attrs, k
+
     # Internal -- parse endtag
     def parse_endtag(self, i):
         rawdata = self.rawdata
@@ -617,6 +757,7 @@ class SGMLLexer(SGMLLexerBase):
             return i + 2 + (rawdata[i + 2] == TAGC)
         match = endtag.match(rawdata, i)
         if not match:
+            self._waitfor = '<>'
             return -1
         j = match.end(0) - 1
         #j = i + j - 1
@@ -727,6 +868,34 @@ attrfind = re.compile(
     + r'|[\-~a-zA-Z0-9,./:+*%?!\(\)_#=]*))?')
 tagend = re.compile(OPTIONAL_WHITESPACE + r'[<>/]')
 
+# The tokens scan() handles itself, matched as parse_starttag(),
+# parse_endtag() and so on would in the lenient mode, with anything
+# else left to parse_markup().  The lookaheads keep names, whitespace
+# and attribute values from matching shorter than they do there.
+# Only the opening of a comment is matched, the rest is left to
+# parse_comment(): a comment can run on for a long way, and matching
+# it here would search all of it again each time more is fed.
+_name_end = r'(?![-_.a-zA-Z0-9])'
+_attribute = ('[{ws},]*[_a-zA-Z][-:.a-zA-Z_0-9]*(?![-:.a-zA-Z_0-9])'
+              '(?:[{ws}]*{vi}[{ws}]*(?![{ws}])'
+              '(?:{lita}[^{lita}<>]*{lita}|{lit}[^{lit}<>]*{lit}'
+              r'|[\-~a-zA-Z0-9,./:+*%?!\(\)_#=]*'
+              r'(?![\-~a-zA-Z0-9,./:+*%?!\(\)_#=])))?').format(
+                  ws=whitespace, vi=VI, lit=LIT, lita=LITA)
+tokens = re.compile(
+    r'(?P<data>[^&<]+)'
+    + '|(?P<starttag>' + STAGO + r'(?P<stag>[a-zA-Z][-_.a-zA-Z0-9]*)'
+    + _name_end + '(?P<attrs>(?:' + _attribute + ')*)'
+    + OPTIONAL_WHITESPACE + '(?P<slash>' + NET + ')?' + TAGC + ')'
+    + '|(?P<endtag>' + ETAGO + r'(?P<etag>[a-zA-Z][-.a-zA-Z0-9]*)'
+    + '[^<>]*' + TAGC + ')'
+    + '|(?P<entityref>' + ERO + r'(?P<ename>[a-zA-Z][-.a-zA-Z0-9]*)'
+    + r'(?P<eterm>[;\n]|(?=[^-.a-zA-Z0-9])))'
+    + '|(?P<charref>' + CRO + '(?P<ordinal>[0-9]+)'
+    + r'(?P<cterm>[;\n]|(?=[^0-9])))'
+    + '|(?P<comment>' + MDO + COM + ')'
+    + '|(?P<markup>[<&])', re.DOTALL)
+
 # used below in comment_match()
 comment_start = re.compile(COM + r'([^-]*)-(.|\n)')
 comment_segment = re.compile(r'([^-]*)-(.|\n)')
@@ -735,6 +904,19 @@ comment_whitespace = re.compile(OPTIONAL_WHITESPACE)
 del re
 
 
+def close_start(rawdata, start):
+    """Return where a comment close could begin in rawdata, searched
+    from start without finding one, once more data is added: at the
+    hyphens and whitespace it ends with.
+    """
+    k = len(rawdata)
+    while k > start and rawdata[k - 1].isspace():
+        k = k - 1
+    while k > start and rawdata[k - 1] == '-':
+        k = k - 1
+    return k
+
+
 def comment_match(rawdata, start):
     """Match a legal SGML comment.
 
@@ -782,3 +964,127 @@ def comment_match(rawdata, start):
         else:
             matchlength = matcher.start()
     return -1, ''
+
+
+class Test(unittest.TestCase):
+
+    class Recorder(SGMLLexer):
+        def reset(self):
+            SGMLLexer.reset(self)
+            self.events = []
+
+        def lex_data(self, data):
+            if self.events and self.events[-1][0] == 'data':
+                data = self.events.pop()[1] + data
+            self.events.append(('data', data))
+
+        def lex_starttag(self, tag, attrs):
+            self.events.append(('start', tag, attrs))
+            if tag == 'xmp':
+                self.setliteral(tag)
+            elif tag == 'plaintext':
+                self.setnomoretags()
+
+        def lex_endtag(self, tag):
+            self.events.append(('end', tag))
+
+        def lex_comment(self, comment):
+            self.events.append(('comment', comment))
+
+        def lex_entityref(self, name, terminator):
+            self.events.append(('entityref', name, terminator))
+
+        def lex_charref(self, ordinal, terminator):
+            self.events.append(('charref', ordinal, terminator))
+
+        def lex_error(self, message):
+            self.events.append(('error', message))
+
+    corpus = ('<p>Some <b class="x">text</b> &amp; more&#65;&#66\n&lt '
+              '<a href=x/>an <A HREF="y.html" Name=\'z\' ismap>image</A>'
+              '<br/><hr /><br / ><ab=c><x:y z><q a="b c"><q a=\'&amp;\'>'
+              '<!-- a -- > <b> --><!----><!DOCTYPE html><?pi>'
+              '<xmp><b>not bold</b></XMP><p&#x41;&nbsp;x</p <>'
+              '<plaintext><b>not bold</b>')
+
+    def lex(self, doc, size, compiled=True):
+        lexer = self.Recorder()
+        lexer.normalize(True)
+        lexer.compiled(compiled)
+        for i in range(0, len(doc), size):
+            lexer.feed(doc[i:i + size])
+        lexer.close()
+        return lexer.events
+
+    def runTest(self):
+        doc = ('<p>Some <b class="x">text</b> &amp; more\n'
+               '<!-- a long comment ' + 'x' * 1000 + ' -->'
+               '<a href="a.html">link</a > < not a tag &\n' * 5)
+        events = self.lex(doc, len(doc))
+        self.assertEqual(events[:4], [('start', 'p', {}),
+                                      ('data', 'Some '),
+                                      ('start', 'b', {'class': 'x'}),
+                                      ('data', 'text')])
+        for size in (1, 7, 512):
+            self.assertEqual(self.lex(doc, size), events)
+        # An unterminated comment waits for a '>', then ends at the end
+        lexer = self.Recorder()
+        lexer.feed('<!-- ')
+        lexer.feed('x' * 100)
+        self.assertEqual(lexer.events, [])
+        self.assertEqual(lexer._pending, ['x' * 100])
+        lexer.feed(' -- >')
+        self.assertEqual(lexer.events, [('comment', ' ' + 'x' * 100 + ' ')])
+        lexer.feed('<!-- y')
+        lexer.close()
+        self.assertEqual(lexer.events[-1], ('comment', ' y'))
+        # Markup in a comment doesn't end it; the close may be split up
+        lexer = self.Recorder()
+        for data in ['<!-- <b>x</b> -', '<br>' * 100, '-', '- ', ' ', '>']:
+            self.assertEqual(lexer.events, [])
+            lexer.feed(data)
+        self.assertEqual(lexer.events, [
+            ('comment', ' <b>x</b> -' + '<br>' * 100)])
+
+        # Both tokenizers see the same
+        events = self.lex(self.corpus, len(self.corpus), False)
+        self.assertIn(('start', 'a', {'href': 'y.html', 'name': 'z',
+                                      'ismap': None}), events)
+        self.assertIn(('data', '<b>not bold</b>'), events)
+        for size in (1, 7, 512):
+            self.assertEqual(self.lex(self.corpus, size, False), events)
+            self.assertEqual(self.lex(self.corpus, size), events)
+
+
+def benchmark(sizes=(5, 10, 20), chunk=512):
+    """Time lexing documents of sizes megabytes fed in chunk sized
+    pieces.
+
+    Run with "python -m grail.sgml.SGMLLexer".  One document is plain
+    markup, lexed with the compiled tokenizer and without it, the
+    other one long comment; the time per kilobyte should stay flat as
+    the size grows.
+    """
+    import time
+    row = ('<p>Lorem <b>ipsum</b> dolor &amp; sit amet, <a href="x.html">'
+           'consectetur</a> adipiscing elit.\n')
+    print("{:>9} {:>9} {:>12}".format("document", "MB", "us per KB"))
+    for size in sizes:
+        markup = row * (size * 1024 * 1024 // len(row))
+        comment = '<!-- ' + markup + ' -->'
+        for name, doc, compiled in (('markup', markup, True),
+                                    ('classic', markup, False),
+                                    ('comment', comment, True)):
+            lexer = SGMLLexer()
+            lexer.compiled(compiled)
+            t0 = time.perf_counter()
+            for i in range(0, len(doc), chunk):
+                lexer.feed(doc[i:i + chunk])
+            lexer.close()
+            elapsed = time.perf_counter() - t0
+            print("{:>9} {:9d} {:12.2f}".format(
+                name, size, elapsed * 1e6 / (len(doc) / 1024)))
+
+
+if __name__ == '__main__':
+    benchmark()
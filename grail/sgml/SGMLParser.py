@@ -4,6 +4,7 @@ __version__ = "$Revision: 1.27 $"
 
 from . import SGMLLexer
 from . import SGMLHandler
+import unittest
 
 SGMLError = SGMLLexer.SGMLError
 
@@ -22,6 +23,7 @@ class SGMLParser(SGMLLexer.SGMLLexer):
     def __init__(self, gatherer=None):
         if gatherer is None:
             gatherer = SGMLHandler.BaseSGMLHandler()
+        self.__ticaches = {}            # taginfo key -> taginfo cache
         self.push_handler(gatherer)
         SGMLLexer.SGMLLexer.__init__(self)
 
@@ -34,6 +36,7 @@ class SGMLParser(SGMLLexer.SGMLLexer):
         while self.stack:
             self.lex_endtag(self.stack[-1][0].tag)
         self.__taginfo = {}
+        self.__ticaches = {}
         self.set_data_handler(SGMLHandler._nullfunc)
         SGMLLexer.SGMLLexer.cleanup(self)
         self.__handler = None
@@ -45,15 +48,30 @@ class SGMLParser(SGMLLexer.SGMLLexer):
         self.restrict(True)                # impose user-agent compatibility
         self.omittag = True                # default to HTML style
         self.stack = []
+        self.__positions = {}              # tag -> positions on the stack
 
     def get_handler(self):
         return self.__handler
 
     def push_handler(self, handler):
         self.__handler = handler
-        self.__taginfo = {}
+        self.__taginfo = self.__get_ticache(handler)
         self.set_data_handler(handler.handle_data)
 
+    # Internal -- return the taginfo cache for handler.  Handlers with the
+    # same taginfo key share one for the life of the parser, so pushing
+    # another such handler doesn't start over.
+    def __get_ticache(self, handler):
+        get_key = getattr(handler, 'get_taginfo_key', None)
+        key = get_key and get_key()
+        if key is None:
+            return {}
+        try:
+            return self.__ticaches[key]
+        except KeyError:
+            ticache = self.__ticaches[key] = {}
+            return ticache
+
     def get_depth(self):
         """Return depth of the element stack."""
         return len(self.stack)
@@ -96,25 +114,20 @@ class SGMLParser(SGMLLexer.SGMLLexer):
             `gi' == 'ol' ==> ['li', 'ul', 'li', 'em']
             `gi' == 'bogus' ==> None
         """
-        stack = self.stack
-        depth = len(stack)
-        while depth:
-            depth = depth - 1
-            if stack[depth][0].tag == gi:
-                context = stack[depth + 1:]
-                break
-        else:
+        positions = self.__positions.get(gi)
+        if not positions:
             # no such context
             return None
-        for i, entry in enumerate(context):
-            context[i] = entry[0].tag
-        return context
+        return [entry[0].tag for entry in self.stack[positions[-1] + 1:]]
 
     def has_context(self, gi):
-        for entry in self.stack:
-            if entry[0].tag == gi:
-                return True
-        return False
+        return bool(self.__positions.get(gi))
+
+    def pop_stack(self):
+        """Remove the innermost element from the stack without calling
+        its end tag handler."""
+        taginfo = self.stack.pop()[0]
+        self.__positions[taginfo.tag].pop()
 
     #  The remaining methods are the internals of the implementation and
     #  interface with the lexer.  Subclasses should rarely need to deal
@@ -157,6 +170,8 @@ class SGMLParser(SGMLLexer.SGMLLexer):
             handler = self.__handler
             ticache = self.__taginfo
             handler.handle_starttag(tag, taginfo.start, attrs)
+            self.__positions.setdefault(taginfo.tag, []).append(
+                len(self.stack))
             self.stack.append((taginfo, handler, ticache, self.__handler))
         else:
             handler = self.__handler
@@ -169,13 +184,11 @@ class SGMLParser(SGMLLexer.SGMLLexer):
     def lex_endtag(self, tag):
         stack = self.stack
         if tag:
-            found = None
-            for i, entry in enumerate(stack):
-                if entry[0].tag == tag:
-                    found = i
-            if found is None:
+            positions = self.__positions.get(tag)
+            if not positions:
                 self.__handler.report_unbalanced(tag)
                 return
+            found = positions[-1]
         elif stack:
             found = len(stack) - 1
         else:
@@ -188,7 +201,7 @@ class SGMLParser(SGMLLexer.SGMLLexer):
             handler.handle_endtag(taginfo.tag, taginfo.end)
             self.__handler = handler
             self.__taginfo = ticache
-            del stack[-1]
+            self.pop_stack()
 
     named_characters = {'re': '\r',
                         'rs': '\n',
@@ -208,3 +221,174 @@ class SGMLParser(SGMLLexer.SGMLLexer):
 
     def lex_entityref(self, name, terminator):
         self.__handler.handle_entityref(name, terminator)
+
+
+class _TablePage(SGMLHandler.BaseSGMLHandler):
+    # A handler for tables that pushes a _TableCell for the contents of
+    # each cell, as nested formatters do.
+
+    doctype = 'table'
+
+    def __init__(self):
+        self.parser = SGMLParser(gatherer=self)
+        self.events = []
+
+    def start_table(self, attrs):
+        self.events.append('table')
+
+    def end_table(self):
+        self.events.append('/table')
+
+    def start_tr(self, attrs):
+        self.parser.lex_endtag('tr')
+        self.events.append('tr')
+
+    def start_td(self, attrs):
+        self.parser.lex_endtag('td')
+        self.events.append('td')
+        cell = _TableCell(self.events)
+        self.parser.push_handler(SGMLHandler.CompositeHandler(self, cell))
+
+    def do_br(self, attrs):
+        self.events.append('br')
+
+    def handle_data(self, data):
+        self.events.append(data)
+
+
+class _TableCell(SGMLHandler.ElementHandler):
+
+    def __init__(self, events):
+        self.events = events
+
+    def close(self):
+        self.events.append('/cell')
+
+    def start_b(self, attrs):
+        self.events.append('b')
+
+    def end_b(self):
+        self.events.append('/b')
+
+
+class _Nested(SGMLHandler.BaseSGMLHandler):
+    # A handler for elements that are left open.
+
+    def __init__(self):
+        self.parser = SGMLParser(gatherer=self)
+        self.events = []
+
+    def start_div(self, attrs):
+        pass
+
+    def end_div(self):
+        self.events.append('/div')
+
+    def start_b(self, attrs):
+        pass
+
+    def end_b(self):
+        self.events.append('/b')
+
+    def start_i(self, attrs):
+        pass
+
+    def end_i(self):
+        self.events.append('/i')
+
+    def handle_data(self, data):
+        self.events.append(data)
+
+    def report_unbalanced(self, tag):
+        self.events.append(('unbalanced', tag))
+
+
+class Test(unittest.TestCase):
+
+    def runTest(self):
+        doc = ('<table><tr><td>a<b>b</b><br><td><b>c</>'
+               '<tr><td>d<i>e</i></table>')
+        events = ['table', 'tr', 'td', 'a', 'b', 'b', '/b', 'br', '/cell',
+                  'td', 'b', 'c', '/b', '/cell', 'tr', 'td', 'd', 'e',
+                  '/cell', '/table']
+        for i in range(2):
+            page = _TablePage()
+            page.parser.feed(doc)
+            page.parser.close()
+            self.assertEqual(page.events, events)
+
+        # The taginfo comes from a table built once per class
+        table = _TablePage.get_tagtable()
+        self.assertIs(table, _TablePage.get_tagtable())
+        self.assertIs(page.get_taginfo('td'), table['td'])
+        self.assertFalse(table['br'].container)
+        self.assertIsNone(page.get_taginfo('b'))
+        self.assertIsNone(page.get_taginfo('i'))
+        with self.assertRaises(TypeError):
+            table['i'] = None
+        composite = SGMLHandler.CompositeHandler(page, _TableCell([]))
+        self.assertIs(composite.get_taginfo('b'),
+                      _TableCell.get_tagtable()['b'])
+        self.assertIs(composite.get_taginfo('td'), table['td'])
+        self.assertEqual(composite.get_taginfo_key(),
+                         SGMLHandler.CompositeHandler(
+                             page, _TableCell([])).get_taginfo_key())
+
+        # End tags close the innermost open element of their kind
+        page = _Nested()
+        parser = page.parser
+        parser.feed('<div><b><div><i><b>x')
+        self.assertEqual(parser.get_stack(), ['div', 'b', 'div', 'i', 'b'])
+        self.assertTrue(parser.has_context('i'))
+        self.assertFalse(parser.has_context('p'))
+        self.assertEqual(parser.get_context('div'), ['i', 'b'])
+        self.assertEqual(parser.get_context('b'), [])
+        self.assertIsNone(parser.get_context('p'))
+        parser.feed('</p></div>')
+        self.assertEqual(page.events, ['x', ('unbalanced', 'p'),
+                                       '/b', '/i', '/div'])
+        self.assertEqual(parser.get_context('b'), [])
+        self.assertFalse(parser.has_context('i'))
+        parser.pop_stack()
+        self.assertEqual(parser.get_context('div'), [])
+        parser.feed('</b><i></>')
+        self.assertEqual(page.events[-2:], [('unbalanced', 'b'), '/i'])
+        self.assertEqual(parser.get_stack(), ['div'])
+        parser.close()
+        self.assertEqual(page.events[-1], '/div')
+
+
+def benchmark(pages=20, rows=200, cols=10, depths=(1000, 4000, 16000)):
+    """Time parsing pages of tables with a handler pushed for each cell,
+    and documents with depths elements left open.
+
+    Run with "python -m grail.sgml.SGMLParser".  The time per end tag
+    in the nested documents should stay flat as the depth grows.
+    """
+    import time
+    row = '<tr>' + '<td>cell <b>bold</b> text<br>more' * cols + '\n'
+    doc = '<table>' + row * rows + '</table>'
+    t0 = time.perf_counter()
+    for i in range(pages):
+        page = _TablePage()
+        page.parser.feed(doc)
+        page.parser.close()
+    elapsed = time.perf_counter() - t0
+    print("{} pages of {} cells: {:.1f} ms, {:.2f} us per cell".format(
+        pages, rows * cols, elapsed * 1000,
+        elapsed * 1e6 / (pages * rows * cols)))
+    count = 20000
+    for depth in depths:
+        doc = ('<div><i>' * depth + '<b>bold</b></p>' * count +
+               '</div>' * depth)
+        page = _Nested()
+        t0 = time.perf_counter()
+        page.parser.feed(doc)
+        page.parser.close()
+        elapsed = time.perf_counter() - t0
+        print("depth {}: {:.1f} ms, {:.2f} us per end tag".format(
+            depth, elapsed * 1000, elapsed * 1e6 / (2 * count + depth)))
+
+
+if __name__ == '__main__':
+    benchmark()
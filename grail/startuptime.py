@@ -0,0 +1,109 @@
+#! /usr/bin/env python
+
+"""Script to measure how long Grail takes to start.
+
+Usage:  python -m grail.startuptime [-n count] [-m modules] [url]
+
+Imports grail.Grail under "python -X importtime" count times (default
+5) and reports the best total import time and the modules that took
+longest to import themselves.  If a display is available, it then
+times making the Application, opening a Browser and loading url
+(default grail:data/about.html) until the page is done, and lists the
+subsystems that were started on the way.
+"""
+
+import getopt
+import os
+import subprocess
+import sys
+import time
+
+DEFAULT_URL = 'grail:data/about.html'
+SUBSYSTEMS = ('global_history', 'url_cache', 'image_cache', 'auth',
+              'cookies')
+
+
+def import_times(module='grail.Grail'):
+    """Return a list of (self, cumulative, name) import times in
+    microseconds, from importing module in a fresh interpreter."""
+    topdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        cwd=topdir, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        universal_newlines=True, check=True)
+    times = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        try:
+            times.append((int(fields[0]), int(fields[1]),
+                          fields[2].strip()))
+        except (IndexError, ValueError):
+            pass                        # the header
+    return times
+
+
+def report_imports(count, modules):
+    best = None
+    for i in range(count):
+        times = import_times()
+        total = max(cumulative for own, cumulative, name in times)
+        if best is None or total < best[0]:
+            best = (total, times)
+    total, times = best
+    grail_own = sum(own for own, cumulative, name in times
+                    if name.startswith('grail'))
+    print("import grail.Grail: {:.1f} ms, {:.1f} ms of it in grail's own"
+          " modules ({} modules imported)".format(
+              total / 1000, grail_own / 1000, len(times)))
+    print("{:>10}  {}".format("self (ms)", "module"))
+    for own, cumulative, name in sorted(times, reverse=True)[:modules]:
+        print("{:>10.1f}  {}".format(own / 1000, name))
+
+
+def report_first_paint(url):
+    import tkinter
+    from . import Grail
+    from .Browser import Browser
+    t0 = time.perf_counter()
+    try:
+        app = Grail.Application()
+    except tkinter.TclError as err:
+        print("no first paint timing:", err)
+        return
+    app.embedded = False
+    t1 = time.perf_counter()
+    browser = Browser(app.root, app)
+    app.root.update()
+    t2 = time.perf_counter()
+    browser.context.load(url)
+    while browser.context.busy():
+        app.root.tk.dooneevent()
+    app.root.update()
+    t3 = time.perf_counter()
+    print()
+    print("{:>10.1f} ms  Application()".format((t1 - t0) * 1000))
+    print("{:>10.1f} ms  first window".format((t2 - t1) * 1000))
+    print("{:>10.1f} ms  {} loaded".format((t3 - t2) * 1000, url))
+    started = [name for name in SUBSYSTEMS if name in vars(app)]
+    print("subsystems started:", ", ".join(started) or "none")
+    browser.close()
+    app.root.destroy()
+
+
+def main():
+    count = 5
+    modules = 15
+    opts, args = getopt.getopt(sys.argv[1:], 'n:m:')
+    for opt, arg in opts:
+        if opt == '-n':
+            count = int(arg)
+        elif opt == '-m':
+            modules = int(arg)
+    report_imports(count, modules)
+    report_first_paint(args[0] if args else DEFAULT_URL)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,9 +5,13 @@ This can be used to implement client-side cookie handling.
 __author__ = "Fred L. Drake, Jr. <fdrake@acm.org>"
 __version__ = '$Revision: 2.1 $'
 
+import bisect
+import functools
+import heapq
+import itertools
+import os
 import time
 from . import ht_time
-import operator
 
 
 class Error(Exception):
@@ -50,17 +54,39 @@ def is_special_domain(domain):
 
 
 class CookieDB:
+    """A database of cookies.
+
+    Cookies are indexed by domain; each domain keeps its cookies in a
+    list sorted longest path first, so lookup() only has to merge the
+    lists of the host and its parent domains.  Cookies with an
+    expiration time are also kept in a heap on that time; expired
+    cookies are dropped from the top of the heap before each lookup,
+    without looking at the others.
+
+    If the database has a file name, each change to a persistent
+    cookie is appended to the file as it is made (an expired entry
+    stands for a deleted cookie); sync() rewrites the file when most
+    of it has become obsolete.
+    """
 
     def __init__(self, filename=None, fp=None, caps=None):
-        self.__cookies = {}
-        self.__num_cookies = 0
+        self.__domains = {}     # domain -> [(-len(path), seq, cookie)]
+        self.__cookies = {}     # (domain, path, name) -> cookie
+        self.__expiry = []      # heap of (expires, seq, cookie)
+        self.__seq = itertools.count()
+        self.__log = None
+        self.__loglines = 0
+        self.__loading = False
         self.set_capacities(caps)
         self.set_filename(filename)
         if fp is not None:
             self.load(fp)
-        elif filename:
+        elif filename and os.path.exists(filename):
             self.load()
 
+    def __len__(self):
+        return len(self.__cookies)
+
     def get_capacities(self):
         return self.__caps.copy()
 
@@ -69,21 +95,30 @@ class CookieDB:
             caps = Capacities()
         self.__caps = caps
 
+    def get_filename(self):
+        return self.__filename
+
     def set_filename(self, filename):
+        self.close()
         self.__filename = filename
 
     def load(self, fp=None):
         if fp is None:
-            fp = open(self.get_filename())
+            with open(self.get_filename()) as fp:
+                return self.load(fp)
         pos = fp.tell()
         try:
             line = fp.readline()
         finally:
             fp.seek(pos)
-        if line.startswith("<?XML"):
-            self.load_xml(fp)
-        else:
-            self.load_ns(fp)
+        self.__loading = True
+        try:
+            if line.startswith("<?XML"):
+                self.load_xml(fp)
+            else:
+                self.load_ns(fp)
+        finally:
+            self.__loading = False
 
     def load_ns(self, fp=None):
         for (lineno, line) in enumerate(fp, 1):
@@ -102,23 +137,56 @@ class CookieDB:
             secure = secure != 'FALSE'
             cookie = Cookie(domain, path, secure, expires, name, value)
             self.set_cookie(cookie)
+            self.__loglines = self.__loglines + 1
 
     def save(self, fp=None):
         if fp is None:
-            fp = open(self.__filename, 'w')
+            filename = self.__filename
+            with open(filename + '.tmp', 'w') as fp:
+                self.save(fp)
+            os.replace(filename + '.tmp', filename)
+            return
         fp.write(BANNER)
         for cookie in self.all_cookies():
             if cookie.expires is not None:
-                isdomain = 'TRUE' if cookie.isdomain else 'FALSE'
-                secure = 'TRUE' if cookie.secure else 'FALSE'
-                expires = format(cookie.expires)
-                l = [cookie.domain, isdomain, cookie.path, secure,
-                     expires, cookie.name, cookie.value]
-                s = '\t'.join(l)
-                fp.write(s + '\n')
+                fp.write(format_cookie(cookie))
+
+    def sync(self):
+        """Bring the file up to date, rewriting it if it has grown
+        much larger than the persistent cookies it holds."""
+        if not self.__filename:
+            return
+        self.expire()
+        if self.__loglines > 2 * len(self.__expiry) + 100 \
+           or not os.path.exists(self.__filename):
+            self.close()
+            self.save()
+            self.__loglines = len(self.__expiry)
+        elif self.__log:
+            self.__log.flush()
+
+    def close(self):
+        log = self.__log
+        self.__log = None
+        if log:
+            log.close()
+
+    def __journal(self, cookie, expires):
+        if self.__loading or not self.__filename:
+            return
+        if self.__log is None:
+            new = not os.path.exists(self.__filename)
+            self.__log = open(self.__filename, 'a')
+            if new:
+                self.__log.write(BANNER)
+        self.__log.write(format_cookie(cookie, expires))
+        self.__log.flush()
+        self.__loglines = self.__loglines + 1
 
     def set_cookie(self, cookie):
-        if hasattr(cookie, 'discard') or cookie.max_age == 0:
+        if hasattr(cookie, 'discard') or cookie.max_age == 0 \
+           or (cookie.expires is not None
+               and cookie.expires < int(time.time())):
             return self.discard(cookie)
         # need to enforce capacities here!
         caps = self.__caps
@@ -127,137 +195,136 @@ class CookieDB:
         # truncate cookie value if necessay:
         max_value_len = caps.max_cookie_size - len(cookie.name)
         cookie.value = cookie.value[:max_value_len]
-        try:
-            cookies = self.__cookies[cookie.domain]
-        except KeyError:
-            self.__cookies[cookie.domain] = [cookie]
-            self.__num_cookies = self.__num_cookies + 1
+        key = (cookie.domain, cookie.path, cookie.name)
+        old = self.__cookies.get(key)
+        if old is not None:
+            self.__remove(old)
         else:
-            for i, c in enumerate(cookies):
-                if c.name == cookie.name and c.path == cookie.path:
-                    cookies[i] = cookie
-                    break
-            else:
-                if len(cookies) >= caps.num_per_server:
-                    self.__expire_cookies(cookies)
-                if len(cookies) == caps.num_per_server:
-                    # need to remove one more!
-                    key = operator.attrgetter('expires')
-                    mcookies = sorted(cookies, key=key)
-                    for c, i in mcookies:
-                        if c.expires:
-                            cookies.remove(c)
-                            break
-                    else:
-                        # all are per-session; just toss the first one
-                        del cookies[0]
-                    self.__num_cookies = self.__num_cookies - 1
-                cookies.append(cookie)
-                self.__num_cookies = self.__num_cookies + 1
+            cookies = self.__domains.get(cookie.domain, ())
+            if len(cookies) >= caps.num_per_server:
+                self.expire()
+                cookies = self.__domains.get(cookie.domain, ())
+            if len(cookies) >= caps.num_per_server:
+                # remove the one expiring first; session cookies last
+                victim = min((c for l, s, c in cookies),
+                             key=lambda c: (c.expires is None,
+                                            c.expires or 0))
+                self.__remove(victim)
+            if len(self.__cookies) >= caps.max_cookies:
+                self.__make_room()
+        self.__add(cookie)
+        if cookie.expires is not None:
+            self.__journal(cookie, cookie.expires)
+        elif old is not None and old.expires is not None:
+            self.__journal(old, 1)
 
     def discard(self, cookie):
-        try:
-            cookies = self.__cookies[cookie.domain]
-        except KeyError:
-            return
-        for i in range(cookies):
-            c = cookies[i]
-            if c.name == cookie.name and c.path == cookie.path:
+        old = self.__cookies.get((cookie.domain, cookie.path, cookie.name))
+        if old is not None:
+            self.__remove(old)
+            if old.expires is not None:
+                self.__journal(old, 1)
+
+    def __add(self, cookie):
+        seq = next(self.__seq)
+        self.__cookies[(cookie.domain, cookie.path, cookie.name)] = cookie
+        cookies = self.__domains.setdefault(cookie.domain, [])
+        bisect.insort(cookies, (-len(cookie.path), seq, cookie))
+        if cookie.expires is not None:
+            heap = self.__expiry
+            if len(heap) > 2 * len(self.__cookies) + 64:
+                # drop the entries of replaced and removed cookies
+                heap[:] = [e for e in heap if self.__present(e[2])]
+                heapq.heapify(heap)
+            heapq.heappush(heap, (cookie.expires, seq, cookie))
+
+    def __present(self, cookie):
+        key = (cookie.domain, cookie.path, cookie.name)
+        return self.__cookies.get(key) is cookie
+
+    def __remove(self, cookie):
+        del self.__cookies[(cookie.domain, cookie.path, cookie.name)]
+        cookies = self.__domains[cookie.domain]
+        for i, entry in enumerate(cookies):
+            if entry[2] is cookie:
                 del cookies[i]
-                self.__num_cookies = self.__num_cookies - 1
                 break
+        if not cookies:
+            del self.__domains[cookie.domain]
+        # the entry in the expiry heap is dropped when it comes up
+
+    def expire(self, now=None):
+        """Remove the cookies which have expired."""
+        if now is None:
+            now = int(time.time())
+        heap = self.__expiry
+        while heap and heap[0][0] < now:
+            cookie = heapq.heappop(heap)[2]
+            if self.__present(cookie):
+                self.__remove(cookie)
+
+    def __make_room(self):
+        """Remove the cookie which expires first, after any that have
+        already expired."""
+        self.expire()
+        heap = self.__expiry
+        while len(self.__cookies) >= self.__caps.max_cookies:
+            if not heap:
+                raise CapacityError("too many cookies")
+            cookie = heapq.heappop(heap)[2]
+            if self.__present(cookie):
+                self.__remove(cookie)
+                self.__journal(cookie, 1)
 
     def lookup(self, domain, path='/', secure=False):
-        domain = domain.lower()
-        hostparts = domain.split('.')
-        results = self.__match_path(domain, path)
-        minparts = 3
-        if is_special_domain(hostparts[-1]):
-            minparts = 2
-        while len(hostparts) > minparts:
-            del hostparts[0]
-            key = '.'.join([''] + hostparts)
-            results.extend(self.__match_path(key, path))
-        if not secure:
-            results = list(c for c in results if not c.secure)
-        return results
-
-    def __expire_cookies(self, cookies):
-        """Remove expired cookies from a list if they've expired.  Current
-        database size is adjusted, so only call this on lists which are
-        part of the database.  The resulting list is limited to the number
-        of cookies allowed for a single domain."""
-        now = int(time.time())
-        old_len = len(cookies)
-        for i in reversed(range(old_len)):
-            cookie = cookies[i]
-            if cookie.expires is not None \
-               and cookie.expires < now:
-                del cookies[i]
-        # should trim list back if there are too many:
-        num_per_server = self.__caps.num_per_server
-        if len(cookies) > num_per_server:
-            # sort on expiration
-            ncookies = sorted(cookies, key=operator.attrgetter('expires'))
-            for cookie in ncookies:
-                if cookie.expires:
-                    cookies.remove(cookies)
-                    if len(cookies) == num_per_server:
-                        break
-        if len(cookies) > num_per_server:
-            # still too many; just toss the first few in the list
-            del cookies[:-num_per_server]
-        self.__num_cookies = self.__num_cookies + len(cookies) - old_len
-
-    def __make_room(self, howmany):
-        remove = (self.__num_cookies - self.__caps.max_cookies) + howmany
-        # Expire cookies until we've killed off enough,
-        # if that'll do the trick.
-        domains = self.all_domains()
-        while remove > 0 and domains:
-            cookies = self.__cookies[domains.pop(0)]
-            num_cookies = len(cookies)
-            self.__expire_cookies(cookies)
-            remove = remove - (num_cookies - len(cookies))
-        if remove > 0:
-            # need to be more aggressive
-            pass
-
-    def __match_path(self, domain, path):
-        results = []
-        try:
-            cookies = self.__cookies[domain]
-        except KeyError:
-            pass
-        else:
-            if cookies:
-                self.__expire_cookies(cookies)
-            if cookies:
-                for cookie in cookies:
-                    if path.startswith(cookie.path):
-                        results.append(cookie)
-            else:
-                # nothing left in domain
-                del self.__cookies[domain]
-        if results:
-            results.sort(key=lambda x: len(x.path), reverse=True)
-            results.reverse()
-        return results
+        """Return the cookies to send to a host for a path, the most
+        specific path first."""
+        heap = self.__expiry
+        if heap and heap[0][0] < time.time():
+            self.expire()
+        domains = self.__domains
+        entries = None
+        for key in domain_keys(domain.lower()):
+            if key in domains:
+                if entries is None:
+                    entries = domains[key]
+                else:
+                    # each list is a sorted run, which sorted() merges
+                    entries = sorted(entries + domains[key])
+        if entries is None:
+            return []
+        return [cookie for l, s, cookie in entries
+                if path.startswith(cookie.path)
+                and (secure or not cookie.secure)]
 
     def all_domains(self):
-        return list(self.__cookies.keys())
+        return list(self.__domains.keys())
 
     def all_cookies(self):
-        results = []
-        for d in self.all_domains():
-            cookies = self.__cookies[d]
-            self.__expire_cookies(cookies)
-            if cookies:
-                results.extend(cookies)
-            else:
-                # nothing left; remove the domain
-                del self.__cookies[d]
-        return results
+        self.expire()
+        return list(self.__cookies.values())
+
+
+@functools.lru_cache(maxsize=1024)
+def domain_keys(host):
+    """Return the domains whose cookies a host may see: the host
+    itself and each domain suffix with enough name parts."""
+    keys = [host]
+    hostparts = host.split('.')
+    minparts = 2 if is_special_domain(hostparts[-1]) else 3
+    for i in range(len(hostparts) - minparts + 1):
+        keys.append('.' + '.'.join(hostparts[i:]))
+    return tuple(keys)
+
+
+def format_cookie(cookie, expires=None):
+    """Return the line of a Netscape cookie file for a cookie."""
+    if expires is None:
+        expires = cookie.expires
+    isdomain = 'TRUE' if cookie.isdomain else 'FALSE'
+    secure = 'TRUE' if cookie.secure else 'FALSE'
+    return '\t'.join([cookie.domain, isdomain, cookie.path, secure,
+                      format(expires), cookie.name, cookie.value]) + '\n'
 
 
 class Capacities:
@@ -292,10 +359,10 @@ class Cookie:
 import re
 _name_rx = re.compile(r"\s*(?P<value>[A-Z][-A-Z0-9]*)", re.IGNORECASE)
 _value_rx = re.compile(r"\s*=\s*(?P<value>[^;,\s]+)\s*")
-# RFC 850 date format...
+# RFC 850 or RFC 1123 date format...
 _date_rx = re.compile(
     r"""\s*=\s*(\"|'|)\s*
-        (?P<value>[A-Z]+,\s*\d+-[A-Z]+-\d+\s+\d+:\d+:\d+(?:\s+GMT)?)
+        (?P<value>[A-Z]+,\s*\d+[-\s][A-Z]+[-\s]\d+\s+\d+:\d+:\d+(?:\s+GMT)?)
         \s*(?:\1\s*)""",
     re.IGNORECASE | re.VERBOSE)
 del re
@@ -332,18 +399,23 @@ def parse_cookie(s):
     if value is None:
         raise ValueError("no value for cookie")
     s = s[pos:].strip()
-    pos = 0
-    if s and s[0] == ';':
-        # look for parameters
-        pos = 1
-    while s:
-        k, pos = _get_name(s, pos)
+    # look for parameters
+    while s and s[0] == ';':
+        # discard ';'
+        s = s[1:].strip()
+        if not s:
+            break
+        k, pos = _get_name(s)
         k = k.lower()
         if k == "expires":
             expires, pos = _get_value(s, pos, _date_rx)
             if expires is None:
                 raise ValueError("missing or unrecognized expiration date")
-            expires = ht_time.parse(expires)
+            try:
+                expires = ht_time.parse(expires)
+            except (ValueError, KeyError):
+                # Netscape's own format: Wdy, DD-Mon-YYYY HH:MM:SS GMT
+                expires = ht_time.parse(expires.replace('-', ' '))
         else:
             v, pos = _get_value(s, pos)
         #
@@ -351,7 +423,7 @@ def parse_cookie(s):
             secure = True
         elif k == 'path':
             path = v
-        elif k == 'domain':
+        elif k == 'domain' and v:
             domain = v.lower()
         elif k == 'max-age':
             max_age = int(v)
@@ -362,17 +434,12 @@ def parse_cookie(s):
             others[k] = v
         #
         s = s[pos:].strip()
-        if s and s[0] != ';':
-            break
-        if s:
-            # discard ';'
-            s = s[1:].strip()
-    if domain and domain[0] == '.':
-        minparts = 3
-        hostparts = '.'.split(domain)
+    if domain and domain[0] != '.':
+        domain = '.' + domain
+    if domain:
+        hostparts = domain.split('.')
         del hostparts[0]
-        if hostparts[-1] in SPECIAL_DOMAINS:
-            minparts = 2
+        minparts = 2 if is_special_domain(hostparts[-1]) else 3
         if len(hostparts) < minparts:
             raise ValueError("too few components in domain specification")
     # prefer max-age over expires
@@ -410,6 +477,36 @@ def testcgi():
     print("<code>testcgi()</code> function.")
 
 
+def benchmark(ncookies=50000, nlookups=100000):
+    """Time lookups in a large cookie database.
+
+    Run with "python -m grail.utils.cookielib".
+    """
+    import random
+    caps = Capacities()
+    caps.max_cookies = ncookies
+    db = CookieDB(caps=caps)
+    hosts = []
+    now = int(time.time())
+    t0 = time.perf_counter()
+    for i in range(ncookies // 10):
+        domain = "site{}.example.com".format(i)
+        hosts.append("www." + domain)
+        for j in range(10):
+            expires = now + random.randrange(60, 86400) if j % 2 else None
+            db.set_cookie(Cookie("." + domain if j < 5 else "www." + domain,
+                                 "/dir{}".format(j % 3) if j % 4 else "/",
+                                 False, expires, "name{}".format(j), "x"))
+    t1 = time.perf_counter()
+    found = 0
+    for host in random.choices(hosts, k=nlookups):
+        found = found + len(db.lookup(host, "/dir1/page.html"))
+    t2 = time.perf_counter()
+    print("{} cookies set in {:.2f} s".format(len(db), t1 - t0))
+    print("{} lookups ({} cookies found) in {:.2f} s: {:.1f} us each"
+          .format(nlookups, found, t2 - t1, (t2 - t1) * 1e6 / nlookups))
+
+
 # Testing stuff.  The following things really need testing:
 #
 # - Capacity handling:
@@ -418,4 +515,4 @@ def testcgi():
 # - Parsing of dates following expires parameter with various quoting.
 
 if __name__ == "__main__":
-    test()
+    benchmark()
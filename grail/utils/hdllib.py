@@ -16,6 +16,9 @@ Classes:
 - PacketUnpacker -- helper for packet unpacking
 - SessionTag -- helper for session tag management
 - HashTable -- hash table
+- Query -- one request to a handle server and its replies
+- Resolver -- non-blocking resolution of many queries on one socket
+- ResolutionCache -- cache of resolved handles and hash tables
 
 TO DO, doubts, questions:
 
@@ -23,7 +26,12 @@ XXX Constants should only have a prefix 'HP_' or 'HDL_' when their
     name occurs in the spec.  I've tried to fix this but may have
     missed some cases.
 
-XXX Should break up get_data in send_request and poll_request.
+Resolver sends queries without waiting for the replies.  Several
+queries can be in flight at once on its UDP socket; replies are
+matched to their query by session tag.  Polling the resolver (when its
+socket is readable, or when a timer goes off) reads the replies and
+resends or times out the queries that are due.  HashTable.get_data()
+is a blocking wrapper around a Resolver.
 
 XXX When retrying, should we generate a new tag or reuse the old one?
 I think yes, but this means repacking the request.
@@ -54,15 +62,21 @@ I think yes, but this means repacking the request.
 #
 # I didn't see a caching of authority handles and/or service handles,
 # this would be a tremendous increase for handle resolution.
+#
+# [ResolutionCache does that now.]
 
 import random
+import pickle
 import hashlib
 import os
 import select
 import socket
+import threading
 import time
+import unittest
 import xdrlib
 import binascii
+from collections import OrderedDict
 
 DEBUG = 0                               # Default debugging flag
 
@@ -81,6 +95,9 @@ DEFAULT_SERVERS = ['132.151.1.155',
 DEFAULT_NUM_OF_BITS = 2
 DEFAULT_HASH_FILE = '/usr/local/etc/hdl_hash.tbl'
 DEFAULT_UDP_PORT = 2222
+DEFAULT_HANDLE_TTL = 24 * 3600          # Seconds a resolution is cached
+DEFAULT_TABLE_TTL = 7 * 24 * 3600       # Seconds a hash table is cached
+DEFAULT_CACHE_ENTRIES = 1000
 DEFAULT_TCP_PORT = 2222
 DEFAULT_ADMIN_PORT = 80                 # Admin protocol uses HTTP now
 FILE_NAME_LENGTH = 128
@@ -287,7 +304,7 @@ class PacketUnpacker:
             print("length according to header:", end=" ")
             print(self.length_from_header, end=" ")
             print("actual length:", end=" ")
-            print(len(buf) - self.u.get_position())
+            print(len(self.buf()) - self.u.get_position())
             raise Error("body length mismatch")
 
     def unpack_item_array(self):
@@ -483,7 +500,8 @@ class HashTable:
 
         Otherwise, If the optional server argument is given, filename
         is ignored, and a single bucket hash table is constructed
-        using the default port and the given server.
+        using the given server, which may be "host:port"; the default
+        port is used otherwise.
 
         Otherwise, if a filename is give, read the hash table from
         that file.
@@ -546,11 +564,14 @@ class HashTable:
                 print("Constructing hardcoded hash table using", server)
             else:
                 print("Constructing hardcoded fallback hash table")
+        up = DEFAULT_UDP_PORT
         if server:
             self.num_of_bits = 0
+            server, sep, port = server.partition(':')
+            if sep:
+                up = int(port)
         else:
             self.num_of_bits = DEFAULT_NUM_OF_BITS
-        up = DEFAULT_UDP_PORT
         tp = DEFAULT_TCP_PORT
         ap = DEFAULT_ADMIN_PORT
         for i in range(1 << self.num_of_bits):
@@ -592,7 +613,7 @@ class HashTable:
         # Verify the checksum before proceeding
         checksum = data[:16]
         data = data[16:]
-        if haslib.md5(data).digest() != checksum:
+        if hashlib.md5(data).digest() != checksum:
             raise Error("checksum error for hash table")
 
         # Read and decode header
@@ -749,105 +770,88 @@ class HashTable:
         # In get_data function, it always makes a UDP connection. This
         # may not be the case for systems behind firewalls.
 
-        mytag = self.tag.session_tag()
-
-        p = PacketPacker()
-        p.pack_header(mytag, command=command)
-        p.pack_body(hdl, flags, types)
-        request = p.get_buffer()
-
-        (server, qport) = self.hash_handle(hdl)[2:4]
-
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        if self.debug:
-            print("Send request")
-        s.sendto(request, (server, qport))
-
-        expected = 1
-        responses = {}
-        endtime = time.time() + timeout
-
-        while len(responses) != expected:
+        resolver = Resolver(self.debug)
+        try:
+            query = resolver.query(self, hdl, types, flags, timeout,
+                                   interval, command, response)
+            resolver.wait(query)
+        finally:
+            resolver.close()
+        return query.result()
 
-            t = time.time()
-            if t > endtime:
-                raise Error("timed out")
-                break
 
-            (readers, writers, extras) = select.select(
-                [s], [], [], min(endtime - t, interval))
+class Query:
+    """One request to a handle server and the replies to it.
 
-            if s not in readers:
-                if self.debug:
-                    print("Nothing received yet...")
-                t = time.time()
-                if t + interval < endtime:
-                    if self.debug:
-                        print("Resend request")
-                    s.sendto(request, (server, qport))
-                continue
+    Created by Resolver.query().  Once done is true, result() returns
+    the (flags, items) of the reply or raises the Error it got.
 
-            reply, fromaddr = s.recvfrom(1024)
-            u = PacketUnpacker(reply, self.debug)
-            (tag, rcommand, err, sequence, total, version) = \
-                u.unpack_header()
+    """
 
+    def __init__(self, hdl, address, tag, request, timeout, interval,
+                 response, debug=0):
+        self.hdl = hdl
+        self.address = address
+        self.tag = tag
+        self.request = request
+        self.endtime = time.time() + timeout
+        self.interval = interval
+        self.next_send = 0
+        self.response = response
+        self.debug = debug
+        self.expected = 1
+        self.responses = {}
+        self.done = False
+        self.error = None
+
+    def deadline(self):
+        """Return the time at which the query needs attention."""
+        return min(self.next_send, self.endtime)
+
+    def fail(self, error):
+        self.error = error
+        self.done = True
+
+    def handle_reply(self, u, rcommand, err, sequence, total):
+        """Take one reply datagram, after its header was unpacked."""
+        if rcommand != self.response:
             if self.debug:
-                print('-' * 20)
-                print("Reply header:")
-                print("Version:       ", version)
-                print("Session tag:   ", tag)
-                print("Command:       ", rcommand)
-                print("Sequence#:     ", sequence)
-                print("#Datagrams:    ", total)
-                print("Error code:    ", err, end="")
-                if err in error_map:
-                    print(" ({})".format(error_map[err]), end="")
-                print()
-                print('-' * 20)
+                print("bad reply type")
+            return
 
-            if tag != mytag:
-                if self.debug:
-                    print("bad session tag")
-                continue
-
-            if rcommand != response:
-                if self.debug:
-                    print("bad reply type")
-                continue
-
-            if not 1 <= sequence <= total and not err:
-                if self.debug:
-                    print("bad sequence number")
-                continue
-
-            expected = total
-
-            if err != HP_OK:
-                if self.debug:
-                    print('err: ', err)
-                err_info = u.unpack_error_body(err)
-                if self.debug:
-                    print('err_info:', repr(err_info))
-                try:
-                    err_name = error_map[err]
-                except KeyError:
-                    err_name = str(err)
-                if self.debug:
-                    print('err_name:', repr(err))
-                raise Error(err_name, err, err_info)
-
-            flags, items = u.unpack_reply_body()
-
-            responses[sequence] = (flags, items)
+        if not 1 <= sequence <= total and not err:
+            if self.debug:
+                print("bad sequence number")
+            return
 
-        s.close()
+        self.expected = total
 
+        if err != HP_OK:
+            if self.debug:
+                print('err: ', err)
+            err_info = u.unpack_error_body(err)
+            if self.debug:
+                print('err_info:', repr(err_info))
+            try:
+                err_name = error_map[err]
+            except KeyError:
+                err_name = str(err)
+            self.fail(Error(err_name, err, err_info))
+            return
+
+        self.responses[sequence] = u.unpack_reply_body()
+        if len(self.responses) == self.expected:
+            self.done = True
+
+    def result(self):
+        """Return (flags, items) from the replies, or raise Error."""
+        if self.error is not None:
+            raise self.error
         allflags = None
         allitems = []
-        for i in range(1, expected + 1):
-            if i in responses:
-                (flags, items) = responses[i]
+        for i in range(1, self.expected + 1):
+            if i in self.responses:
+                (flags, items) = self.responses[i]
                 item = items[0]
                 #
                 # Check for a continuation packet, if we find one,
@@ -870,6 +874,290 @@ class HashTable:
         return (allflags, allitems)
 
 
+class Resolver:
+    """Non-blocking handle resolution.
+
+    All queries share one UDP socket; a reply is handed to the query
+    with its session tag.  Call poll() when fileno() is readable, and
+    at the latest at deadline(), to read replies and to resend or time
+    out queries.
+
+    If the after attribute is set to a function like Tk's after(), the
+    resolver polls itself when a query is due, and if that finishes
+    a query, it sends an empty datagram to its own socket so whoever
+    waits for the socket to become readable wakes up.
+
+    """
+
+    after = None
+
+    def __init__(self, debug=None):
+        if debug is None:
+            debug = DEBUG
+        self.debug = debug
+        self.tag = SessionTag()
+        self.queries = {}               # session tag -> Query
+        self.sock = None
+        self.timer = None
+
+    def fileno(self):
+        return self.get_socket().fileno()
+
+    def get_socket(self):
+        if self.sock is None:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.bind(('', 0))
+            self.sock.setblocking(False)
+        return self.sock
+
+    def close(self):
+        sock = self.sock
+        self.sock = None
+        if sock:
+            sock.close()
+        self.queries.clear()
+
+    def query(self, hashtable, hdl, types=[], flags=[], timeout=30,
+              interval=5, command=HP_QUERY, response=HP_QUERY_RESPONSE):
+        """Send a query for HDL to its server in HASHTABLE.
+
+        The other arguments are those of HashTable.get_data().  Return
+        the Query object.
+
+        """
+        tag = self.tag.session_tag()
+        while tag in self.queries:
+            tag = self.tag.session_tag()
+
+        p = PacketPacker()
+        p.pack_header(tag, command=command)
+        p.pack_body(hdl, flags, types)
+        request = p.get_buffer()
+
+        (server, qport) = hashtable.hash_handle(hdl)[2:4]
+
+        query = Query(hdl, (server, qport), tag, request, timeout,
+                      interval, response, self.debug)
+        self.queries[tag] = query
+        self.send(query)
+        self.schedule()
+        return query
+
+    def cancel(self, query):
+        if self.queries.get(query.tag) is query:
+            del self.queries[query.tag]
+
+    def send(self, query):
+        if self.debug:
+            print("Send request")
+        self.get_socket().sendto(query.request, query.address)
+        query.next_send = time.time() + query.interval
+
+    def deadline(self):
+        """Return when poll() must be called next, or None."""
+        if not self.queries:
+            return None
+        return min(query.deadline() for query in self.queries.values())
+
+    def poll(self):
+        """Read the replies that have arrived and take care of queries
+        that are due.  Return the list of queries that are done."""
+        finished = []
+        while self.sock is not None:
+            try:
+                reply, fromaddr = self.sock.recvfrom(1024)
+            except (BlockingIOError, InterruptedError):
+                break
+            except ConnectionRefusedError:
+                # An ICMP error for one of the requests; let it time out
+                continue
+            query = self.dispatch(reply)
+            if query is not None and query.done:
+                del self.queries[query.tag]
+                finished.append(query)
+
+        now = time.time()
+        for query in list(self.queries.values()):
+            if now > query.endtime:
+                query.fail(Error("timed out"))
+                del self.queries[query.tag]
+                finished.append(query)
+            elif now >= query.next_send and now + query.interval \
+                    < query.endtime:
+                if self.debug:
+                    print("Resend request")
+                self.send(query)
+        return finished
+
+    def dispatch(self, reply):
+        """Hand a reply to its query; return the query or None."""
+        if len(reply) < HP_HEADER_LENGTH:
+            # Maybe a wakeup() call
+            return None
+        u = PacketUnpacker(reply, self.debug)
+        (tag, rcommand, err, sequence, total, version) = \
+            u.unpack_header()
+
+        if self.debug:
+            print('-' * 20)
+            print("Reply header:")
+            print("Version:       ", version)
+            print("Session tag:   ", tag)
+            print("Command:       ", rcommand)
+            print("Sequence#:     ", sequence)
+            print("#Datagrams:    ", total)
+            print("Error code:    ", err, end="")
+            if err in error_map:
+                print(" ({})".format(error_map[err]), end="")
+            print()
+            print('-' * 20)
+
+        query = self.queries.get(tag)
+        if query is None:
+            if self.debug:
+                print("bad session tag")
+            return None
+        try:
+            query.handle_reply(u, rcommand, err, sequence, total)
+        except (Error, EOFError, xdrlib.Error) as err:
+            query.fail(err if isinstance(err, Error)
+                       else Error("bad reply: {}".format(err)))
+        return query
+
+    def wait(self, query):
+        """Block until QUERY is done."""
+        while not query.done:
+            timeout = max(0, self.deadline() - time.time())
+            select.select([self.get_socket()], [], [], timeout)
+            self.poll()
+
+    def schedule(self):
+        if self.after is None or self.timer is not None:
+            return
+        deadline = self.deadline()
+        if deadline is not None:
+            delay = max(0, int((deadline - time.time()) * 1000) + 1)
+            self.timer = self.after(delay, self.__timer)
+
+    def __timer(self):
+        self.timer = None
+        if self.poll():
+            self.wakeup()
+        self.schedule()
+
+    def wakeup(self):
+        """Make the socket readable."""
+        sock = self.get_socket()
+        sock.sendto(b'', ('127.0.0.1', sock.getsockname()[1]))
+
+
+class ResolutionCache:
+    """Cache of handle resolutions and hash tables.
+
+    Keys are made by handle_key() and table_key().  Each entry expires
+    after its time to live; beyond max_entries, the least recently
+    used entries are evicted.  hits and misses count the lookups.
+
+    With a filename, the cache is read from the file when created and
+    written back by save().
+
+    """
+
+    def __init__(self, filename=None, max_entries=DEFAULT_CACHE_ENTRIES):
+        self.filename = filename
+        self.max_entries = max_entries
+        self.entries = OrderedDict()    # key -> (expires, value)
+        self.hits = 0
+        self.misses = 0
+        self.changed = False
+        if filename:
+            self.load()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, now=None):
+        """Return the value cached for key, or None."""
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry[0] > (time.time() if now is None else now):
+                self.entries.move_to_end(key)
+                self.hits = self.hits + 1
+                return entry[1]
+            del self.entries[key]
+            self.changed = True
+        self.misses = self.misses + 1
+        return None
+
+    def put(self, key, value, ttl, now=None):
+        """Cache value for key during ttl seconds."""
+        if ttl <= 0:
+            return
+        if now is None:
+            now = time.time()
+        self.entries[key] = (now + ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        self.changed = True
+
+    def clear(self):
+        self.entries.clear()
+        self.changed = True
+
+    def load(self):
+        now = time.time()
+        try:
+            with open(self.filename, 'rb') as fp:
+                entries = pickle.load(fp)
+            entries = [(key, (expires, value))
+                       for key, (expires, value) in entries
+                       if expires > now]
+        except Exception:
+            # Missing, damaged or not written by save(): start empty
+            return
+        self.entries.update(entries)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def save(self):
+        if not (self.filename and self.changed):
+            return
+        with open(self.filename + '.tmp', 'wb') as fp:
+            pickle.dump(list(self.entries.items()), fp)
+        os.replace(self.filename + '.tmp', self.filename)
+        self.changed = False
+
+
+def handle_key(hdl, types):
+    """Return the ResolutionCache key for resolving hdl to types."""
+    if hdl[:2] == b'//':
+        hdl = hdl[2:]
+    return ('handle', hdl.upper(), tuple(types))
+
+
+def table_key(authority):
+    """Return the ResolutionCache key for the hash table of an
+    authority; b'' stands for the global hash table."""
+    return ('table', authority)
+
+
+def cache_period(items, default=DEFAULT_HANDLE_TTL):
+    """Return how long a resolution may be cached, in seconds.
+
+    This is the HDL_TYPE_CACHE_PERIOD item if the reply has one.
+
+    """
+    for type, data in items:
+        if type == HDL_TYPE_CACHE_PERIOD:
+            try:
+                return int(data.strip(b'\0 ') or b'0')
+            except ValueError:
+                if len(data) == 4:
+                    return int.from_bytes(data, 'big')
+    return default
+
+
 def hexstr(s):
     """Convert a byte string to hexadecimal."""
     return binascii.hexlify(s).decode("ascii")
@@ -881,24 +1169,26 @@ def fetch_global_hash_table(ht=None, debug=DEBUG):
         print("Fetching global hash table")
     if not ht:
         ht = HashTable(server=DEFAULT_GLOBAL_SERVER, debug=debug)
-    flags, items = ht.get_data(b"/service-pointer",
-                               command=HP_HASH_REQUEST,
-                               response=HP_HASH_RESPONSE)
+    flags, items = ht.get_data(*global_hash_table_request())
+    return HashTable(data=global_hash_table_data(items, debug), debug=debug)
+
+
+def global_hash_table_request():
+    """Return the get_data() arguments to ask for the global hash table."""
+    return (b"/service-pointer", [], [], 30, 5,
+            HP_HASH_REQUEST, HP_HASH_RESPONSE)
+
+
+def global_hash_table_data(items, debug=DEBUG):
+    """Return the global hash table data from the reply to its request."""
     hashtable = None
     for type, data in items:
         if type == HDL_TYPE_SERVICE_POINTER:
             # Version 2 of the handle protocol introduces the
             # HANDLE_SERVICE_ID.  This must be checked first.
             # As of 8/10/97 global now implements version 2.
-            urnscheme = data[:16]
-            if urnscheme == HANDLE_SERVICE_ID:
-                hashtable = data[16:]
-                # This data is in the same format as file "hdl_hash.tbl"
-                if debug:
-                    print("hash table data =", hexstr(hashtable))
-            else:
-                raise Error("Unknown SERVICE_ID: {}".format(urnscheme))
-    return HashTable(data=hashtable, debug=debug)
+            hashtable = service_pointer(data, debug)
+    return hashtable
 
 
 def fetch_local_hash_table(hdl, ht=None, debug=DEBUG):
@@ -910,20 +1200,40 @@ def fetch_local_hash_table(hdl, ht=None, debug=DEBUG):
 
     if debug:
         print("Fetching local hash table for", repr(hdl))
+    # 1. Create a HashTable object if none is provided
+    if not ht:
+        ht = HashTable(debug=debug)
+    # 2. Send the query and get the reply
+    flags, items = ht.get_data(*local_hash_table_request(hdl, debug))
+    # 3. Inspect the result
+    hashtable, handle = service_items(items, debug)
+    if not hashtable and handle:
+        flags, items = ht.get_data(handle,
+                                   types=[HDL_TYPE_SERVICE_POINTER])
+        hashtable, handle = service_items(items, debug)
+    if hashtable:
+        return HashTable(data=hashtable, debug=debug)
+    raise Error("Didn't get a hash table")
+
+
+def local_hash_table_request(hdl, debug=DEBUG):
+    """Return the get_data() arguments to ask for the local hash table
+    of a handle."""
     # 1. Get the authority name
     hdl = get_authority(hdl)
     # 2. Prefix the "ha.auth/" authority
     hdl = b"ha.auth/" + hdl
     if debug:
         print("Requesting handle", repr(hdl))
-    # 3. Create a HashTable object if none is provided
-    if not ht:
-        ht = HashTable(debug=debug)
-    # 4. Send the query and get the reply
-    flags, items = ht.get_data(hdl,
-                               types=[HDL_TYPE_SERVICE_POINTER,
-                                      HDL_TYPE_SERVICE_HANDLE])
-    # 5. Inspect the result
+    return hdl, [HDL_TYPE_SERVICE_POINTER, HDL_TYPE_SERVICE_HANDLE]
+
+
+def service_items(items, debug=DEBUG):
+    """Return (hash table data, service handle) from a reply.
+
+    Either may be None.
+
+    """
     hashtable = None
     handle = None
     for type, data in items:
@@ -932,42 +1242,25 @@ def fetch_local_hash_table(hdl, ht=None, debug=DEBUG):
                 print("service handle =", hexstr(data))
             handle = data
         elif type == HDL_TYPE_SERVICE_POINTER:
-            urnscheme = data[:16]
-            urndata = data[16:]
-            if debug:
-                print("URN scheme =", repr(urnscheme))
-            if urnscheme == HANDLE_SERVICE_ID:
-                hashtable = urndata
-                if debug:
-                    print("hash table data =", hexstr(hashtable))
-            else:
-                raise Error("Unknown SERVICE_ID: {}".format(urnscheme))
+            hashtable = service_pointer(data, debug)
         else:
             if debug:
                 print("type", type, "=", data)
-    if hashtable:
-        return HashTable(data=hashtable, debug=debug)
-    elif handle:
-        flags, items = ht.get_data(handle,
-                                   types=[HDL_TYPE_SERVICE_POINTER])
-        for type, data in items:
-            if type == HDL_TYPE_SERVICE_POINTER:
-                urnscheme = data[:16]
-                urndata = data[16:]
-                if debug:
-                    print("URN scheme =", repr(urnscheme))
-                if urnscheme == HANDLE_SERVICE_ID:
-                    hashtable = urndata
-                    if debug:
-                        print("hash table data =", hexstr(hashtable))
-                    return HashTable(data=hashtable, debug=debug)
-                else:
-                    raise Error("Unknown SERVICE_ID: {}".format(urnscheme))
-            else:
-                if debug:
-                    print("type", type, "=", data)
+    return hashtable, handle
 
-    raise Error("Didn't get a hash table")
+
+def service_pointer(data, debug=DEBUG):
+    """Return the hash table data from a service pointer."""
+    urnscheme = data[:16]
+    if debug:
+        print("URN scheme =", repr(urnscheme))
+    if urnscheme != HANDLE_SERVICE_ID:
+        raise Error("Unknown SERVICE_ID: {}".format(urnscheme))
+    hashtable = data[16:]
+    # This data is in the same format as file "hdl_hash.tbl"
+    if debug:
+        print("hash table data =", hexstr(hashtable))
+    return hashtable
 
 
 def get_authority(hdl):
@@ -978,6 +1271,172 @@ def get_authority(hdl):
     return hdl.lower()
 
 
+def make_service_pointer(host, port):
+    """Return a service pointer to a one-bucket hash table for a
+    handle server at host (in dot notation) and port."""
+    bucket = xdrlib.Packer()
+    bucket.pack_int(0)                          # slot no
+    bucket.pack_int(0)                          # weight
+    bucket.pack_opaque(bytes(map(int, host.split('.'))))
+    bucket.pack_int(port)                       # udp query port
+    bucket.pack_int(port)                       # tcp query port
+    bucket.pack_int(DEFAULT_ADMIN_PORT)
+    bucket.pack_int(-1)                         # secondary slot no
+    bucket = bucket.get_buffer()
+    header = xdrlib.Packer()
+    header.pack_int(1)                          # schema version
+    header.pack_int(1)                          # data version
+    header.pack_int(0)                          # num of bits
+    header.pack_int(len(bucket))                # max slot size
+    header.pack_int(4)                          # max address length
+    header.pack_fopaque(16, bytes(16))          # unique id
+    data = header.get_buffer() + bucket
+    return HANDLE_SERVICE_ID + hashlib.md5(data).digest() + data
+
+
+class StandInServer:
+    """A local handle server for testing, run in a thread.
+
+    HANDLES maps handles (bytes) to lists of (type, value) items;
+    other handles are not found.  The reply for a handle in DELAYS is
+    sent that many seconds late; the first request for a handle in
+    DROP gets no reply at all.
+
+    """
+
+    def __init__(self, handles, delays={}, drop=()):
+        self.handles = handles
+        self.delays = delays
+        self.drop = set(drop)
+        self.requests = []
+        self.timers = []
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.address = "{}:{}".format(*self.sock.getsockname())
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.start()
+
+    def close(self):
+        self.sock.sendto(b'', self.sock.getsockname())
+        self.thread.join()
+        for timer in self.timers:
+            timer.cancel()
+            timer.join()
+        self.sock.close()
+
+    def serve(self):
+        while True:
+            request, client = self.sock.recvfrom(1024)
+            if not request:
+                break
+            u = PacketUnpacker(request)
+            tag, command = u.unpack_header()[:2]
+            hdl = u.unpack_request_body()[0]
+            self.requests.append(hdl)
+            if hdl in self.drop:
+                self.drop.remove(hdl)
+                continue
+            reply = self.reply(tag, command + 1, hdl)
+            timer = threading.Timer(self.delays.get(hdl, 0),
+                                    self.sock.sendto, (reply, client))
+            self.timers.append(timer)
+            timer.start()
+
+    def service_pointer(self):
+        """Return a service pointer to a hash table for this server."""
+        return make_service_pointer(*self.sock.getsockname())
+
+    def reply(self, tag, command, hdl):
+        p = PacketPacker()
+        if hdl not in self.handles:
+            p.pack_header(tag, command, HP_HANDLE_NOT_FOUND)
+            p.p.pack_string(b'')
+            return p.get_buffer()
+        items = self.handles[hdl]
+        body = xdrlib.Packer()
+        body.pack_opaque(b'\0')
+        body.pack_uint(len(items))
+        for type, value in items:
+            body.pack_uint(type)
+            body.pack_int(len(value))
+            body.pack_fopaque(len(value), value)
+        data = body.get_buffer()
+        p.pack_header(tag, command)
+        p.p.pack_string(data + hashlib.md5(data).digest())
+        return p.get_buffer()
+
+
+class Test(unittest.TestCase):
+
+    """Resolve handles against a StandInServer.
+
+    Run with "python -m unittest grail.utils.hdllib".
+    """
+
+    def setUp(self):
+        self.server = StandInServer(
+            {b'test/slow': [(HDL_TYPE_URL, b'http://slow/')],
+             b'test/fast': [(HDL_TYPE_URL, b'http://fast/')],
+             b'test/lost': [(HDL_TYPE_URL, b'http://lost/'),
+                            (HDL_TYPE_EMAIL_RFC822, b'lost@found')]},
+            delays={b'test/slow': 0.3}, drop=[b'test/lost'])
+        self.hashtable = HashTable(server=self.server.address)
+
+    def tearDown(self):
+        self.server.close()
+
+    def runTest(self):
+        resolver = Resolver()
+        queries = [resolver.query(self.hashtable, hdl, interval=0.1)
+                   for hdl in (b'test/slow', b'test/fast', b'test/lost',
+                               b'test/none')]
+        done = []
+        while len(done) < len(queries):
+            select.select([resolver], [], [], resolver.deadline()
+                          - time.time())
+            done.extend(query.hdl for query in resolver.poll())
+        resolver.close()
+        # the replies come back in a different order on one socket
+        self.assertEqual(done[-1], b'test/slow')
+        self.assertEqual(queries[0].result()[1],
+                         [(HDL_TYPE_URL, b'http://slow/')])
+        self.assertEqual(queries[1].result()[1],
+                         [(HDL_TYPE_URL, b'http://fast/')])
+        self.assertEqual(len(queries[2].result()[1]), 2)
+        with self.assertRaises(Error) as cm:
+            queries[3].result()
+        self.assertEqual(cm.exception.errno, HP_HANDLE_NOT_FOUND)
+        # the dropped request was sent again
+        self.assertEqual(self.server.requests.count(b'test/lost'), 2)
+        # and the blocking interface still works
+        self.assertEqual(self.hashtable.get_data(b'test/fast')[1],
+                         [(HDL_TYPE_URL, b'http://fast/')])
+
+
+class CacheFileTest(unittest.TestCase):
+
+    """A ResolutionCache is saved to its file and read back."""
+
+    def runTest(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'cache')
+            cache = ResolutionCache(filename)
+            cache.put(handle_key(b'test/1', [HDL_TYPE_URL]), 'live', 60)
+            cache.put(handle_key(b'test/2', [HDL_TYPE_URL]), 'dead', 60,
+                      time.time() - 120)
+            cache.save()
+            self.assertEqual(list(ResolutionCache(filename).entries),
+                             [handle_key(b'test/1', [HDL_TYPE_URL])])
+            # A file that can't be read is ignored
+            for data in (b'', b'garbage', pickle.dumps(None),
+                         pickle.dumps([1, 2]), pickle.dumps({'key': 1}),
+                         pickle.dumps([('key', ('never', 'x'))])):
+                with open(filename, 'wb') as fp:
+                    fp.write(data)
+                self.assertEqual(len(ResolutionCache(filename)), 0)
+
+
 # Test sets
 
 testsets = [